@@ -3,7 +3,7 @@ import clang.cindex
 
 from traitlets.config import Configurable
 from traitlets.config import PyFileConfigLoader
-from traitlets import Unicode, Bool, observe
+from traitlets import Unicode, Bool, Int, Float, List, observe
 
 __version__ = "1.10"
 
@@ -72,6 +72,8 @@ class Database(Configurable):
     localonly = Bool(False, config=True)  # use local even if a mongodb server is defined
     user = Unicode("", config=True)  # don't define a mongodb user
     verify = Bool(True, config=True)  # don't authenticate mongodb user
+    cache = Unicode("", config=True)  # don't use a persistent cache of unfolded types
+    deps = Bool(True, config=True)  # maintain the local dependency index
 
 
 class Collect(Configurable):
@@ -82,6 +84,13 @@ class Collect(Configurable):
     allc = Bool(False, config=True)  # parse everything including function bodies
     tmp = Unicode()  # don't change temp directory
     lib = Unicode("", config=True)  # allow to choose clang_library_file
+    jobs = Int(1, config=True)  # parse files sequentially (0 means all cpus)
+    prelude = List(Unicode(), config=True)  # don't precompile common headers
+    batch = Int(10000, config=True)  # insert collected documents by batches of 10000
+    timeout = Float(0, config=True)  # don't limit parsing time of a file (seconds)
+    maxmem = Int(0, config=True)  # don't limit memory of parsing processes (MB)
+    decompose = Bool(False, config=True)  # don't store decomposed fields types
+    checkpoint = Bool(False, config=True)  # don't journal collected files
 
     @observe("lib")
     def _lib_changed(self, change):
@@ -0,0 +1,463 @@
+import re
+import json
+import sqlite3
+
+"""
+This module implements the index of the values of constants (macros and enum
+constants) of the database: macros are evaluated as C integer constant
+expressions (possibly referencing other macros or enum constants) by a safe
+evaluator that only supports literals, identifiers, casts to integer types and
+C operators (following the LP64 integer types and conversions), so that
+constants can be found by value or by decomposition of a mask of flags without
+evaluating every macro of the database for each query.
+"""
+
+# ------------------------------------------------------------------------------
+
+re_tok = re.compile(
+    r"\s*(?:"
+    r"(?P<num>(?:0[xX][0-9a-fA-F]+|0[bB][01]+|[0-9]+)(?P<sfx>[uUlL]*)(?![\w.]))|"
+    r"(?P<chr>'(?:\\.|[^\\'])+')|"
+    r"(?P<id>[A-Za-z_]\w*)|"
+    r"(?P<op><<|>>|<=|>=|==|!=|&&|\|\||[-+*/%&|^~!<>()?:])"
+    r")"
+)
+
+escapes = {"n": 10, "t": 9, "r": 13, "0": 0, "a": 7, "b": 8, "f": 12, "v": 11}
+
+# (bits, unsigned) of integer type names (other words are qualifiers):
+inttypes = {
+    "char": (8, False),
+    "short": (16, False),
+    "int": (32, False),
+    "long": (64, False),
+    "_Bool": (8, True),
+    "bool": (8, True),
+    "size_t": (64, True),
+    "ssize_t": (64, False),
+    "intptr_t": (64, False),
+    "uintptr_t": (64, True),
+    "ptrdiff_t": (64, False),
+}
+for n in (8, 16, 32, 64):
+    inttypes["int%d_t" % n] = (n, False)
+    inttypes["uint%d_t" % n] = (n, True)
+    inttypes["__u%d" % n] = (n, True)
+    inttypes["__s%d" % n] = (n, False)
+    inttypes["u%d" % n] = (n, True)
+
+qualifiers = ("const", "volatile", "signed", "unsigned")
+
+# binary operators by increasing precedence:
+binops = (("||",), ("&&",), ("|",), ("^",), ("&",), ("==", "!="),
+          ("<", "<=", ">", ">="), ("<<", ">>"), ("+", "-"), ("*", "/", "%"))
+
+
+def wrap(v, bits, uns):
+    "Returns the (value, bits, unsigned) of v converted to the given type."
+    v &= (1 << bits) - 1
+    if not uns and v >> (bits - 1):
+        v -= 1 << bits
+    return (v, bits, uns)
+
+
+def literal(s, sfx):
+    "Returns the typed value of an integer literal with suffix sfx."
+    if s[:2] in ("0b", "0B"):
+        v = int(s[2:], 2)
+    elif s[:2] in ("0x", "0X"):
+        v = int(s, 16)
+    elif s != "0" and s[0] == "0":
+        v = int(s, 8)
+    else:
+        v = int(s)
+    sfx = sfx.lower()
+    uns = "u" in sfx
+    decimal = s[0] != "0" or s == "0"
+    for bits in (64,) if "l" in sfx else (32, 64):
+        for u in (uns,) if (uns or decimal) else (False, True):
+            if v < (1 << (bits - (0 if u else 1))):
+                return (v, bits, u)
+    if v < (1 << 64):
+        return (v, 64, True)
+    raise ValueError("integer literal too large: %s" % s)
+
+
+class CExpr(object):
+    """
+    Evaluator of C integer constant expressions where identifiers are resolved
+    by the lookup function (that returns the integer value of an identifier or
+    raises KeyError.) Raises ValueError if the expression is not a supported
+    constant expression.
+    """
+
+    def __init__(self, expr, lookup=None):
+        self.toks = []
+        pos, expr = 0, expr.strip()
+        while pos < len(expr):
+            m = re_tok.match(expr, pos)
+            if m is None or m.end() == pos:
+                raise ValueError("invalid token in '%s'" % expr)
+            self.toks.append((m.lastgroup, m))
+            pos = m.end()
+        self.i = 0
+        self.lookup = lookup
+
+    def peek(self):
+        if self.i < len(self.toks):
+            k, m = self.toks[self.i]
+            return (k, m.group(k))
+        return (None, None)
+
+    def take(self, val=None):
+        k, v = self.peek()
+        if k is None or (val is not None and v != val):
+            raise ValueError("expected '%s'" % val)
+        self.i += 1
+        return self.toks[self.i - 1]
+
+    def value(self):
+        if not self.toks:
+            raise ValueError("empty expression")
+        r = self.ternary()
+        if self.i != len(self.toks):
+            raise ValueError("unexpected token '%s'" % self.peek()[1])
+        return r[0]
+
+    def ternary(self):
+        c = self.binary(0)
+        if self.peek() == ("op", "?"):
+            self.take("?")
+            a = self.ternary()
+            self.take(":")
+            b = self.ternary()
+            return a if c[0] else b
+        return c
+
+    def binary(self, level):
+        if level == len(binops):
+            return self.unary()
+        a = self.binary(level + 1)
+        while self.peek()[0] == "op" and self.peek()[1] in binops[level]:
+            op = self.take()[1].group("op")
+            b = self.binary(level + 1)
+            a = self.apply(op, a, b)
+        return a
+
+    @staticmethod
+    def apply(op, a, b):
+        if op == "&&":
+            return (int(bool(a[0] and b[0])), 32, False)
+        if op == "||":
+            return (int(bool(a[0] or b[0])), 32, False)
+        if op in ("<<", ">>"):
+            bits, uns = max(a[1], 32), a[2]
+            if not 0 <= b[0] < bits:
+                raise ValueError("invalid shift")
+            v = a[0] << b[0] if op == "<<" else a[0] >> b[0]
+            return wrap(v, bits, uns)
+        bits = max(a[1], b[1], 32)
+        uns = (a[2] and a[1] == bits) or (b[2] and b[1] == bits)
+        x, y = wrap(a[0], bits, uns)[0], wrap(b[0], bits, uns)[0]
+        if op in ("==", "!=", "<", "<=", ">", ">="):
+            r = {"==": x == y, "!=": x != y, "<": x < y,
+                 "<=": x <= y, ">": x > y, ">=": x >= y}[op]
+            return (int(r), 32, False)
+        if op in ("/", "%"):
+            if y == 0:
+                raise ValueError("division by zero")
+            q = abs(x) // abs(y)
+            if (x < 0) != (y < 0):
+                q = -q
+            return wrap(q if op == "/" else x - q * y, bits, uns)
+        v = {"+": x + y, "-": x - y, "*": x * y,
+             "&": x & y, "|": x | y, "^": x ^ y}[op]
+        return wrap(v, bits, uns)
+
+    def casttype(self):
+        """
+        Returns the (bits, unsigned) of the integer type name at the current
+        (open parenthesis) token followed by a closing parenthesis, or None.
+        """
+        j = self.i + 1
+        words = []
+        while j < len(self.toks) and self.toks[j][0] == "id":
+            words.append(self.toks[j][1].group("id"))
+            j += 1
+        if not words or j >= len(self.toks) or self.toks[j][1].group("op") != ")":
+            return None
+        W = [w for w in words if w not in qualifiers]
+        if any((w not in inttypes) for w in W):
+            return None
+        bits, uns = inttypes[W[0]] if W else (32, False)
+        if W.count("long") == 2:
+            bits = 64
+        if "unsigned" in words:
+            uns = True
+        self.i = j + 1
+        return (bits, uns)
+
+    def unary(self):
+        k, v = self.peek()
+        if k == "op" and v in ("-", "+", "~", "!"):
+            self.take()
+            a = self.unary()
+            bits = max(a[1], 32)
+            if v == "-":
+                return wrap(-a[0], bits, a[2])
+            if v == "~":
+                return wrap(~a[0], bits, a[2])
+            if v == "!":
+                return (int(not a[0]), 32, False)
+            return wrap(a[0], bits, a[2])
+        if k == "op" and v == "(":
+            t = self.casttype()
+            if t is not None:
+                a = self.unary()
+                return wrap(a[0], t[0], t[1])
+        return self.primary()
+
+    def primary(self):
+        k, m = self.take()
+        if k == "num":
+            return literal(m.group("num")[: len(m.group("num")) - len(m.group("sfx"))],
+                           m.group("sfx"))
+        if k == "chr":
+            s = m.group("chr")[1:-1]
+            if s[0] == "\\":
+                c = s[1:]
+                if c in escapes:
+                    return (escapes[c], 32, False)
+                if c[0] == "x":
+                    return wrap(int(c[1:], 16), 8, False)
+                if c.isdigit():
+                    return wrap(int(c, 8), 8, False)
+                s = c
+            if len(s) != 1:
+                raise ValueError("invalid char literal")
+            return (ord(s), 32, False)
+        if k == "id":
+            if self.lookup is None:
+                raise ValueError("undefined symbol '%s'" % m.group("id"))
+            try:
+                v = self.lookup(m.group("id"))
+            except KeyError:
+                raise ValueError("undefined symbol '%s'" % m.group("id"))
+            return literal_value(v)
+        if m.group("op") == "(":
+            r = self.ternary()
+            self.take(")")
+            return r
+        raise ValueError("unexpected token '%s'" % m.group("op"))
+
+
+def literal_value(v):
+    "Returns the typed value of an int (of the smallest type that can hold it.)"
+    for bits in (32, 64):
+        if -(1 << (bits - 1)) <= v < (1 << (bits - 1)):
+            return (v, bits, False)
+    if 0 <= v < (1 << 64):
+        return (v, 64, True)
+    raise ValueError("value too large: %d" % v)
+
+
+def c_eval(expr, lookup=None):
+    """
+    Returns the integer value of the C constant expression expr, where
+    identifiers are resolved by the lookup function (see CExpr.)
+    """
+    return CExpr(expr, lookup).value()
+
+
+# ------------------------------------------------------------------------------
+
+
+def constants(docs):
+    """
+    Yields the (value, symbol, doc) tuples of all constants defined by the
+    given list of cMacro and cEnum documents: enum constants and macros that
+    evaluate to an integer. Identifiers in macros are resolved to constants of
+    the same tag only (so that the constants of a tag don't depend on other
+    tags, see ConstIndex.update.)
+    """
+    E, M = {}, {}
+    for d in docs:
+        if d["cls"] == "cEnum":
+            for k, v in d["val"].items():
+                E.setdefault(k, {}).setdefault(d.get("tag"), v)
+        elif d["cls"] == "cMacro":
+            M.setdefault(d["id"], {}).setdefault(d.get("tag"), d["val"])
+    V = {}
+
+    def value(name, tag):
+        if tag in E.get(name, ()):
+            return E[name][tag]
+        if tag not in M.get(name, ()):
+            raise KeyError(name)
+        D = M[name]
+        k = (name, tag)
+        if k not in V:
+            # (recursive definitions are undefined:)
+            V[k] = None
+            try:
+                V[k] = c_eval(D[tag], lambda n: value(n, tag))
+            except (ValueError, RecursionError):
+                pass
+        if V[k] is None:
+            raise KeyError(name)
+        return V[k]
+
+    for d in docs:
+        if d["cls"] == "cEnum":
+            for k, v in d["val"].items():
+                yield (v, k, d)
+        elif d["cls"] == "cMacro":
+            try:
+                v = value(d["id"], d.get("tag"))
+            except KeyError:
+                continue
+            yield (v, d["id"], d)
+
+
+def int64(v):
+    "Returns the signed 64 bits integer with the same (low) bits as v."
+    return wrap(v, 64, False)[0]
+
+
+def mask_ranges(value):
+    """
+    Returns the list of (low, high) ranges of (signed 64 bits) values of the
+    positive constants with bits that are all in the (64 bits) mask value:
+    such constants are between the lowest bit of the mask and the mask itself.
+    """
+    u = value & ((1 << 64) - 1)
+    if u == 0:
+        return []
+    lo, R = u & -u, []
+    if lo < (1 << 63):
+        R.append((lo, min(u, (1 << 63) - 1)))
+    if u >= (1 << 63):
+        R.append((int64(max(lo, 1 << 63)), int64(u)))
+    return R
+
+
+def decompose(value, flags):
+    """
+    Returns the (names, rest) decomposition of value in the list of flags
+    given as (value, name) tuples with bits that are all in value: flags with
+    more bits are chosen first, each only if none of its bits are already
+    covered, and rest is the mask of remaining bits. Names are sorted by value.
+    """
+    F = sorted(set(flags), key=lambda x: (-bin(x[0]).count("1"), -x[0], x[1]))
+    rest, R = value, []
+    for v, n in F:
+        if v and (v & rest) == v:
+            R.append((v, n))
+            rest &= ~v
+    return ([n for v, n in sorted(R)], rest)
+
+
+# ------------------------------------------------------------------------------
+
+
+class ConstIndex(object):
+    """
+    This class implements the index of the values of constants of the local
+    database, stored in a SQLite file next to it (see Proxy.constants.)
+
+    The "consts" table maps the (signed 64 bits) value of every constant to its
+    symbol, the cls, id, tag and src of the document that defines it and its
+    doc_id, and the exact value as a string.
+
+    Attributes:
+        path (str): the index file path
+        stamp (str): the stamp of the database when the index was built
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.con = sqlite3.connect(path)
+        self.con.execute("CREATE TABLE IF NOT EXISTS meta (k TEXT PRIMARY KEY, v TEXT)")
+        self.con.execute(
+            "CREATE TABLE IF NOT EXISTS consts (value INTEGER, raw TEXT, symbol TEXT, "
+            "cls TEXT, id TEXT, tag TEXT, src TEXT, doc_id INTEGER)"
+        )
+        self.con.execute("CREATE INDEX IF NOT EXISTS consts_v ON consts (value)")
+        self.con.execute("CREATE INDEX IF NOT EXISTS consts_t ON consts (tag)")
+        r = self.con.execute("SELECT v FROM meta WHERE k = 'stamp'").fetchone()
+        self.stamp = r and json.loads(r[0])
+
+    def __repr__(self):
+        return u"<ConstIndex [%s]>" % self.path
+
+    def build(self, docs, stamp):
+        """
+        Replaces the content of the index by the constants of the given cMacro
+        and cEnum documents (that have a doc_id) and records the stamp of the
+        indexed database.
+        """
+        self.con.execute("DELETE FROM consts")
+        self.add(docs)
+        self.set_stamp(stamp)
+
+    def update(self, docs, tag, stamp):
+        """
+        Replaces the constants of given tag by those of the given cMacro and
+        cEnum documents of this tag, and records the stamp of the database.
+        """
+        self.con.execute("DELETE FROM consts WHERE tag = ?", (tag,))
+        self.add(docs)
+        self.set_stamp(stamp)
+
+    def add(self, docs):
+        "Adds the constants of the given cMacro and cEnum documents."
+        self.con.executemany(
+            "INSERT INTO consts VALUES (?,?,?,?,?,?,?,?)",
+            (
+                (int64(v), str(v), n, d["cls"], d["id"], d.get("tag"), d.get("src"), d.doc_id)
+                for v, n, d in constants(docs)
+            ),
+        )
+
+    def set_stamp(self, stamp):
+        "Records the stamp of the database that the index is up-to-date with."
+        self.con.execute(
+            "INSERT OR REPLACE INTO meta VALUES ('stamp', ?)", (json.dumps(stamp),)
+        )
+        self.con.commit()
+        self.stamp = stamp
+
+    def select(self, value, symbol="", tag=None, mask=False):
+        """
+        Returns the list of (value, symbol, cls, id, tag, src, doc_id) tuples of
+        constants (of given tag if not None and with symbol containing the given
+        string) equal to value, or if mask is True, of non-null constants with
+        bits that are all in value (found in the ranges of indexed values given
+        by mask_ranges.)
+        """
+        if mask:
+            R = mask_ranges(value)
+            if not R:
+                return []
+            sql = "SELECT * FROM consts WHERE (%s) AND (value & ?) = value" % " OR ".join(
+                ["value BETWEEN ? AND ?"] * len(R)
+            )
+            params = [b for r in R for b in r] + [int64(value)]
+        else:
+            sql = "SELECT * FROM consts WHERE value = ?"
+            params = [int64(value)]
+        if symbol:
+            sql += " AND instr(symbol, ?) > 0"
+            params.append(symbol)
+        if tag is not None:
+            sql += " AND tag = ?"
+            params.append(tag)
+        R = []
+        for r in self.con.execute(sql + " ORDER BY rowid", params):
+            v = int(r[1])
+            if (v & ~value == 0 and v > 0) if mask else (v == value):
+                R.append((v,) + r[2:])
+        return R
+
+    def close(self):
+        self.con.close()
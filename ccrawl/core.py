@@ -1,7 +1,7 @@
 from collections import OrderedDict
 from ccrawl import formatters
-from ccrawl.utils import struct_letters, c_type, cxx_type
-from ccrawl.db import where
+from ccrawl.utils import struct_letters, c_type, cxx_type, LRU
+from ccrawl.db import where, val_digest
 
 
 class ccore(object):
@@ -23,8 +23,9 @@ class ccore(object):
     Attributes:
         formatter (function): a function used to print the object
                               in various formats.
-        _cache_ (dict): a global (parent class level) dict of all types
-                        that have been fetched from the database so far.
+        _cache_ (LRU): a global (parent class level) dict of the (most
+                       recently used) types that have been fetched from
+                       the database so far.
     """
 
     _is_typedef = False
@@ -37,7 +38,7 @@ class ccore(object):
     _is_template = False
     _is_namespace = False
     formatter = None
-    _cache_ = {}
+    _cache_ = LRU(100000)
 
     def show(self, db=None, r=None, form=None):
         """
@@ -61,6 +62,14 @@ class ccore(object):
         self.subtypes = OrderedDict()
         return self
 
+    def deps(self):
+        """
+        Generic method that returns the list of identifiers of all types on
+        which this type directly depends (ie. the keys of its subtypes once
+        unfolded) without querying any database.
+        """
+        return []
+
     def build(self, db):
         """
         Generic method for building a ctypes instance for this type.
@@ -90,6 +99,8 @@ class ccore(object):
                 self.subtypes[elt] = None
                 return
         self.subtypes[elt] = x.unfold(db, limit)
+        if limit is None and hasattr(db, "remember"):
+            db.remember(x)
 
     def graph(self,db,V=None,g=None):
         """
@@ -141,24 +152,36 @@ class ccore(object):
         if name == "cNamespace":
             return cNamespace
 
-    def to_db(self, identifier, tag, src):
+    def to_db(self, identifier, tag, src, decompose=False):
         """
         Generic method that returns a list of database-insertable "documents"
-        for the current item.
+        for the current item. Each document holds the "hash" digest of its
+        value (see db.val_digest.)
+        If decompose is True, the documents of structs and unions also hold
+        the decomposition of their fields' types (see fields_types.)
         """
         doc = {
             "id": identifier,
             "val": self,
             "cls": self.__class__.__name__,
             "src": src,
+            "hash": val_digest(self),
         }
         if tag:
             doc["tag"] = tag
+        if decompose and (self._is_struct or self._is_union):
+            T = []
+            for (t, n, c) in self:
+                try:
+                    T.append(c_type(t).to_dict() if "&" not in t else None)
+                except Exception:
+                    T.append(None)
+            doc["types"] = T
         data = [doc]
         if hasattr(self, "local"):
             for i, x in iter(self.local.items()):
                 if x:
-                    data.extend(x.to_db(i, tag, identifier))
+                    data.extend(x.to_db(i, tag, identifier, decompose))
         return data
 
     @staticmethod
@@ -175,8 +198,25 @@ class ccore(object):
         val = ccore.getcls(data["cls"])(data["val"])
         val.identifier = identifier
         val.subtypes = None
+        if "types" in data:
+            val.types = data["types"]
         return val
 
+    def fields_types(self, parse=c_type):
+        """
+        Generic method that iterates over the (t,n,c) fields of a struct or
+        union and yields (t,n,c,r) tuples where r is the decomposed type t,
+        either obtained from the database document or parsed with the given
+        parse function (c_type by default.)
+        """
+        T = getattr(self, "types", None) or ()
+        for i, (t, n, c) in enumerate(self):
+            if i < len(T) and T[i] is not None:
+                r = c_type.from_dict(T[i])
+            else:
+                r = parse(t)
+            yield (t, n, c, r)
+
 
 # ------------------------------------------------------------------------------
 
@@ -207,6 +247,10 @@ class cTypedef(str, ccore):
                 self.add_subtype(db, elt, limit)
         return self
 
+    def deps(self):
+        elt = c_type(self).lbase
+        return [elt] if elt not in struct_letters else []
+
     def __eq__(self, other):
         return str(self) == str(other)
 
@@ -238,8 +282,7 @@ class cStruct(list, ccore):
             self.subtypes = OrderedDict()
             T = list(struct_letters.keys())
             T.append(self.identifier)
-            for (t, n, c) in self:
-                ctype = c_type(t)
+            for (t, n, c, ctype) in self.fields_types():
                 if limit != None:
                     if limit <= 0 and ctype.is_ptr:
                         continue
@@ -251,6 +294,14 @@ class cStruct(list, ccore):
                     self.add_subtype(db, elt, limit)
         return self
 
+    def deps(self):
+        T = list(struct_letters.keys())
+        T.append(self.identifier)
+        for (t, n, c, ctype) in self.fields_types():
+            if ctype.lbase not in T:
+                T.append(ctype.lbase)
+        return T[len(struct_letters) + 1 :]
+
     def index_of(self,n):
         i=0
         for f in self:
@@ -288,27 +339,31 @@ class cClass(list, ccore):
     def unfold(self, db, limit=None):
         if self.subtypes is None:
             self.subtypes = OrderedDict()
-            T = list(struct_letters.keys())
-            T.append(self.identifier)
-            for (x, y, _) in self:
-                qal, t = x
-                mn, n = y
-                if qal == "parent":
-                    elt = [n]
-                elif qal == "using":
-                    elt = t
-                else:
-                    if mn or ("virtual" in qal):
-                        continue
-                    elt = cxx_type(t)
-                    elt = elt.show_base(kw=True, ns=True)
-                    elt = [elt]
-                for e in elt:
-                    if e not in T:
-                        T.append(e)
-                        self.add_subtype(db, e, limit)
+            for e in self.deps():
+                self.add_subtype(db, e, limit)
         return self
 
+    def deps(self):
+        T = list(struct_letters.keys())
+        T.append(self.identifier)
+        for (x, y, _) in self:
+            qal, t = x
+            mn, n = y
+            if qal == "parent":
+                elt = [n]
+            elif qal == "using":
+                elt = t
+            else:
+                if mn or ("virtual" in qal):
+                    continue
+                elt = cxx_type(t)
+                elt = elt.show_base(kw=True, ns=True)
+                elt = [elt]
+            for e in elt:
+                if e not in T:
+                    T.append(e)
+        return T[len(struct_letters) + 1 :]
+
     def build(self, db):
         from ccrawl.ext import ctypes_
 
@@ -453,8 +508,7 @@ class cUnion(list, ccore):
             self.subtypes = OrderedDict()
             T = list(struct_letters.keys())
             T.append(self.identifier)
-            for (t, n, c) in self:
-                ctype = c_type(t)
+            for (t, n, c, ctype) in self.fields_types():
                 if limit != None:
                     if limit <= 0 and ctype.is_ptr:
                         continue
@@ -466,6 +520,14 @@ class cUnion(list, ccore):
                     self.add_subtype(db, elt, limit)
         return self
 
+    def deps(self):
+        T = list(struct_letters.keys())
+        T.append(self.identifier)
+        for (t, n, c, ctype) in self.fields_types():
+            if ctype.lbase not in T:
+                T.append(ctype.lbase)
+        return T[len(struct_letters) + 1 :]
+
     def index_of(self,n):
         i=0
         for f in self:
@@ -522,17 +584,21 @@ class cFunc(dict, ccore):
     def unfold(self, db, limit=None):
         if self.subtypes is None:
             self.subtypes = OrderedDict()
-            T = list(struct_letters.keys())
-            rett = self.restype()
-            args = self.argtypes()
-            args.insert(0, rett)
-            for t in args:
-                elt = c_type(t).lbase
-                if elt not in T:
-                    T.append(elt)
-                    self.add_subtype(db, elt)
+            for elt in self.deps():
+                self.add_subtype(db, elt)
         return self
 
+    def deps(self):
+        T = list(struct_letters.keys())
+        rett = self.restype()
+        args = self.argtypes()
+        args.insert(0, rett)
+        for t in args:
+            elt = c_type(t).lbase
+            if elt not in T:
+                T.append(elt)
+        return T[len(struct_letters) :]
+
     def __eq__(self, other):
         return str(self) == str(other)
 
@@ -569,11 +635,12 @@ class cNamespace(list, ccore):
     def unfold(self, db, limit=None):
         if self.subtypes is None:
             self.subtypes = OrderedDict()
-            T = list(struct_letters.keys())
-            T.append(self.identifier)
-            for elt in self:
+            for elt in self.deps():
                 self.add_subtype(db, elt)
         return self
 
+    def deps(self):
+        return list(OrderedDict.fromkeys(self))
+
     def __eq__(self, other):
         return list(self) == list(other)
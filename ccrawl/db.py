@@ -1,13 +1,23 @@
+import os
+import time
+import atexit
 import requests
 import click
+import hashlib
+import json
+import sqlite3
+from collections import deque
 from tinydb.storages import JSONStorage, MemoryStorage
 from tinydb.middlewares import CachingMiddleware
+from tinydb.table import Document, Table
 from tinydb import TinyDB, Query, where
+from ccrawl.utils import LRU
 
 """
 This module implements all classes that allow to interact with the various databases
 that are supported by ccrawl. The idea was to allow ccrawl to work either in 'local'
-mode with a TinyDB database stored as a json file, or in 'remote' mode with a MongoDB
+mode with a TinyDB database stored as a json file (or an indexed SQLite database if
+the local path starts with "sqlite://"), or in 'remote' mode with a MongoDB
 database suited for querying very large sets of documents. 
 """
 
@@ -22,6 +32,10 @@ class Proxy(object):
     to a native MongoDB query when interacting with the remote database. This has
     limitations since MongoDB queries are more expressive but we can always use
     directly the Proxy.rdb instance to avoid this limitation.
+
+    If a persistent cache is configured (Database.cache), queries that test the
+    equality of the "id" are answered from the documents of this id kept in memory,
+    which are initially loaded from the cached closure of this type when possible.
     """
 
     def __init__(self, config):
@@ -29,14 +43,29 @@ class Proxy(object):
         self.ldb = None
         self.rdb = None
         self.tag = Query().noop()
+        self.tagname = None
         self.req = None
-        if config.local:
+        self.cache = None
+        self._docs = LRU(100000)
+        self._key = None
+        self._saved = set()
+        self._lindex = None
+        self._lstale = True
+        self._tindex = None
+        self._cindex = None
+        self._cstale = True
+        if config.local.startswith("sqlite://"):
+            self.ldb = SQLiteDB(config.local[9:])
+        elif config.local:
             try:
                 self.ldb = TinyDB(config.local, storage=CachingMiddleware(JSONStorage))
             except Exception:
                 self.ldb = TinyDB(storage=MemoryStorage)
         else:
             self.ldb = TinyDB(storage=MemoryStorage)
+        if isinstance(self.ldb, TinyDB):
+            # lookups by id use the (lazy) index of IndexedTable:
+            self.ldb.table_class = IndexedTable
         if config.url:
             auth = None
             if config.user:
@@ -49,6 +78,8 @@ class Proxy(object):
                 self.rdb = dbclass(config.url, auth=auth, verify=config.verify)
             except Exception:
                 self.rdb = None
+        if config.cache:
+            self.cache = TypesCache(config.cache)
 
     def set_tag(self, tag=None):
         """
@@ -56,12 +87,53 @@ class Proxy(object):
         the database by document.tag values.
         """
         self.tag = (where("tag") == tag) if (tag is not None) else Query().noop()
+        self.tagname = tag
 
     def insert_multiple(self, docs):
         """
         Inserts multiple documents in the *local* database only.
+        Returns the list of inserted doc_ids.
+        (The trigram index, if it exists, is updated with these documents,
+        but their dependency index is only built by build_deps.)
+        """
+        I = self._trigrams_index()
+        self.forget()
+        ids = self.ldb.insert_multiple(docs)
+        if I is not None:
+            I.add(zip(ids, docs))
+        return ids
+
+    def replace(self, doc, doc_id):
+        """
+        Replaces the document of given doc_id in the *local* database only.
+        Its dependency index is dropped unless doc has a "use" list (see
+        build_deps.)
+        """
+        I = self._trigrams_index()
+        self.forget()
+
+        def swap(d):
+            d.update(doc)
+            if "use" not in doc:
+                d.pop("use", None)
+                d.pop("used_by", None)
+
+        self.ldb.update(swap, doc_ids=[doc_id])
+        if I is not None:
+            I.add([(doc_id, doc)])
+
+    def flush(self):
         """
-        self.ldb.insert_multiple(docs)
+        Writes pending changes of the *local* database to its file.
+        """
+        I = self._trigrams_index()
+        self.forget()
+        if isinstance(self.ldb, SQLiteDB):
+            self.ldb.flush()
+        elif isinstance(self.ldb.storage, CachingMiddleware):
+            self.ldb.storage.flush()
+        if I is not None:
+            I.set_stamp(self.stamp())
 
     def contains(self, q=None, **kargs):
         """
@@ -73,6 +145,9 @@ class Proxy(object):
             q = self.tag
         for k in kargs:
             q &= where(k) == kargs[k]
+        L = self._cached(q)
+        if L is not None:
+            return any((q(x) for x in L))
         if self.rdb and not self.c.localonly:
             return self.rdb.contains(q._hash, **kargs)
         return self.ldb.contains(q)
@@ -89,6 +164,9 @@ class Proxy(object):
             q = self.tag & q
         for k in kargs:
             q &= where(k) == kargs[k]
+        L = self._cached(q)
+        if L is not None:
+            return [x for x in L if q(x)]
         if self.rdb and not self.c.localonly:
             return list(self.rdb.search(q._hash, **kargs))
         return self.ldb.search(q)
@@ -103,42 +181,397 @@ class Proxy(object):
             q = self.tag
         for k in kargs:
             q &= where(k) == kargs[k]
+        L = self._cached(q)
+        if L is not None:
+            for x in L:
+                if q(x):
+                    return x
+            return None
         if self.rdb and not self.c.localonly:
             return self.rdb.get(q._hash, **kargs)
         return self.ldb.get(q)
 
+    def cachekey(self):
+        """
+        Returns the (identity, stamp, tag) tuple that identifies the content
+        of the database filtered by self.tag in the persistent cache, or None
+        if there is no persistent cache or if the database is not stored in a
+        file. The stamp changes whenever documents are added to or removed from
+        the database.
+        """
+        if self.cache is None:
+            return None
+        if self._key is None:
+            if self.rdb and not self.c.localonly:
+                ident, stamp = repr(self.rdb), self.rdb.stamp()
+            else:
+                ident = self.sidecar("")
+                if ident is None:
+                    return None
+                ident = os.path.abspath(ident)
+                try:
+                    st = os.stat(ident)
+                except OSError:
+                    return None
+                stamp = "%d:%d" % (st.st_mtime_ns, st.st_size)
+            self.cache.invalidate(ident, stamp)
+            self._key = (ident, stamp)
+        return self._key + (repr(self.tag._hash),)
+
+    def _cached(self, q):
+        """
+        Returns the list of all documents with the id tested by query q
+        (or None if q is not an id lookup or if there is no persistent cache.)
+        Documents are fetched at most once and kept in memory, and if the id
+        is the root of a cached closure, all documents of this closure are
+        loaded as well.
+        """
+        if self.cache is None:
+            return None
+        v = query_id(getattr(q, "_hash", None))
+        if v is None:
+            return None
+        L = self._docs.get(v)
+        if L is None:
+            key = self.cachekey()
+            if key is None:
+                return None
+            D = self.cache.load(key, v)
+            if D:
+                for k, docs in D.items():
+                    self._docs[k] = docs
+            L = self._docs.get(v)
+        if L is None:
+            qv = where("id") == v
+            if self.rdb and not self.c.localonly:
+                L = [dict(((k, x[k]) for k in x if k != "_id")) for x in self.rdb.search(qv._hash)]
+            else:
+                L = self.ldb.search(qv)
+            self._docs[v] = L
+        return L
+
+    def remember(self, x):
+        """
+        Saves in the persistent cache the documents of all types in the closure
+        of the unfolded ccore object x, so that they are all loaded at once by
+        the next lookup of x.
+        """
+        key = self.cachekey()
+        if key is None or x.identifier in self._saved:
+            return
+        D = {}
+        S = [(x.identifier, x)]
+        while S:
+            k, y = S.pop()
+            if k in D:
+                continue
+            docs = self._docs.get(k)
+            if docs is None:
+                return
+            D[k] = docs
+            if y is not None and y.subtypes:
+                S.extend(y.subtypes.items())
+        self.cache.save(key, x.identifier, D)
+        self._saved.add(x.identifier)
+
+    def forget(self):
+        """
+        Drops documents kept in memory by the cache (the database is about to
+        be modified.)
+        """
+        self._docs.clear()
+        self._key = None
+        self._saved.clear()
+        self._lstale = True
+        self._cstale = True
+
     def cleanup_local(self):
         """
         Removes duplicates from the *local* database only.
         (Documents are considered duplicates if their "id" and "val"
-        attributes are equal.)
+        attributes are equal, "val" being compared by its "hash" digest.)
         """
         D = {}
         for e in self.ldb.search(self.tag):
-            k = "%s := %s" % (e["id"], e["val"])
+            k = (e["id"], e.get("hash") or val_digest(e["val"]))
             if not k in D:
                 D[k] = [e.doc_id]
             else:
                 D[k].append(e.doc_id)
+        self.forget()
         for v in D.values():
             if len(v) > 1:
                 self.ldb.remove(doc_ids=v[1:])
 
+    def remove_sources(self, srcs):
+        """
+        Removes from the *local* database only all documents (filtered
+        by self.tag) collected from the given source files, including the
+        documents of their nested types (whose "src" is their parent's "id".)
+        Returns the number of removed documents.
+        """
+        self.forget()
+        srcs = set(srcs)
+        n = 0
+        while srcs:
+            L = self.ldb.search(self.tag & where("src").test(lambda s: s in srcs))
+            self.ldb.remove(doc_ids=[e.doc_id for e in L])
+            n += len(L)
+            srcs = set((e["id"] for e in L))
+        return n
+
+    @staticmethod
+    def doc_deps(l):
+        """
+        Returns the "use" list of document l, computed from its value
+        if missing (see ccore.deps.)
+        """
+        from ccrawl.core import ccore
+
+        u = l.get("use")
+        if u is None:
+            try:
+                u = ccore.from_db(l).deps()
+            except Exception:
+                u = []
+        return u
+
+    def deps_index(self, L):
+        """
+        Returns the (U, R) dependency index of the list L of documents, where
+        U is the list of the "use" lists of each document (the identifiers of
+        types on which it directly depends) and R is the dict that maps an
+        identifier to the list of identifiers of documents of L that use it.
+        Documents that already have a "use" list are not unfolded again.
+        """
+        U = []
+        R = {}
+        for l in L:
+            u = self.doc_deps(l)
+            U.append(u)
+            for e in u:
+                R.setdefault(e, {})[l["id"]] = None
+        return (U, {e: list(r) for e, r in R.items()})
+
+    def build_deps(self):
+        """
+        Builds (or updates) the dependency index of the *local* database
+        documents filtered by self.tag, in a single pass: every document gets
+        a "use" list (see deps_index) and a "used_by" list of the identifiers
+        of documents that depend on it. Only documents with a missing or
+        outdated index are updated.
+        Returns the number of updated documents.
+        """
+        L = self.ldb.search(self.tag)
+        U, R = self.deps_index(L)
+        ids = []
+        for l, u in zip(L, U):
+            if l.get("use") != u or l.get("used_by") != R.get(l["id"], []):
+                ids.append(l.doc_id)
+        if ids:
+
+            def link(d):
+                d["use"] = self.doc_deps(d)
+                d["used_by"] = R.get(d["id"], [])
+
+            self.forget()
+            self.ldb.update(link, doc_ids=ids)
+        return len(ids)
+
+    def sidecar(self, ext):
+        """
+        Returns the path of the file with given extension stored next to
+        the *local* database file (or None if the local database is not
+        stored in a file.)
+        """
+        if isinstance(self.ldb, SQLiteDB):
+            if self.ldb.path != ":memory:":
+                return self.ldb.path + ext
+        elif self.c.local and not isinstance(self.ldb.storage, MemoryStorage):
+            return self.c.local + ext
+        return None
+
     def cleanup(self):
         """
         Wrapper for remote cleanup method.
         """
         self.rdb.cleanup(self)
 
-    def find_matching_types(self, Locs, req=None, psize=0):
+    def layouts(self):
+        """
+        Returns the LayoutIndex of the structures of the *local* database,
+        stored next to the database file (see sidecar) and rebuilt if the
+        database has been modified since it was built.
+        """
+        from ccrawl.layout import LayoutIndex, Layouts
+
+        if self._lindex is None:
+            self._lindex = LayoutIndex(self.sidecar(".layouts") or ":memory:")
+            self._lstale = False
+        stamp = self.stamp()
+        if self._lstale or stamp != self._lindex.stamp:
+            L = self.ldb.search((where("cls") == "cStruct") | (where("cls") == "cClass"))
+            self._lindex.build(L, Layouts(self.ldb), stamp)
+            self._lstale = False
+        return self._lindex
+
+    def constants(self, tag=None, since=None):
+        """
+        Returns the ConstIndex of the constants of the *local* database,
+        stored next to the database file (see sidecar) and rebuilt if the
+        database has been modified since it was built.
+        If tag is not None and the index was up-to-date with the database
+        stamp since, the database is assumed to have been modified only by
+        documents of this tag (as by collect) and only the constants of this
+        tag are updated.
+        """
+        from ccrawl.constants import ConstIndex
+
+        if self._cindex is None:
+            self._cindex = ConstIndex(self.sidecar(".constants") or ":memory:")
+            self._cstale = False
+        stamp = self.stamp()
+        if self._cstale or stamp != self._cindex.stamp:
+            Q = (where("cls") == "cMacro") | (where("cls") == "cEnum")
+            if tag is not None and since not in (None, "-") and since == self._cindex.stamp:
+                self._cindex.update(self.ldb.search(Q & (where("tag") == tag)), tag, stamp)
+            else:
+                self._cindex.build(self.ldb.search(Q), stamp)
+            self._cstale = False
+        return self._cindex
+
+    def find_constants(self, value, symbol="", mask=False, q=None):
         """
-        Wrapper for find_matching_types method.
+        Returns the list of (value, symbol, cls, id, tag, src) tuples of the
+        constants (filtered by self.tag, with symbol containing the given
+        string and defined by a document that matches the query q if not None)
+        equal to value, or if mask is True, of non-null constants with bits
+        that are all in value (see constants.decompose.)
+        Constants are found from the index of the constants of the *local*
+        database or from the constants collection of the remote database.
         """
         if self.rdb and not self.c.localonly:
-            self.rdb.find_matching_types(Locs, req, psize)
-        else:
-            click.secho("find_matching_types is not supported for local database",fg='red')
-        return Locs
+            return self.rdb.find_constants(
+                value, symbol, mask, self.tagname, None if q is None else q._hash
+            )
+        R = []
+        for r in self.constants().select(value, symbol, self.tagname, mask):
+            if q is None or q(self.ldb.get(doc_id=r[-1])):
+                R.append(r[:-1])
+        return R
+
+    def stamp(self):
+        """
+        Returns the stamp of the *local* database file that changes whenever
+        the file is written (or "-" if the database is not stored in a file.)
+        """
+        ident = self.sidecar("")
+        if ident is not None and os.path.isfile(ident):
+            st = os.stat(ident)
+            return "%d:%d" % (st.st_mtime_ns, st.st_size)
+        return "-"
+
+    def trigrams(self):
+        """
+        Returns the TrigramIndex of the documents of the *local* database,
+        stored next to the database file (see sidecar) and rebuilt if the
+        database file has been written since the index was updated (or if
+        the database is not stored in a file.)
+        Documents inserted (or replaced) by the Proxy only add trigrams to an
+        existing index, and removed documents are left in it since candidates
+        of the index are always checked against the query (see search_rex.)
+        """
+        from ccrawl.trigrams import TrigramIndex
+
+        if self._tindex is None:
+            self._tindex = TrigramIndex(self.sidecar(".trigrams") or ":memory:")
+        stamp = self.stamp()
+        if stamp == "-" or stamp != self._tindex.stamp:
+            self._tindex.build(((l.doc_id, l) for l in self.ldb.all()), stamp)
+        return self._tindex
+
+    def _trigrams_index(self):
+        """
+        Returns the (up-to-date) TrigramIndex if it is opened or if its file
+        exists, or None otherwise.
+        """
+        if self._tindex is None:
+            f = self.sidecar(".trigrams")
+            if f is None or not os.path.isfile(f):
+                return None
+        return self.trigrams()
+
+    def search_rex(self, rex, q):
+        """
+        Returns the list of documents matching the query q (filtered by
+        self.tag) that tests documents against the regular expression rex.
+        Only candidate documents that have the trigrams of the literal parts
+        of rex (see trigrams.regex_trigrams) are tested, using the trigram
+        index of the *local* database or the "tri" field of remote documents.
+        """
+        from ccrawl.trigrams import regex_trigrams
+
+        T = regex_trigrams(rex)
+        if T is None:
+            return self.search(q)
+        if self.rdb and not self.c.localonly:
+            return list(self.rdb.search_trigrams((self.tag & q)._hash, T))
+        q = self.tag & q
+        R = []
+        for i in self.trigrams().candidates(T):
+            d = self.ldb.get(doc_id=i)
+            if d is not None and q(d):
+                R.append(d)
+        return R
+
+    def find_matching_types(self, Locs, req=None, psize=0, k=0):
+        """
+        Wrapper for find_matching_types method. For the *local* database,
+        the (offset, size) locations of all names are looked up at once in
+        the index of layouts (for pointer sizes of 4 and 8 bytes if psize
+        is 0) and req is the dict of values that matching documents must
+        have. Candidates are ranked for each name (see rank_types.)
+        If k>0, structures are not required to have all locations and
+        the k best scored candidates are returned for each name as (id,
+        score) tuples (see rank_scores.)
+        """
+        if self.rdb and not self.c.localonly:
+            return self.rdb.find_matching_types(Locs, req, psize, k)
+        I = self.layouts()
+        psize = psize // 8 if psize > 8 else psize
+        P = (psize,) if psize else I.psizes
+        if k > 0:
+            N = [n for n, S in Locs.items() if S]
+            C = {}
+            for p in P if N else ():
+                R = I.ranked(p, [Locs[n] for n in N], 4 * k, tag=self.tagname)
+                for i, L in R.items():
+                    C.setdefault(N[i], []).extend(L)
+            if req and C:
+                C = self._filter_req(C, req)
+            return rank_scores(Locs, C, k)
+        locs = set()
+        for S in Locs.values():
+            locs.update(map(tuple, S))
+        C = []
+        for p in P if locs else ():
+            C.extend(I.candidates(p, locs, tag=self.tagname))
+        if req and C:
+            C = self._filter_req({None: C}, req)[None]
+        return rank_types(Locs, C)
+
+    def _filter_req(self, C, req):
+        """
+        Filters the dict of lists of candidate tuples (whose first element is
+        the identifier) by the dict req of values that their local documents
+        must have.
+        """
+        ids = set((c[0] for L in C.values() for c in L))
+        D = self.ldb.search(where("id").one_of(list(ids)))
+        ok = set(
+            (d["id"] for d in D if all((d.get(k) == v for k, v in req.items())))
+        )
+        return dict(((n, [c for c in L if c[0] in ok]) for n, L in C.items()))
 
     def close(self):
         """
@@ -150,6 +583,516 @@ class Proxy(object):
 # ------------------------------------------------------------------------------
 
 
+def kpad(x):
+    """
+    Returns the deduplication key of document x: cFunc documents are keyed
+    by id+prototype and other documents are keyed by id+src.
+    """
+    if x["cls"] == "cFunc":
+        return x["id"] + x["val"]["prototype"]
+    return x["id"] + x["src"]
+
+
+def val_digest(val):
+    """
+    Returns the hex digest of the val of a document, independently of the
+    ordering of its dict keys.
+    """
+    v = json.dumps(val, sort_keys=True, separators=(",", ":"))
+    return hashlib.blake2b(v.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def rank_types(Locs, C):
+    """
+    Updates the Locs dict of {name: [(offset,size),...]} locations with the
+    (S, ids) tuple of identifiers of candidate structures that have all
+    locations of S. Candidates are given as (id, size, count, locs) tuples
+    where count is the number of distinct locations of the structure and
+    locs is the set of its locations (or at least of those that are in Locs.)
+
+    Identifiers are ranked by number of locations not accessed in S, then
+    by size so that the tightest structures come first.
+    """
+    for n, S in Locs.items():
+        s = set(map(tuple, S))
+        R = sorted(
+            ((c - len(s), sz, i) for (i, sz, c, l) in C if s and s.issubset(l))
+        )
+        ids = []
+        for _, _, i in R:
+            if i not in ids:
+                ids.append(i)
+        Locs[n] = (S, ids)
+    return Locs
+
+
+def access_match(S, fields):
+    """
+    Returns the (matched, exact) tuple for the list S of (offset, size[, "*"])
+    accesses and the (offset, size, ptr) fields of a structure (where ptr is
+    None if unknown.) Each access matches the fields at its offset with value
+    1 if sizes are equal (exact) or 0.5 otherwise, halved if the access is
+    a pointer ("*") and the field is known not to be a pointer. Matched is the
+    sum over accesses of their best values and exact is the number of accesses
+    that have a field of equal size.
+    """
+    F = {}
+    for o, sz, ptr in fields:
+        if sz > 0:
+            F.setdefault(o, []).append((sz, ptr))
+    matched, exact = 0.0, 0
+    for a in set(map(tuple, S)):
+        V = [
+            (1.0 if sz == a[1] else 0.5)
+            * (0.5 if (a[2:] == ("*",) and ptr is False) else 1.0)
+            for sz, ptr in F.get(a[0], ())
+        ]
+        if V:
+            matched += max(V)
+            exact += any((sz == a[1] for sz, _ in F[a[0]]))
+    return (matched, exact)
+
+
+def type_score(S, size, count, matched, exact):
+    """
+    Returns the score (in [0,1]) of a structure of given size and number of
+    distinct (offset, size) locations for the list S of accesses, given its
+    matched and exact values (see access_match.) The score is mostly the
+    ratio of matched accesses, with a lower weight for the ratio of fields
+    that are accessed, and is halved if some access is beyond the structure.
+    """
+    S = set(map(tuple, S))
+    if not S:
+        return 0.0
+    fit = 1.0 if size >= max((a[0] + a[1] for a in S)) else 0.5
+    prec = exact / count if count else 0.0
+    return round(fit * (0.8 * matched / len(S) + 0.2 * prec), 4)
+
+
+def rank_scores(Locs, C, k):
+    """
+    Updates the Locs dict of {name: [(offset,size[,"*"]),...]} accesses with
+    the (S, [(id, score),...]) tuple of the k best scored candidates, given
+    C as the dict of lists of (id, size, count, matched, exact) candidates by
+    name (see type_score.) The best score of an id is kept.
+    """
+    for n, S in Locs.items():
+        B = {}
+        for i, size, count, matched, exact in C.get(n, ()):
+            sc = type_score(S, size, count, matched, exact)
+            if sc > B.get(i, 0.0):
+                B[i] = sc
+        R = sorted(B.items(), key=lambda x: (-x[1], x[0]))
+        Locs[n] = (S, R[:k])
+    return Locs
+
+
+class Sink(object):
+    """
+    Streaming writer of collected documents into the *local* database of
+    a Proxy. Documents are deduplicated (see kpad) and inserted by batches
+    of size documents.
+
+    With the SQLite backend, each batch is written to the database file, so
+    that only the current batch and the (hashed) keys of already inserted
+    documents are kept in memory. A TinyDB database keeps all its documents
+    in memory and rewrites its whole file when written, so batches are only
+    inserted and the file is written once by the final flush.
+
+    For duplicated keys, the first document is kept except for cFunc
+    documents which are replaced by any new one that has locals/calls.
+
+    If a journal (see journal.Checkpoint) is provided, it is committed
+    each time the database file is written.
+
+    Attributes:
+        db (Proxy): the database proxy
+        size (int): the number of documents per batch
+        count (int): the number of inserted documents
+        journal (Checkpoint): the optional journal of collected files
+        stream (bool): True if each batch is written to the database file
+    """
+
+    def __init__(self, db, size=10000, journal=None):
+        self.db = db
+        self.size = size
+        self.journal = journal
+        self.stream = isinstance(db.ldb, SQLiteDB)
+        self.count = 0
+        self.batch = {}
+        # hashed keys of inserted documents, mapped to their doc_id if
+        # they are cFunc (that could be replaced), or to 0 otherwise:
+        self.keys = {}
+
+    @staticmethod
+    def key(x):
+        return hashlib.blake2b(kpad(x).encode("utf-8"), digest_size=8).digest()
+
+    @staticmethod
+    def has_body(x):
+        return x["cls"] == "cFunc" and bool(x["val"]["locs"] or x["val"]["calls"])
+
+    def skip(self, docs):
+        """
+        Marks the keys of given documents (already in the database) as inserted.
+        """
+        for x in docs:
+            self.keys[self.key(x)] = 0
+
+    def add(self, l):
+        """
+        Adds the list l of parsed documents, and flushes the current batch
+        if it is full.
+        """
+        for x in l:
+            k = self.key(x)
+            if k in self.batch:
+                if self.has_body(x):
+                    self.batch[k] = x
+            elif k in self.keys:
+                if self.keys[k] and self.has_body(x):
+                    self.db.replace(x, self.keys[k])
+            else:
+                self.batch[k] = x
+        if len(self.batch) >= self.size:
+            if self.stream:
+                self.flush()
+            else:
+                self.insert()
+
+    def insert(self):
+        """
+        Inserts the current batch in the database.
+        """
+        if self.batch:
+            ids = self.db.insert_multiple(list(self.batch.values()))
+            for (k, x), i in zip(self.batch.items(), ids):
+                self.keys[k] = i if x["cls"] == "cFunc" else 0
+            self.count += len(self.batch)
+            self.batch = {}
+
+    def flush(self):
+        """
+        Inserts the current batch in the database and writes it to disk.
+        """
+        self.insert()
+        self.db.flush()
+        if self.journal is not None:
+            self.journal.commit()
+
+
+# ------------------------------------------------------------------------------
+
+
+def query_id(q):
+    """
+    Returns the value v if the TinyDB.Query hash q is an equality test
+    where("id") == v, possibly and-ed with other tests (or None otherwise.)
+    """
+    if q and q[0] == "==" and q[1] == ("id",) and isinstance(q[2], str):
+        return q[2]
+    if q and q[0] == "and":
+        for x in q[1]:
+            v = query_id(x)
+            if v is not None:
+                return v
+    return None
+
+
+class IndexedTable(Table):
+    """
+    TinyDB table that keeps a hash index of its documents by "id", built
+    lazily and dropped whenever the table is modified (i.e. when its query
+    cache is cleared.) Queries that test the equality of the "id" (and
+    possibly the tag or other attributes) only check the indexed documents
+    with this id rather than scanning the whole table.
+    """
+
+    def __init__(self, *args, **kargs):
+        super().__init__(*args, **kargs)
+        self._index = None
+
+    def clear_cache(self):
+        super().clear_cache()
+        self._index = None
+
+    def _lookup(self, cond):
+        "Returns the list of (doc_id, doc) candidates for cond, or None."
+        v = query_id(getattr(cond, "_hash", None))
+        if v is None:
+            return None
+        table = self._read_table()
+        if self._index is None:
+            self._index = {}
+            for i, doc in table.items():
+                self._index.setdefault(doc.get("id"), []).append(i)
+        return [(i, table[i]) for i in self._index.get(v, ())]
+
+    def search(self, cond):
+        L = self._lookup(cond)
+        if L is None:
+            return super().search(cond)
+        return [
+            self.document_class(doc, self.document_id_class(i))
+            for i, doc in L
+            if cond(doc)
+        ]
+
+    def get(self, cond=None, doc_id=None, doc_ids=None):
+        L = None
+        if doc_id is None and doc_ids is None:
+            L = self._lookup(cond)
+        if L is None:
+            return super().get(cond, doc_id, doc_ids)
+        for i, doc in L:
+            if cond(doc):
+                return self.document_class(doc, self.document_id_class(i))
+        return None
+
+    def contains(self, cond=None, doc_id=None):
+        if doc_id is None and self._lookup(cond) is not None:
+            return self.get(cond) is not None
+        return super().contains(cond, doc_id)
+
+
+# ------------------------------------------------------------------------------
+
+
+class SQLiteDB(object):
+    """
+    This class implements a local database stored in a SQLite file with
+    the subset of the TinyDB interface used by ccrawl.
+
+    Documents are stored as json in the "nodes" table which also holds
+    their "id", "cls", "tag", "src" and "hash" attributes in indexed columns.
+    Queries are *translated* to a SQL condition on these columns (like
+    MongoDB._where does) that preselects candidate documents, which are
+    then checked against the query itself if the translation is partial.
+    """
+
+    columns = ("id", "cls", "tag", "src", "hash")
+    storage = None
+
+    def __init__(self, path):
+        self.path = path
+        self.con = sqlite3.connect(path)
+        self.con.execute(
+            "CREATE TABLE IF NOT EXISTS nodes (doc_id INTEGER PRIMARY KEY, "
+            "id TEXT, cls TEXT, tag TEXT, src TEXT, hash TEXT, doc TEXT)"
+        )
+        # databases created before the hash column:
+        C = [r[1] for r in self.con.execute("PRAGMA table_info(nodes)")]
+        if "hash" not in C:
+            self.con.execute("ALTER TABLE nodes ADD COLUMN hash TEXT")
+        for c in self.columns:
+            self.con.execute("CREATE INDEX IF NOT EXISTS nodes_%s ON nodes (%s)" % (c, c))
+
+    def __repr__(self):
+        return u"<SQLiteDB [%s]>" % self.path
+
+    def _where(self, q):
+        """
+        Translate a TinyDB.Query hash into a tuple (sql, params, exact) where
+        exact is True if the SQL condition is equivalent to the query
+        (or (None, [], False) if the query can't be translated.)
+        """
+        if q is None:
+            return (None, [], False)
+        if len(q) == 0:
+            return ("1", [], True)
+        op = q[0]
+        if op == "==" and len(q[1]) == 1 and q[1][0] in self.columns:
+            if isinstance(q[2], str):
+                return ("%s = ?" % q[1][0], [q[2]], True)
+        elif op in ("and", "or"):
+            L = [self._where(x) for x in q[1]]
+            T = [x for x in L if x[0] is not None]
+            if op == "or" and len(T) < len(L):
+                return (None, [], False)
+            if T:
+                j = " %s " % op.upper()
+                sql = j.join(("(%s)" % x[0] for x in T))
+                params = sum((x[1] for x in T), [])
+                return (sql, params, len(T) == len(L) and all((x[2] for x in T)))
+        return (None, [], False)
+
+    def _select(self, cond=None, doc_ids=None, limit=None):
+        "Generator of the Documents matching cond and/or doc_ids."
+        sql = "SELECT doc_id, doc FROM nodes"
+        W, params, exact = [], [], True
+        if cond is not None:
+            w, params, exact = self._where(getattr(cond, "_hash", None))
+            if w is not None:
+                W.append(w)
+        if doc_ids is not None:
+            W.append("doc_id IN (%s)" % ",".join((str(int(i)) for i in doc_ids)))
+        if W:
+            sql += " WHERE " + " AND ".join(W)
+        sql += " ORDER BY doc_id"
+        if limit is not None and (cond is None or exact):
+            sql += " LIMIT %d" % limit
+        for i, d in self.con.execute(sql, params).fetchall():
+            x = Document(json.loads(d), doc_id=i)
+            if exact or cond is None or cond(x):
+                yield x
+
+    def _row(self, doc):
+        return tuple(
+            (doc.get(c) if isinstance(doc.get(c), str) else None for c in self.columns)
+        ) + (json.dumps(doc),)
+
+    def insert(self, doc):
+        cur = self.con.execute(
+            "INSERT INTO nodes (id, cls, tag, src, hash, doc) VALUES (?,?,?,?,?,?)",
+            self._row(doc),
+        )
+        return cur.lastrowid
+
+    def insert_multiple(self, docs):
+        return [self.insert(doc) for doc in docs]
+
+    def all(self):
+        return list(self._select())
+
+    def __iter__(self):
+        return iter(self._select())
+
+    def __len__(self):
+        return self.con.execute("SELECT COUNT(*) FROM nodes").fetchone()[0]
+
+    def search(self, cond):
+        return list(self._select(cond))
+
+    def get(self, cond=None, doc_id=None):
+        for x in self._select(cond, None if doc_id is None else [doc_id], limit=1):
+            return x
+        return None
+
+    def contains(self, cond=None, doc_id=None):
+        return self.get(cond, doc_id) is not None
+
+    def update(self, fields, cond=None, doc_ids=None):
+        ids = []
+        for x in self._select(cond, doc_ids):
+            if callable(fields):
+                fields(x)
+            else:
+                x.update(fields)
+            self.con.execute(
+                "UPDATE nodes SET id=?, cls=?, tag=?, src=?, hash=?, doc=? "
+                "WHERE doc_id=?",
+                self._row(x) + (x.doc_id,),
+            )
+            ids.append(x.doc_id)
+        return ids
+
+    def remove(self, cond=None, doc_ids=None):
+        if cond is None and doc_ids is None:
+            raise RuntimeError("Use truncate() to remove all documents")
+        ids = [x.doc_id for x in self._select(cond, doc_ids)]
+        self.con.executemany("DELETE FROM nodes WHERE doc_id=?", ((i,) for i in ids))
+        return ids
+
+    def truncate(self):
+        self.con.execute("DELETE FROM nodes")
+
+    def flush(self):
+        "Commits pending changes to the database file."
+        self.con.commit()
+
+    def close(self):
+        self.con.commit()
+        self.con.close()
+
+
+# ------------------------------------------------------------------------------
+
+
+class TypesCache(object):
+    """
+    This class implements the persistent cache of unfolded types, stored in a
+    SQLite file shared by all ccrawl processes.
+
+    For every (database identity, tag, identifier) key, the "closures" table
+    holds the list of identifiers of all types on which this type depends, and
+    the "docs" table holds the documents of each identifier. All entries of a
+    database are tied to its stamp and are dropped as soon as the stamp of the
+    database changes (see Proxy.cachekey.)
+    Changes are committed when the cache is closed (at exit.)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.con = sqlite3.connect(path)
+        self.con.execute(
+            "CREATE TABLE IF NOT EXISTS docs (db TEXT, stamp TEXT, id TEXT, "
+            "docs TEXT, PRIMARY KEY (db, id))"
+        )
+        self.con.execute(
+            "CREATE TABLE IF NOT EXISTS closures (db TEXT, stamp TEXT, tag TEXT, "
+            "id TEXT, ids TEXT, PRIMARY KEY (db, tag, id))"
+        )
+        atexit.register(self.close)
+
+    def __repr__(self):
+        return u"<TypesCache [%s]>" % self.path
+
+    def invalidate(self, db, stamp):
+        """
+        Removes all entries of database db that don't have the given stamp.
+        """
+        for t in ("docs", "closures"):
+            self.con.execute("DELETE FROM %s WHERE db = ? AND stamp != ?" % t, (db, stamp))
+
+    def load(self, key, identifier):
+        """
+        Returns the dict of the lists of documents of all identifiers in the
+        closure of identifier (or None if the closure is not cached.)
+        """
+        db, stamp, tag = key
+        r = self.con.execute(
+            "SELECT ids FROM closures WHERE db = ? AND stamp = ? AND tag = ? AND id = ?",
+            (db, stamp, tag, identifier),
+        ).fetchone()
+        if r is None:
+            return None
+        ids = json.loads(r[0])
+        D = {}
+        for i in range(0, len(ids), 500):
+            chunk = ids[i : i + 500]
+            sql = "SELECT id, docs FROM docs WHERE db = ? AND stamp = ? AND id IN (%s)"
+            sql %= ",".join("?" * len(chunk))
+            for k, docs in self.con.execute(sql, [db, stamp] + chunk):
+                D[k] = json.loads(docs)
+        if len(D) < len(ids):
+            return None
+        return D
+
+    def save(self, key, identifier, D):
+        """
+        Saves the closure of identifier given as the dict of the lists of
+        documents of all its identifiers.
+        """
+        db, stamp, tag = key
+        self.con.executemany(
+            "INSERT OR REPLACE INTO docs VALUES (?,?,?,?)",
+            ((db, stamp, k, json.dumps(docs)) for k, docs in D.items()),
+        )
+        self.con.execute(
+            "INSERT OR REPLACE INTO closures VALUES (?,?,?,?,?)",
+            (db, stamp, tag, identifier, json.dumps(list(D))),
+        )
+
+    def close(self):
+        if self.con is not None:
+            self.con.commit()
+            self.con.close()
+            self.con = None
+
+
+# ------------------------------------------------------------------------------
+
+
 class CouchDB(object):
     def __init__(self, url, auth=None, verify=True):
         self.url = url
@@ -171,7 +1114,8 @@ class MongoDB(object):
     The database used is named "ccrawl", and documents are all stored in
     the "nodes" collection. Collections struct_ptr32 and struct_ptr64 are
     used to precompute structures' offsets assuming respective pointer size
-    of 32 bits and 64 bits.
+    of 32 bits and 64 bits. The "meta" collection holds the generation
+    counter of the nodes collection (see stamp.)
     """
 
     def __init__(self, url, auth=None, verify=True):
@@ -187,7 +1131,10 @@ class MongoDB(object):
     def _where(self, q):
         "Translate a TinyDB.Query into a MongoDB request"
         res = dict()
-        if len(q) > 1:
+        if len(q) == 3 and q[0] == "==" and q[1] == ("id",):
+            # (fast path for the most common query)
+            res["id"] = q[2]
+        elif len(q) > 1:
             op = q[0]
             if op == "exists":
                 res[q[1][0]] = {"$exists": True}
@@ -210,59 +1157,348 @@ class MongoDB(object):
                 res["$or"] = [self._where(x) for x in q[1]]
         return res
 
+    @staticmethod
+    def tri(d):
+        "Returns the sorted list of trigrams of document d (see trigrams.)"
+        from ccrawl.trigrams import doc_trigrams
+
+        return sorted(doc_trigrams(d))
+
     def insert_multiple(self, docs):
         "Calls insert_many on the nodes collection."
         col = self.db.get_collection("nodes")
-        return col.insert_many(docs)
+        res = col.insert_many([dict(d, tri=self.tri(d)) for d in docs])
+        self.touch()
+        return res
+
+    def insert_chunks(self, docs, size=1000, retries=3):
+        """
+        Generator that inserts the list of documents in the nodes collection
+        by chunks of given size, with unordered insert_many calls so that an
+        invalid document doesn't prevent the others of its chunk from being
+        inserted. Chunks that fail for a transient reason (network, server
+        election) are retried up to retries times, and documents that already
+        exist (duplicated _id from a previous attempt) are considered inserted.
+        Inserted entries are copies of the documents with their "tri" field.
+        Yields, for each chunk, the (chunk, failed) tuple where failed is the
+        list of documents of the chunk that could not be inserted.
+        """
+        from pymongo.errors import BulkWriteError, PyMongoError
+
+        col = self.db.get_collection("nodes")
+        for i in range(0, len(docs), size):
+            chunk = docs[i : i + size]
+            todo, failed = [(d, dict(d, tri=self.tri(d))) for d in chunk], []
+            for n in range(retries + 1):
+                if n > 0:
+                    time.sleep(0.5 * n)
+                try:
+                    col.insert_many([r for _, r in todo], ordered=False)
+                except BulkWriteError as e:
+                    for w in e.details.get("writeErrors", []):
+                        if w.get("code") != 11000:
+                            failed.append(todo[w["index"]][0])
+                except PyMongoError:
+                    continue
+                todo = []
+                break
+            self.touch()
+            yield (chunk, failed + [d for d, _ in todo])
+
+    def sync_plan(self, docs):
+        """
+        Compares the given (local) documents with the nodes collection and
+        returns the tuple (new, changed, same) where new is the list of
+        documents that have no remote entry with same id, cls, tag and src,
+        changed is the list of (doc, ids) tuples where ids are the _id of
+        remote entries whose val differs from doc's val, and same is the
+        list of documents whose remote entries are all up-to-date.
+        Remote entries of all tags found in docs are fetched in a single
+        request, and vals are compared by their "hash" digest (which is
+        computed here only for documents that don't have one.)
+        """
+        col = self.db.get_collection("nodes")
+        tags = list(set((d.get("tag") for d in docs)))
+        P = {"id": True, "cls": True, "tag": True, "src": True, "hash": True}
+        R, old = {}, {}
+        for r in col.find({"tag": {"$in": tags}}, projection=P):
+            k = (r["id"], r["cls"], r.get("tag"), r.get("src"))
+            R.setdefault(k, []).append([r["_id"], r.get("hash")])
+            if r.get("hash") is None:
+                old[r["_id"]] = R[k][-1]
+        if old:
+            req = {"_id": {"$in": list(old)}}
+            for r in col.find(req, projection={"val": True}):
+                old[r["_id"]][1] = val_digest(r["val"])
+        new, changed, same = [], [], []
+        for d in docs:
+            k = (d["id"], d["cls"], d.get("tag"), d.get("src"))
+            if k not in R:
+                new.append(d)
+                continue
+            h = d.get("hash") or val_digest(d["val"])
+            ids = [i for (i, rh) in R[k] if rh != h]
+            if ids:
+                changed.append((d, ids))
+            else:
+                same.append(d)
+        return (new, changed, same)
+
+    def sync_apply(self, proxydb, new, changed, size=1000):
+        """
+        Inserts new documents and updates the val and use of changed remote
+        entries (see sync_plan) with unordered bulk writes of given size,
+        then updates the offsets/size of the written structures and the
+        constants of the tags of written macros and enums.
+        Returns the number of written remote entries.
+        """
+        from bson import ObjectId
+        from pymongo import InsertOne, UpdateMany
+
+        col = self.db.get_collection("nodes")
+        ops, S = [], []
+        for d in new:
+            d = dict(d, _id=ObjectId(), tri=self.tri(d))
+            ops.append(InsertOne(d))
+            if d["cls"] == "cStruct":
+                S.append(d["_id"])
+        for d, ids in changed:
+            v = {"val": d["val"], "use": d.get("use", [])}
+            v["hash"] = d.get("hash") or val_digest(d["val"])
+            v["tri"] = self.tri(d)
+            ops.append(UpdateMany({"_id": {"$in": ids}}, {"$set": v}))
+            if d["cls"] == "cStruct":
+                S.extend(ids)
+        for i in range(0, len(ops), size):
+            col.bulk_write(ops[i : i + size], ordered=False)
+        if ops:
+            self.touch()
+        if S:
+            self.update_structs(proxydb, {"_id": {"$in": S}})
+        T = set((d.get("tag") for d in new + [d for d, _ in changed]
+                 if d["cls"] in ("cMacro", "cEnum")))
+        if T:
+            self.update_constants(T)
+        return len(new) + sum((len(ids) for _, ids in changed))
+
+    def touch(self):
+        """
+        Increments the generation counter of the nodes collection, which
+        must be called after any write of its documents (see stamp.)
+        """
+        col = self.db.get_collection("meta")
+        col.update_one({"_id": "nodes"}, {"$inc": {"gen": 1}}, upsert=True)
+
+    def stamp(self):
+        """
+        Returns a string that changes whenever documents of the nodes collection
+        are added, removed or updated (its count, its last inserted _id and its
+        generation counter, the latter catching in-place updates.)
+        """
+        col = self.db.get_collection("nodes")
+        last = col.find_one(sort=[("_id", -1)], projection={"_id": True})
+        gen = self.db.get_collection("meta").find_one({"_id": "nodes"})
+        return "%d:%s:%d" % (
+            col.estimated_document_count(),
+            last and last["_id"],
+            gen["gen"] if gen else 0,
+        )
 
     def contains(self, q, **kargs):
         """Calls find on the nodes collection for the given query.
         with limit set to 1 and returns True if the list is non empty.
         """
         col = self.db.get_collection("nodes")
-        return len(list(col.find(self._where(q)).limit(1))) > 0
+        return col.find_one(self._where(q), projection={"_id": True}) is not None
 
     def search(self, q, **kargs):
         "Calls find on the nodes collection for the given query."
         col = self.db.get_collection("nodes")
-        return list(col.find(self._where(q)))
+        return list(col.find(self._where(q), projection={"tri": False}))
+
+    def search_trigrams(self, q, T):
+        """
+        Calls find on the nodes collection for the given query and for entries
+        that have all trigrams of at least one of the sets of T (see
+        trigrams.regex_trigrams) which are selected with the index of the
+        "tri" field. Entries without "tri" (inserted by an older version and
+        not yet updated by cleanup) are only filtered by the query.
+        """
+        col = self.db.get_collection("nodes")
+        req = [{"tri": {"$all": sorted(t)}} for t in T]
+        req = {"$or": req + [{"tri": {"$exists": False}}]}
+        w = self._where(q)
+        if w:
+            req = {"$and": [req, w]}
+        return list(col.find(req, projection={"tri": False}))
 
     def get(self, q, **kargs):
         "Calls find_one on the nodes collection for the given query."
         col = self.db.get_collection("nodes")
-        return col.find_one(self._where(q))
+        return col.find_one(self._where(q), projection={"tri": False})
 
-    def cleanup(self, proxy):
+    def cleanup(self, proxy, jobs=0, report=None):
         """
         Removes duplicates and their precomputed data in structs_ptr32/64
         collections and re-index the database by "id" and "val" fields.
+        (Structures offsets are computed by jobs processes, and failures are
+        written to the report file, see update_structs.)
         """
-        from pymongo import TEXT
+        from pymongo import TEXT, ASCENDING
 
+        col = self.db.get_collection("nodes")
+        click.echo("indexing 'id' and 'hash' fields...", nl=False)
+        col.create_index([("id", ASCENDING), ("hash", ASCENDING)])
+        click.echo("done.")
         click.echo("removing duplicates...", nl=False)
         self.remove_duplicates()
         click.echo("done.")
         click.echo("updating collections of offsets/size for structs...", nl=False)
         self.cleanup_structs()
-        self.update_structs(proxy)
+        F = self.update_structs(proxy, jobs=jobs, report=report)
+        for c in ("structs_ptr32", "structs_ptr64"):
+            self.db[c].create_index("offsets")
         click.echo("done.")
-        col = self.db.get_collection("nodes")
+        if F:
+            click.secho("%d structs failed" % len(F), fg="red")
         click.echo("indexing 'id' and 'val' fields...", nl=False)
         col.create_index([("id", TEXT), ("val", TEXT)])
         click.echo("done.")
+        click.echo("indexing base types of structs' fields...", nl=False)
+        col.create_index("types.base", sparse=True)
+        click.echo("done.")
+        click.echo("indexing trigrams...", nl=False)
+        self.update_trigrams()
+        col.create_index("tri")
+        click.echo("done.")
+        click.echo("indexing constants...", nl=False)
+        self.update_constants()
+        self.touch()
+        click.echo("done.")
+
+    def update_trigrams(self, size=1000):
+        """
+        Sets the "tri" field of entries of the nodes collection that don't
+        have one (inserted by an older version), with bulk writes of given
+        size.
+        """
+        from pymongo import UpdateOne
+
+        col = self.db.get_collection("nodes")
+        P = {"id": True, "val": True, "use": True}
+        ops = []
+        for d in col.find({"tri": {"$exists": False}}, projection=P):
+            ops.append(UpdateOne({"_id": d["_id"]}, {"$set": {"tri": self.tri(d)}}))
+            if len(ops) >= size:
+                col.bulk_write(ops, ordered=False)
+                ops = []
+        if ops:
+            col.bulk_write(ops, ordered=False)
+
+    def update_constants(self, tags=None, size=1000):
+        """
+        Replaces the entries of the constants collection for the given tags
+        (or all tags if None) by the constants of the cMacro and cEnum entries
+        of the nodes collection with these tags (see constants.constants),
+        inserted by chunks of given size, and indexes their value.
+        Returns the number of constants.
+        """
+        from ccrawl.constants import constants, int64
+
+        req = {"cls": {"$in": ["cMacro", "cEnum"]}}
+        if tags is not None:
+            req["tag"] = {"$in": list(tags)}
+        P = {"id": True, "cls": True, "val": True, "tag": True, "src": True}
+        docs = list(self.db.get_collection("nodes").find(req, projection=P))
+        col = self.db.get_collection("constants")
+        col.delete_many({} if tags is None else {"tag": req["tag"]})
+        L = [
+            {
+                "value": int64(v),
+                "raw": str(v),
+                "symbol": n,
+                "cls": d["cls"],
+                "id": d["id"],
+                "tag": d.get("tag"),
+                "src": d.get("src"),
+                "node": d["_id"],
+            }
+            for v, n, d in constants(docs)
+        ]
+        for i in range(0, len(L), size):
+            col.insert_many(L[i : i + size], ordered=False)
+        col.create_index("value")
+        return len(L)
+
+    def find_constants(self, value, symbol="", mask=False, tag=None, q=None):
+        """
+        Returns the list of (value, symbol, cls, id, tag, src) tuples of the
+        constants (with symbol containing the given string and defined by an
+        entry of the nodes collection that matches the query q if not None)
+        equal to value or, if mask is True, non-null constants with bits that
+        are all in value (see Proxy.find_constants.)
+        The constants collection is built first if it is empty (see
+        update_constants.)
+        """
+        import re
+        from ccrawl.constants import int64, mask_ranges
 
-    def cleanup_structs(self, **kargs):
+        w = int64(value)
+        if mask:
+            R = mask_ranges(value)
+            if not R:
+                return []
+            clear = [i for i in range(64) if not (w >> i) & 1]
+            req = {
+                "$or": [{"value": {"$gte": lo, "$lte": hi}} for lo, hi in R],
+                "value": {"$bitsAllClear": clear},
+            }
+        else:
+            req = {"value": w}
+        if symbol:
+            req["symbol"] = {"$regex": re.escape(symbol)}
+        if tag is not None:
+            req["tag"] = tag
+        C = self.db.get_collection("constants")
+        if C.find_one(projection={"_id": True}) is None:
+            self.update_constants()
+        L = []
+        for r in C.find(req):
+            v = int(r["raw"])
+            if (v & ~value == 0 and v > 0) if mask else (v == value):
+                L.append(r)
+        if q is not None and L:
+            req = {"_id": {"$in": list(set((r["node"] for r in L)))}}
+            w = self._where(q)
+            if w:
+                req = {"$and": [req, w]}
+            col = self.db.get_collection("nodes")
+            ok = set((d["_id"] for d in col.find(req, projection={"_id": True})))
+            L = [r for r in L if r["node"] in ok]
+        return [
+            (int(r["raw"]), r["symbol"], r["cls"], r["id"], r["tag"], r["src"]) for r in L
+        ]
+
+    def cleanup_structs(self, size=10000, **kargs):
         """
         Remove all entries from struct_ptr32/64 collections that don't have
-        a matching _id in the nodes collection.
+        a matching _id in the nodes collection (or whose matching node has
+        all passed key=value arguments.)
+        The set difference is computed by batches of size _id.
         """
+        nodes = self.db["nodes"]
         for col in (self.db["structs_ptr32"], self.db["structs_ptr64"]):
-            L = []
-            for s in col.find():
-                o = self.db["nodes"].find_one({"_id": s["_id"]})
-                if (o is None) or all((o[k] == v for (k, v) in kargs.items())):
-                    L.append(s["_id"])
-            col.delete_many({"_id": {"$in": L}})
+            S = [s["_id"] for s in col.find({}, projection={"_id": True})]
+            for i in range(0, len(S), size):
+                B = S[i : i + size]
+                req = {"_id": {"$in": B}}
+                alive = set((o["_id"] for o in nodes.find(req, projection={"_id": True})))
+                L = [x for x in B if x not in alive]
+                if kargs:
+                    req.update(kargs)
+                    L.extend((o["_id"] for o in nodes.find(req, projection={"_id": True})))
+                if L:
+                    col.delete_many({"_id": {"$in": L}})
 
     def cleanup_selected(self, **kargs):
         """
@@ -280,53 +1516,115 @@ class MongoDB(object):
             self.db["structs_ptr64"].delete_many({"_id": {"$in": S}})
         if len(L) > 0:
             self.db["nodes"].delete_many({"_id": {"$in": L}})
+            self.touch()
 
-    def update_structs(self, proxydb, req=None):
+    @staticmethod
+    def struct_offsets(s, layouts):
         """
-        Update the struct_32/64 collections for the given request filtered
-        documents.
+        Returns the tuple (_id, id, layout, error) for the given cStruct
+        document, where layout is the (size32, offsets32, size64, offsets64)
+        tuple or None if it can't be computed, and error is the reason why.
+        (See layout.Layouts, the layout is computed with the types of the
+        document's tag.)
         """
         from ccrawl.core import ccore
-        from ccrawl.ext import amoco
+
+        try:
+            x = ccore.from_db(s)
+            layouts = layouts.of(s.get("tag"))
+            l32 = layouts.layout(x, 4)
+            l64 = layouts.layout(x, 8)
+        except Exception as e:
+            return (s["_id"], s["id"], None, "%s: %s" % (e.__class__.__name__, e))
+        return (s["_id"], s["id"], (l32.size, l32.offsets(), l64.size, l64.offsets()), None)
+
+    def update_structs(self, proxydb, req=None, jobs=1, size=1000, report=None):
+        """
+        Update the struct_32/64 collections for the given request filtered
+        documents, which are upserted by bulk writes of given size.
+
+        Structures are partitioned by size documents that are dispatched to
+        jobs worker processes (0 means all cpus). Each worker has its own
+        connection to the remote database and its own memoized layouts, so
+        that subtypes are resolved only once per worker.
+        Returns the list of (_id, id, error) tuples of structures for which
+        offsets couldn't be computed, which is also written as json lines
+        in the report file if provided.
+        """
+        from pymongo import UpdateOne
+        from ccrawl.layout import Layouts
 
         col = self.db.get_collection("nodes")
         req = req or {}
         req.update({"cls": "cStruct"})
-        s_32 = self.db["structs_ptr32"]
-        s_64 = self.db["structs_ptr64"]
-        for s in col.find(req):
-            click.echo("updating {}".format(s["id"]))
-            i = s["_id"]
-            x = ccore.from_db(s)
-            try:
-                ax = amoco.build(x, proxydb)()
-                off32 = ax.offsets(psize=4)
-                tot32 = ax.size(psize=4)
-                off64 = ax.offsets(psize=8)
-                tot64 = ax.size(psize=8)
-            except Exception:
-                continue
-            s_32.update_one(
-                {"_id": i},
-                {"$set": {"_id": i, "size": tot32, "offsets": off32}},
-                upsert=True,
-            )
-            s_64.update_one(
-                {"_id": i},
-                {"$set": {"_id": i, "size": tot64, "offsets": off64}},
-                upsert=True,
+        cur = col.find(req, projection={"tri": False})
+        if jobs == 1:
+            ex = None
+            E = Layouts(proxydb)
+            R = (self.struct_offsets(s, E) for s in cur)
+        else:
+            import multiprocessing as mp
+            from concurrent.futures import ProcessPoolExecutor
+
+            jobs = jobs or os.cpu_count()
+            ex = ProcessPoolExecutor(
+                jobs,
+                mp_context=mp.get_context("spawn"),
+                initializer=structs_worker_init,
+                initargs=(self.url,),
             )
+            R = structs_dispatch(ex, jobs, cur, size)
+        s_32, s_64, F = [], [], []
+        try:
+            for i, name, layout, err in R:
+                if layout is None:
+                    F.append((i, name, err))
+                    continue
+                click.echo("updating {}".format(name))
+                tot32, off32, tot64, off64 = layout
+                s_32.append(
+                    UpdateOne(
+                        {"_id": i},
+                        {"$set": {"_id": i, "size": tot32, "offsets": off32}},
+                        upsert=True,
+                    )
+                )
+                s_64.append(
+                    UpdateOne(
+                        {"_id": i},
+                        {"$set": {"_id": i, "size": tot64, "offsets": off64}},
+                        upsert=True,
+                    )
+                )
+                if len(s_32) >= size:
+                    self.db["structs_ptr32"].bulk_write(s_32, ordered=False)
+                    self.db["structs_ptr64"].bulk_write(s_64, ordered=False)
+                    s_32, s_64 = [], []
+        finally:
+            if ex is not None:
+                ex.shutdown(cancel_futures=True)
+        if s_32:
+            self.db["structs_ptr32"].bulk_write(s_32, ordered=False)
+            self.db["structs_ptr64"].bulk_write(s_64, ordered=False)
+        if report:
+            with open(report, "w") as f:
+                for i, name, err in F:
+                    f.write(json.dumps({"_id": str(i), "id": name, "error": err}) + "\n")
+        return F
 
     def remove_duplicates(self, **kargs):
         """
         Remove duplicates from the nodes collection.
+        (Documents are considered duplicates if their "id" and "hash" are
+        equal, or their "id" and "val" for documents without "hash".)
         """
         col = self.db.get_collection("nodes")
         L = [{"$match": kargs}] if kargs else []
         L += [
+            {"$sort": {"id": 1, "hash": 1}},
             {
                 "$group": {
-                    "_id": {"id": "$id", "val": "$val"},
+                    "_id": {"id": "$id", "hash": {"$ifNull": ["$hash", "$val"]}},
                     "count": {"$sum": 1},
                     "tbd": {"$push": "$$ROOT._id"},
                 }
@@ -339,7 +1637,7 @@ class MongoDB(object):
             #                                               x["_id"]))
             col.delete_many({"_id": {"$in": x["tbd"][1:]}})
 
-    def find_matching_types(self, Locs, req=None, psize=0):
+    def find_matching_types(self, Locs, req=None, psize=0, k=0):
         """
         For a given dictionnary of "locations" where the key
         is an arbitrary name (a stack variable name, etc) and
@@ -347,42 +1645,122 @@ class MongoDB(object):
         how this local stack variable is accessed within a function,
         try to find any matching structured type in the database and
         updates the dict value by adding these typenames.
+        All locations are sent in a single aggregation (per pointer
+        size, both 4 and 8 if psize is 0) that joins the nodes collection
+        once, and candidates are ranked for each name (see rank_types.)
+        If k>0, the k best scored candidates are returned for each name
+        as (id, score) tuples (see scored_types.)
         """
         if req is None:
             req = {}
-        psize = psize // 8 or psize
-        if psize == 0:
-            self.find_matching_types(Locs, req, psize=4)
-            self.find_matching_types(Locs, req, psize=8)
-            return
-        col = self.db["structs_ptr%2d" % (psize * 8)]
-        for n, S in Locs.items():
+        psize = psize // 8 if psize > 8 else psize
+        P = (psize,) if psize else (4, 8)
+        if k > 0:
+            return self.scored_types(Locs, req, P, k)
+        Q = []
+        for S in Locs.values():
+            S = sorted(set(map(tuple, S)))
+            if S and S not in Q:
+                Q.append(S)
+        C = []
+        for p in P if Q else ():
+            col = self.db["structs_ptr%2d" % (p * 8)]
             res = col.aggregate(
-                [
-                    {"$match": {"offsets": {"$all": S}}},
-                    {
-                        "$lookup": {
-                            "from": "nodes",
-                            "localField": "_id",
-                            "foreignField": "_id",
-                            "as": "node",
-                        }
-                    },
+                [{"$match": {"$or": [{"offsets": {"$all": S}} for S in Q]}}]
+                + self.join_nodes()
+                + [
+                    {"$match": req},
+                    {"$project": {"id": 1, "size": 1, "offsets": 1}},
+                ]
+            )
+            for x in res:
+                l = set(map(tuple, x["offsets"]))
+                C.append((x["id"], x["size"], len(l), l))
+        return rank_types(Locs, C)
+
+    @staticmethod
+    def join_nodes():
+        "Returns the aggregation stages that merge structs with their nodes."
+        return [
+            {
+                "$lookup": {
+                    "from": "nodes",
+                    "localField": "_id",
+                    "foreignField": "_id",
+                    "as": "node",
+                }
+            },
+            {
+                "$replaceRoot": {
+                    "newRoot": {
+                        "$mergeObjects": [
+                            {"$arrayElemAt": ["$node", 0]},
+                            "$$ROOT",
+                        ]
+                    }
+                }
+            },
+            {"$project": {"node": 0}},
+        ]
+
+    def scored_types(self, Locs, req, P, k):
+        """
+        Approximate variant of find_matching_types: for each pointer size of
+        P, structures that have any of the locations are selected (with the
+        index of offsets), and a facet per name keeps the 4*k of them that
+        have most of its locations. The pointer fields of these candidates
+        are then fetched from their nodes to score them (see access_match)
+        and the Locs dict is updated with the k best (id, score) tuples.
+        """
+        N = [n for n, S in Locs.items() if S]
+        U = []
+        for n in N:
+            for a in Locs[n]:
+                if list(a[:2]) not in U:
+                    U.append(list(a[:2]))
+        C = {}
+        for p in P if N else ():
+            col = self.db["structs_ptr%2d" % (p * 8)]
+            L = [{"$match": {"offsets": {"$in": U}}}]
+            if req:
+                L += self.join_nodes() + [{"$match": req}]
+            F = {}
+            for i, n in enumerate(N):
+                S = [list(a[:2]) for a in Locs[n]]
+                F["q%d" % i] = [
                     {
-                        "$replaceRoot": {
-                            "newRoot": {
-                                "$mergeObjects": [
-                                    {"$arrayElemAt": ["$node", 0]},
-                                    "$$ROOT",
-                                ]
-                            }
+                        "$project": {
+                            "size": 1,
+                            "offsets": 1,
+                            "n": {"$size": "$offsets"},
+                            "hit": {"$size": {"$setIntersection": ["$offsets", S]}},
                         }
                     },
-                    {"$project": {"node": 0}},
-                    {"$match": req},
+                    {"$sort": {"hit": -1, "n": 1, "_id": 1}},
+                    {"$limit": 4 * k},
                 ]
+            L.append({"$facet": F})
+            res = next(iter(col.aggregate(L)), {})
+            ids = set((x["_id"] for R in res.values() for x in R))
+            nodes = self.db["nodes"].find(
+                {"_id": {"$in": list(ids)}}, projection={"id": True, "val": True}
             )
-            Locs[n] = (S, [x["id"] for x in res])
+            T = dict(((x["_id"], x) for x in nodes))
+            for i, n in enumerate(N):
+                for x in res.get("q%d" % i, ()):
+                    d = T.get(x["_id"])
+                    if d is None:
+                        continue
+                    O = [tuple(o) for o in x["offsets"]]
+                    V = d.get("val")
+                    if isinstance(V, list) and len(V) == len(O):
+                        fields = [o + ("*" in v[0],) for o, v in zip(O, V)]
+                    else:
+                        fields = [o + (None,) for o in O]
+                    count = len(set((o for o in O if o[1] > 0)))
+                    m, e = access_match(Locs[n], fields)
+                    C.setdefault(n, []).append((d["id"], x["size"], count, m, e))
+        return rank_scores(Locs, C, k)
 
     def find_calls_to(self,ref,D=None):
         """
@@ -398,3 +1776,40 @@ class MongoDB(object):
                  "val.calls": {"$elemMatch": {"$regex": ref}},
              }.update(D)
         )
+
+
+def structs_worker_init(url):
+    """
+    Initializer of MongoDB.update_structs worker processes: opens a Proxy
+    to the remote database only and the layouts of its types.
+    """
+    global structs_layouts
+    from ccrawl.conf import Database
+    from ccrawl.layout import Layouts
+
+    structs_layouts = Layouts(Proxy(Database(local="", url=url, cache="")))
+
+
+def structs_worker(part):
+    return [MongoDB.struct_offsets(s, structs_layouts) for s in part]
+
+
+def structs_dispatch(ex, jobs, cur, size):
+    """
+    Generator that submits the documents of cursor cur by partitions of
+    given size to the ex pool of jobs workers, and yields their results in
+    order (with at most 2*jobs pending partitions.)
+    """
+    Q = deque()
+    P = []
+    for s in cur:
+        P.append(s)
+        if len(P) >= size:
+            Q.append(ex.submit(structs_worker, P))
+            P = []
+            if len(Q) >= 2 * jobs:
+                yield from Q.popleft().result()
+    if P:
+        Q.append(ex.submit(structs_worker, P))
+    while Q:
+        yield from Q.popleft().result()
@@ -76,10 +76,9 @@ else:
             # gather fields as long as they are part of
             # the bitfield...
             bfmt = []
-            for t, n, c in iter(obj):
+            for t, n, c, r in obj.fields_types():
                 if c and c.count("\n") > 0:
                     c = None
-                r = c_type(t)
                 if r.lbfw > 0:
                     bfmt.append((r, n))
                     continue
@@ -115,8 +115,7 @@ def build(obj, db, Types={}, _bstack=[]):
         if not early_exit:
             fmt = []
             anon = []
-            for t, n, c in iter(obj):
-                r = get_c_or_cxx_type(t)
+            for t, n, c, r in obj.fields_types(get_c_or_cxx_type):
                 if "?_" in r.lbase:
                     if not n:
                         continue
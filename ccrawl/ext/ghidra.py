@@ -424,6 +424,19 @@ else:
                 Locs[n] = S
         return Locs
 
+    def find_matching_structs(f, db, req=None, psize=0):
+        """find candidate structures for all pointer variables of function f,
+           with a single query to the database (see Proxy.find_matching_types)
+           for the pointer size of the current program if psize is 0.
+           Returns the dict of variable names with (offsets, ranked typenames).
+        """
+        Locs = find_auto_structs(f)
+        if not Locs:
+            return Locs
+        if psize == 0:
+            psize = currentProgram.getDefaultPointerSize()
+        return db.find_matching_types(Locs, req, psize)
+
     def getSigned(v):
         mask = 0x80 << ((v.getSize() - 1) * 8)
         value = v.getOffset()
@@ -521,6 +534,27 @@ def find_functions_with_type(lref,nbfields=-1,sta=None,sto=None):
             secho("not found.",fg="yellow")
     return F
 
+def find_program_structs(db,req=None,sta=None,sto=None):
+    fm = currentProgram.getFunctionManager()
+    F = {}
+    if sta:
+        I = fm.getFunctionsNoStubs(toAddr(sta),True)
+    else:
+        I = fm.getFunctionsNoStubs(True)
+    for f in I:
+        if sto and not (f.getEntryPoint().getOffset() < sto):
+            break
+        try:
+            L = find_matching_structs(f,db,req)
+        except:
+            continue
+        L = dict(((k,v) for k,v in L.items() if v[1]))
+        if L:
+            F[f.getName()] = L
+            if conf.VERBOSE:
+                secho("%s: %d variables matched."%(f.getName(),len(L)),fg="green")
+    return F
+
 def colorize_gdb_tracefile(tfilename,tpnum,frame=None,offset=0,c=(0x22,0x22,0x44)):
     from amoco.system.gdb_tfile import GDBTrace
     state = b.remote_eval('state')
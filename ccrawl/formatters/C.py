@@ -79,11 +79,9 @@ def cStruct_C(obj, db, recursive):
     # S holds obj title and fields declaration strings
     S = [u"%s {" % name]
     # iterate through all fields:
-    for i in obj:
-        # get type, name, comment:
-        t, n, c = i
-        # decompose C-type t into specific parts:
-        r = c_type(t)
+    for i in obj.fields_types():
+        # get type, name, comment and decomposed C-type t:
+        t, n, c, r = i
         # get "element base" part of type t:
         e = r.lbase
         if not n and not e.startswith("union "):
@@ -105,8 +105,7 @@ def do_graph(obj,V,g):
         # we walk the struct/union fields to
         # set the edge's data from the field's accessor
         def _walk(o):
-            for (t,n,c) in o:
-                ct = c_type(t)
+            for (t,n,c,ct) in o.fields_types():
                 elt = ct.lbase
                 # we ignore raw C types (int, float, ...)
                 if elt in o.subtypes:
@@ -225,7 +224,6 @@ def parse_accessor(s):
     return (p,s,a)
 
 
-from ccrawl.ext import amoco
 def get_cycle_offsets(node,db,P,psize):
     """
     For a given cycle P, associated to a root node, return
@@ -240,9 +238,9 @@ def get_cycle_offsets(node,db,P,psize):
             j = col.find_one({"_id": _id})
             if j and i is not None:
                 return j["offsets"][i]
-        # otherwise we need to build the struct:
-        ax = amoco.build(obj,db)()
-        return ax.offsets(psize)[i]
+        # otherwise we need to compute the struct layout:
+        from ccrawl.layout import Layouts
+        return Layouts(db).layout(obj,psize).offsets()[i]
     r = []
     cur = node
     for el in P:
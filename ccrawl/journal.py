@@ -0,0 +1,259 @@
+import os
+import json
+import hashlib
+
+"""
+This module implements the files that ccrawl keeps next to its local database
+to remember the state of previous collect runs. The Manifest records, for every
+parsed source file, the content digest of the file and of all files it depends
+on as well as the clang arguments used, allowing the collect command to only
+re-parse what has changed since the last run. The Checkpoint journals the files
+already collected by a running collect command, allowing to resume it.
+"""
+
+
+def file_digest(filename):
+    """
+    Returns the sha256 hex digest of the content of filename
+    (or None if the file can't be read.)
+    """
+    h = hashlib.sha256()
+    try:
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 16), b""):
+                h.update(chunk)
+    except OSError:
+        return None
+    return h.hexdigest()
+
+
+def args_digest(args):
+    """
+    Returns the sha256 hex digest of a list of clang arguments.
+    """
+    return hashlib.sha256("\0".join(args).encode("utf-8")).hexdigest()
+
+
+class Manifest(object):
+    """
+    Persistent manifest of collected files, stored as a json file.
+
+    The manifest holds a "files" dict that maps every known source path to
+    its [mtime, size, sha256] triplet, and a "tags" dict that maps each tag
+    to its "roots" dict. A root is a file that has been parsed by the
+    collect command, and its entry holds the digest of the clang arguments
+    used to parse it and the list of all source paths it depends on
+    (itself, its included files and the files found in collected documents.)
+
+    Attributes:
+        path (str): the manifest file path
+        last (str): the tag used by the last incremental collect
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.data = {"last": None, "files": {}, "tags": {}}
+        self.tag = None
+        self.roots = {}
+        self._digests = {}
+        try:
+            with open(path, "r") as f:
+                self.data.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+
+    @property
+    def last(self):
+        return self.data["last"]
+
+    def set_tag(self, tag):
+        """
+        Selects the roots associated to the given tag.
+        """
+        self.tag = tag
+        self.roots = self.data["tags"].setdefault(tag, {})
+        self.data["last"] = tag
+
+    def digest(self, filename):
+        """
+        Returns the current sha256 digest of filename, using the stored
+        (mtime, size) to avoid hashing unmodified files. The digest is
+        computed at most once per manifest instance.
+        """
+        if filename in self._digests:
+            return self._digests[filename]
+        try:
+            st = os.stat(filename)
+        except OSError:
+            h = None
+        else:
+            old = self.data["files"].get(filename)
+            if old and old[0] == st.st_mtime_ns and old[1] == st.st_size:
+                h = old[2]
+            else:
+                h = file_digest(filename)
+                if h is not None:
+                    self.data["files"][filename] = [st.st_mtime_ns, st.st_size, h]
+        if h is None:
+            self.data["files"].pop(filename, None)
+        self._digests[filename] = h
+        return h
+
+    def is_dirty(self, filename, args):
+        """
+        Returns True if the given root file needs to be parsed again, either
+        because it is unknown, its clang args have changed, or any of its
+        dependencies has been modified.
+        """
+        r = self.roots.get(filename)
+        if r is None or r["args"] != args_digest(args):
+            return True
+        for f, h in r["deps"].items():
+            if self.digest(f) != h:
+                return True
+        return False
+
+    def select(self, FILES, args):
+        """
+        Splits the FILES dict of root files (as returned by preprocess) and
+        returns the tuple (todo, drop, keep) where todo is the dict of FILES
+        that need to be parsed again, drop is the set of source paths whose
+        documents are outdated and keep is the set of source paths whose
+        documents are still valid.
+        """
+        todo = {}
+        keep = set()
+        old = set()
+        for filename, directives in FILES.items():
+            if self.is_dirty(filename, args + directives):
+                todo[filename] = directives
+                if filename in self.roots:
+                    old.update(self.roots[filename]["deps"])
+            else:
+                keep.update(self.roots[filename]["deps"])
+        # roots that are not collected anymore (removed or now included by
+        # another file) are outdated as well:
+        for filename in list(self.roots):
+            if filename not in FILES:
+                old.update(self.roots.pop(filename)["deps"])
+        return (todo, old - keep, keep)
+
+    def update(self, filename, args, deps):
+        """
+        Records the given root file as parsed with args, depending on all
+        files in deps.
+        """
+        D = {}
+        for f in set(deps) | {filename}:
+            h = self.digest(f)
+            if h is not None:
+                D[f] = h
+        self.roots[filename] = {"args": args_digest(args), "deps": D}
+
+    def save(self):
+        """
+        Writes the manifest (atomically) to its json file.
+        """
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.data, f)
+        os.replace(tmp, self.path)
+
+
+class Checkpoint(object):
+    """
+    Journal of the files already collected by a running collect command,
+    stored as a json-lines file. The first line holds the tag and the digest
+    of the clang arguments of the run, and each following line holds the
+    path and the number of documents of a collected file. Lines are only
+    written once all documents of their files are saved in the database,
+    so that an interrupted collect can be resumed from the journal.
+
+    Attributes:
+        path (str): the checkpoint file path
+        tag (str): the tag of the journaled collect
+        args (str): the digest of its clang arguments
+        files (dict): the number of documents of each collected file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.tag = None
+        self.args = None
+        self.files = {}
+        self.pending = []
+        self.fd = None
+        self.size = 0
+
+    def load(self):
+        """
+        Reads the journal file and returns True if it holds a valid header.
+        (A truncated last line, left by a crash, is ignored.)
+        """
+        try:
+            with open(self.path, "rb") as f:
+                for line in f:
+                    try:
+                        d = json.loads(line)
+                    except ValueError:
+                        break
+                    if not line.endswith(b"\n"):
+                        break
+                    if self.tag is None:
+                        self.tag = d["tag"]
+                        self.args = d["args"]
+                    else:
+                        self.files[d["file"]] = d["n"]
+                    self.size += len(line)
+        except (OSError, KeyError, TypeError):
+            return False
+        return self.tag is not None
+
+    def start(self, tag, args, resume=False):
+        """
+        Opens the journal for the collect of given tag and clang arguments,
+        either continuing the loaded journal (if resume is True) or
+        starting a new one.
+        """
+        if resume:
+            self.fd = open(self.path, "ab")
+            self.fd.truncate(self.size)
+        else:
+            self.tag = tag
+            self.args = args_digest(args)
+            self.files = {}
+            self.fd = open(self.path, "wb")
+            self.write({"tag": self.tag, "args": self.args})
+
+    def write(self, d):
+        self.fd.write(json.dumps(d).encode("utf-8") + b"\n")
+        self.fd.flush()
+
+    def done(self, filename, n):
+        """
+        Adds the given file (with its number of documents) to the journal
+        once the pending documents are saved (see commit.)
+        """
+        self.pending.append((filename, n))
+
+    def commit(self):
+        """
+        Writes all pending files to the journal.
+        """
+        for filename, n in self.pending:
+            self.files[filename] = n
+            self.write({"file": filename, "n": n})
+        self.pending = []
+
+    def close(self, remove=False):
+        """
+        Closes the journal file, and removes it if remove is True.
+        """
+        if self.fd is not None:
+            self.fd.close()
+            self.fd = None
+        if remove:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
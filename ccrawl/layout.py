@@ -0,0 +1,583 @@
+import re
+import json
+import ctypes
+import sqlite3
+from functools import lru_cache
+from collections import namedtuple
+from ccrawl.core import ccore
+from ccrawl.db import where
+from ccrawl.utils import c_type, cxx_type, pp
+
+"""
+This module implements the computation of the memory layout (size, alignment
+and offsets of fields) of structured types directly from the documents of the
+database, without building amoco or ctypes classes, and the index of these
+layouts that allows to query the local database for structures by total size
+and by (offset, size, type) of their fields.
+
+Layouts follow the System V ABI rules used by gcc/clang for the given pointer
+size: 8 (LP64), 4 (ILP32 with natural alignment of 8-bytes scalars and 64 bits
+long double, as for ARM targets) or 0 for the native pointer size. Bitfields
+are allocated in units of their declared type that they can't straddle, and
+zero-width bitfields only align the next field. Enums are int-sized unless
+their values don't fit in 32 bits. Packing attributes are not taken into
+account since they are not collected.
+"""
+
+# ------------------------------------------------------------------------------
+
+Field = namedtuple("Field", "name offset size count bitpos bitsize")
+Field.__doc__ = """
+Layout of a field: its byte offset and byte size, its number of elements
+(or 0 if it is not an array) and, for bitfields, the position of its first
+bit within the (size bytes) storage unit at offset and its number of bits
+(or 0 if the field is not a bitfield.)
+"""
+
+
+class Layout(object):
+    """
+    Memory layout of a struct or union.
+
+    Attributes:
+        identifier (str): the name of the structured type
+        psize (int): the pointer size used to compute this layout
+        size (int): the total size of the type (including padding)
+        align (int): the alignment of the type
+        fields (list): the Field layouts of its members, in order
+    """
+
+    def __init__(self, identifier, psize, size, align, fields):
+        self.identifier = identifier
+        self.psize = psize
+        self.size = size
+        self.align = align
+        self.fields = fields
+
+    def offsets(self):
+        "Returns the list of (offset, size) of all fields."
+        return [(f.offset, f.size) for f in self.fields]
+
+    def offset_of(self, name):
+        "Returns the offset of the given field name (or None.)"
+        for f in self.fields:
+            if f.name == name:
+                return f.offset
+        return None
+
+    def __repr__(self):
+        return "<Layout %s [size=%d, align=%d]>" % (self.identifier, self.size, self.align)
+
+
+def scalars(psize):
+    """
+    Returns the dict of (size, align) tuples of builtin types for the given
+    pointer size.
+    """
+    L = 8 if psize == 8 else 4
+    return {
+        "_Bool": (1, 1),
+        "bool": (1, 1),
+        "char": (1, 1),
+        "char8_t": (1, 1),
+        "char16_t": (2, 2),
+        "char32_t": (4, 4),
+        "wchar_t": (4, 4),
+        "short": (2, 2),
+        "int": (4, 4),
+        "long": (L, L),
+        "long long": (8, 8),
+        "__int128": (16, 16),
+        "float": (4, 4),
+        "double": (8, 8),
+        "long double": (16, 16) if psize == 8 else (8, 8),
+        "float _Complex": (8, 4),
+        "double _Complex": (16, 8),
+        "_Complex float": (8, 4),
+        "_Complex double": (16, 8),
+        "size_t": (L, L),
+        "ssize_t": (L, L),
+        "void": (None, 1),
+    }
+
+
+# fallbacks for the usual system types in case their headers were not collected:
+stdtypes = {
+    "int8_t": "char",
+    "uint8_t": "char",
+    "int16_t": "short",
+    "uint16_t": "short",
+    "int32_t": "int",
+    "uint32_t": "int",
+    "int64_t": "long long",
+    "uint64_t": "long long",
+    "intptr_t": "long",
+    "uintptr_t": "long",
+    "ptrdiff_t": "long",
+    "off_t": "long",
+}
+
+re_bits = re.compile(r"\s*#\s*(\d+)\s*$")
+re_dim = re.compile(r"\s*\[\s*([^\[\]]*?)\s*\]\s*$")
+re_qual = re.compile(r"\b(const|volatile|signed|unsigned|restrict|__restrict)\b")
+
+
+@lru_cache(maxsize=65536)
+def split_type(t):
+    """
+    Decomposes the type string t of a field into the tuple (base, stack,
+    dims, bits) where base is the base typename (or builtin scalar name),
+    stack is the tuple of ("ptr",), ("fargs",) or ("arr", n) operators applied
+    to the base type, dims is the tuple of outermost array dimensions and bits
+    is the bitfield width (or None if the field is not a bitfield.)
+
+    Trailing array dimensions are handled here since c_type only keeps the
+    first dimension of multi-dimensional arrays.
+    """
+    bits = None
+    m = re_bits.search(t)
+    if m:
+        bits = int(m.group(1))
+        t = t[: m.start()]
+    dims = []
+    if "(" not in t:
+        m = re_dim.search(t)
+        while m:
+            dims.insert(0, m.group(1))
+            t = t[: m.start()]
+            m = re_dim.search(t)
+    t = t.strip()
+    s = " ".join(re_qual.sub(" ", t).split()) or "int"
+    s = re.sub(r"^(short|long|long long) int$", r"\1", s)
+    if s in scalars(8):
+        return (s, (), tuple(dims), bits)
+    if ("&" in t) or ("::" in t):
+        r = cxx_type(t)
+    else:
+        try:
+            r = c_type(t)
+        except pp.ParseException:
+            r = cxx_type(t)
+    stack = []
+    for p in r.pstack:
+        if p.is_ptr:
+            stack.append(("ptr",))
+        elif hasattr(p, "a"):
+            stack.append(("arr", str(p.a)))
+        else:
+            stack.append(("fargs",))
+    return (r.lbase, tuple(stack), tuple(dims), bits)
+
+
+class Layouts(object):
+    """
+    Computes (and memoizes per pointer size) the layouts of structured types
+    and the (size, align) of any type of the given database.
+    Type definitions are fetched from the database (or from the unfold cache
+    of ccore) only when needed: a pointer to an undefined struct doesn't
+    require its definition.
+
+    If tag is not None, only definitions of this tag are used, so that a
+    database with several versions of the same types (with different tags)
+    has one Layouts instance per tag (see the of method.)
+
+    Methods raise KeyError (with the missing typename) if a required type is
+    not found in the database, and TypeError if a type has no size (void,
+    function or recursive types.)
+    """
+
+    def __init__(self, db, tag=None):
+        self.db = db
+        self.tag = tag
+        self.types = {}
+        self.layouts = {}
+        self.objs = {}
+        self._tags = {}
+        self._stack = []
+
+    @staticmethod
+    def psize(psize):
+        return psize or ctypes.sizeof(ctypes.c_void_p)
+
+    def of(self, tag):
+        "Returns the Layouts (on the same database) of the types of given tag."
+        if tag is None or tag == self.tag:
+            return self
+        l = self._tags.get(tag)
+        if l is None:
+            l = self._tags[tag] = Layouts(self.db, tag)
+        return l
+
+    def fetch(self, identifier):
+        "Returns the ccore object of given identifier (or None.)"
+        if self.tag is not None:
+            # (the unfold cache of ccore is shared by all tags:)
+            if identifier not in self.objs:
+                x = None
+                for data in self.db.search(where("id") == identifier):
+                    if data.get("tag") == self.tag:
+                        x = ccore.from_db(data)
+                        break
+                self.objs[identifier] = x
+            return self.objs[identifier]
+        x = ccore._cache_.get(identifier, None)
+        if x is None:
+            data = self.db.get(where("id") == identifier)
+            if data:
+                x = ccore.from_db(data)
+                ccore._cache_[identifier] = x
+        return x
+
+    def dim(self, d):
+        "Returns the integer value of an array dimension (possibly a macro.)"
+        if d == "":
+            return 0
+        try:
+            return int(d, 0)
+        except ValueError:
+            x = self.fetch(d)
+            if x is not None and x._is_macro:
+                return int(x.strip(), 0)
+        raise KeyError(d)
+
+    def typeinfo(self, t, psize=0):
+        """
+        Returns the tuple (size, align, count, bits) for the given type string
+        where count is the number of elements if the type is an array (or 0)
+        and bits is its bitfield width (or None.)
+        """
+        psize = self.psize(psize)
+        base, stack, dims, bits = split_type(str(t))
+        cur = None
+        if not stack or stack[0][0] == "arr":
+            cur = self.sizeof(base, psize)
+        count = 0
+        for p in stack:
+            if p[0] == "ptr":
+                cur, count = (psize, psize), 0
+            elif p[0] == "fargs":
+                cur, count = None, 0
+            elif cur is not None:
+                n = self.dim(p[1])
+                cur, count = (cur[0] * n, cur[1]), (count or 1) * n
+        if cur is None or cur[0] is None:
+            raise TypeError("type '%s' has no size" % t)
+        for d in dims:
+            n = self.dim(d)
+            cur, count = (cur[0] * n, cur[1]), (count or 1) * n
+        return (cur[0], cur[1], count, bits)
+
+    def sizeof(self, identifier, psize=0):
+        """
+        Returns the (size, align) tuple of the given typename.
+        """
+        psize = self.psize(psize)
+        S = scalars(psize)
+        if identifier in S:
+            return S[identifier]
+        k = (identifier, psize)
+        r = self.types.get(k)
+        if r is not None:
+            return r
+        if k in self._stack:
+            raise TypeError("type '%s' is recursive" % identifier)
+        self._stack.append(k)
+        try:
+            x = self.fetch(identifier)
+            if x is None:
+                if identifier in stdtypes:
+                    r = S[stdtypes[identifier]]
+                elif identifier.startswith("enum "):
+                    r = S["int"]
+                else:
+                    raise KeyError(identifier)
+            elif x._is_typedef:
+                r = self.typeinfo(x, psize)[:2]
+            elif x._is_macro:
+                try:
+                    r = self.typeinfo(x.strip(), psize)[:2]
+                except (pp.ParseException, TypeError):
+                    raise KeyError(identifier)
+            elif x._is_enum:
+                V = list(x.values()) or [0]
+                r = S["int"]
+                if min(V) < -(1 << 31) or max(V) >= (1 << 32):
+                    r = S["long long"]
+            elif x._is_struct or x._is_union or x._is_class:
+                l = self.layout(x, psize)
+                r = (l.size, l.align)
+            else:
+                raise TypeError("type '%s' has no size" % identifier)
+        finally:
+            self._stack.pop()
+        self.types[k] = r
+        return r
+
+    def layout(self, x, psize=0):
+        """
+        Returns the Layout of the given cStruct, cUnion or cClass object
+        (C++ classes are laid out according to their as_cStruct conversion.)
+        Fields are in the order of the object's items, so that declarations
+        of nested types (that are not members) have a zero-sized Field.
+        """
+        psize = self.psize(psize)
+        k = (x.identifier, psize)
+        l = self.layouts.get(k)
+        if l is not None:
+            return l
+        if x._is_class:
+            x = x.as_cStruct(self.db)
+        F = []
+        off = 0
+        size = 0
+        align = 1
+        for t, n, c in x:
+            if not n and "?_" not in t and not re_bits.search(t):
+                # declaration of a nested (tagged) type, not a member:
+                F.append(Field(n, -(-off // 8), 0, 0, 0, 0))
+                continue
+            sz, al, count, bits = self.typeinfo(t, psize)
+            if x._is_union:
+                F.append(Field(n, 0, sz, count, 0, bits or 0))
+                size = max(size, sz)
+                align = max(align, al)
+            elif bits is None:
+                off = -(-off // (al * 8)) * al * 8
+                F.append(Field(n, off // 8, sz, count, 0, 0))
+                off += sz * 8
+                align = max(align, al)
+            elif bits == 0:
+                off = -(-off // (al * 8)) * al * 8
+                F.append(Field(n, off // 8, 0, 0, 0, 0))
+            else:
+                if off // (al * 8) != (off + bits - 1) // (al * 8):
+                    off = -(-off // (al * 8)) * al * 8
+                start = (off // (al * 8)) * al
+                F.append(Field(n, start, sz, 0, off - start * 8, bits))
+                off += bits
+                if n:
+                    align = max(align, al)
+        if not x._is_union:
+            size = -(-off // 8)
+        size = -(-size // align) * align
+        l = Layout(x.identifier, psize, size, align, F)
+        self.layouts[k] = l
+        return l
+
+
+# ------------------------------------------------------------------------------
+
+
+class LayoutIndex(object):
+    """
+    This class implements the inverted index of the layouts of structures,
+    stored in a SQLite file next to the local database (see Proxy.layouts.)
+
+    For pointer sizes of 4 and 8 bytes, the "sizes" table maps the total size
+    of every structure to its "sid" (with its number of distinct (offset, size)
+    locations) and the "fields" table maps the offset,
+    size and type string (and pointer flag) of each of its fields to its sid. Structures are
+    selected by intersecting these (indexed) posting lists, and the "structs"
+    table maps sids to their identifier and tag. Structures whose layout can't
+    be computed are recorded with the reason why in the "failures" table.
+
+    Attributes:
+        path (str): the index file path
+        stamp (str): the stamp of the database when the index was built
+    """
+
+    psizes = (4, 8)
+
+    def __init__(self, path):
+        self.path = path
+        self.con = sqlite3.connect(path)
+        for t in (
+            "meta (k TEXT PRIMARY KEY, v TEXT)",
+            "structs (sid INTEGER PRIMARY KEY, id TEXT, tag TEXT)",
+            "sizes (psize INTEGER, size INTEGER, sid INTEGER, count INTEGER)",
+            "fields (psize INTEGER, offset INTEGER, size INTEGER, type TEXT, ptr INTEGER, "
+            "sid INTEGER)",
+            "failures (id TEXT, tag TEXT, error TEXT)",
+        ):
+            self.con.execute("CREATE TABLE IF NOT EXISTS %s" % t)
+        C = [r[1] for r in self.con.execute("PRAGMA table_info(sizes)")]
+        if "count" not in C:
+            # index built by an older version, force its rebuild:
+            self.con.execute("ALTER TABLE sizes ADD COLUMN count INTEGER")
+            self.con.execute("DELETE FROM meta WHERE k = 'stamp'")
+            self.con.commit()
+        self.con.execute("CREATE INDEX IF NOT EXISTS sizes_k ON sizes (psize, size)")
+        self.con.execute(
+            "CREATE INDEX IF NOT EXISTS fields_k ON fields (psize, offset, size)"
+        )
+        r = self.con.execute("SELECT v FROM meta WHERE k = 'stamp'").fetchone()
+        self.stamp = r and json.loads(r[0])
+
+    def __repr__(self):
+        return u"<LayoutIndex [%s]>" % self.path
+
+    def build(self, docs, layouts, stamp):
+        """
+        Replaces the content of the index by the layouts of the given cStruct
+        or cClass documents, computed by layouts (a Layouts instance) for the
+        tag of each document, and records the stamp of the indexed database.
+        """
+        con = self.con
+        for t in ("structs", "sizes", "fields", "failures"):
+            con.execute("DELETE FROM %s" % t)
+        for d in docs:
+            x = ccore.from_db(d)
+            E = layouts.of(d.get("tag"))
+            try:
+                L = [E.layout(x, p) for p in self.psizes]
+            except Exception as e:
+                err = "%s: %s" % (e.__class__.__name__, e)
+                con.execute("INSERT INTO failures VALUES (?,?,?)", (d["id"], d.get("tag"), err))
+                continue
+            sid = con.execute(
+                "INSERT INTO structs (id, tag) VALUES (?,?)", (d["id"], d.get("tag"))
+            ).lastrowid
+            if x._is_class:
+                x = x.as_cStruct(E.db)
+            for p, l in zip(self.psizes, L):
+                n = len(set(((f.offset, f.size) for f in l.fields if f.size > 0)))
+                con.execute("INSERT INTO sizes VALUES (?,?,?,?)", (p, l.size, sid, n))
+                con.executemany(
+                    "INSERT INTO fields VALUES (?,?,?,?,?,?)",
+                    (
+                        (p, f.offset, f.size, t[0], "*" in t[0], sid)
+                        for f, t in zip(l.fields, x)
+                        if f.size > 0
+                    ),
+                )
+        con.execute(
+            "INSERT OR REPLACE INTO meta VALUES ('stamp', ?)", (json.dumps(stamp),)
+        )
+        con.commit()
+        self.stamp = stamp
+
+    def select(self, psize, size=None, fields=(), tag=None):
+        """
+        Returns the list of identifiers of structures (of given tag if not None)
+        with total size (if not None) and that have all fields given as
+        (offset, size, type) tuples where size and type can be None, and
+        type can be "*" to match any pointer type.
+        """
+        Q, params = [], []
+        if size is not None:
+            Q.append("SELECT sid FROM sizes WHERE psize = ? AND size = ?")
+            params += [psize, size]
+        for o, sz, t in fields:
+            q = "SELECT sid FROM fields WHERE psize = ? AND offset = ?"
+            params += [psize, o]
+            if sz is not None:
+                q += " AND size = ?"
+                params.append(sz)
+            if t == "*":
+                q += " AND ptr"
+            elif t is not None:
+                q += " AND type = ?"
+                params.append(t)
+            Q.append(q)
+        if not Q:
+            Q.append("SELECT sid FROM sizes WHERE psize = ?")
+            params.append(psize)
+        sql = "SELECT id FROM structs WHERE sid IN (%s)" % " INTERSECT ".join(Q)
+        if tag is not None:
+            sql += " AND tag = ?"
+            params.append(tag)
+        sql += " ORDER BY sid"
+        return [r[0] for r in self.con.execute(sql, params)]
+
+    def candidates(self, psize, locs, tag=None):
+        """
+        Returns the list of (id, size, count, hits) tuples of structures (of
+        given tag if not None) that have a field at any of the given (offset,
+        size) locations, where count is the number of distinct locations of
+        the structure and hits is the set of given locations that it has.
+        All locations are matched by a single query (see db.rank_types.)
+        """
+        con = self.con
+        con.execute("CREATE TEMP TABLE IF NOT EXISTS locs (offset INTEGER, size INTEGER)")
+        con.execute("DELETE FROM temp.locs")
+        con.executemany("INSERT INTO temp.locs VALUES (?,?)", set(map(tuple, locs)))
+        sql = (
+            "WITH hits AS (SELECT DISTINCT f.sid, f.offset, f.size FROM fields f "
+            "JOIN temp.locs l ON f.offset = l.offset AND f.size = l.size "
+            "WHERE f.psize = ?) "
+            "SELECT h.sid, s.id, z.size, z.count, h.offset, h.size FROM hits h "
+            "JOIN structs s ON s.sid = h.sid "
+            "JOIN sizes z ON z.sid = h.sid AND z.psize = ?"
+        )
+        params = [psize, psize]
+        if tag is not None:
+            sql += " WHERE s.tag = ?"
+            params.append(tag)
+        C = {}
+        for sid, i, size, n, o, sz in con.execute(sql, params):
+            if sid not in C:
+                C[sid] = (i, size, n, set())
+            C[sid][3].add((o, sz))
+        return [C[sid] for sid in sorted(C)]
+
+    def ranked(self, psize, Q, pool, tag=None):
+        """
+        Returns the dict of lists of (id, size, count, matched, exact) tuples
+        of the (at most pool) structures (of given tag if not None) that best
+        match each list of (offset, size[, "*"]) accesses of Q, by index of Q.
+        An access matches a field at its offset with value 1 if the sizes are
+        equal (exact) or 0.5 otherwise, halved if the access is a pointer ("*")
+        and the field is not, and matched is the sum over accesses of the best
+        matching field values (see db.access_match.)
+        All lists of accesses are matched by a single query.
+        """
+        con = self.con
+        con.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS acc (q INTEGER, offset INTEGER, "
+            "size INTEGER, ptr INTEGER)"
+        )
+        con.execute("DELETE FROM temp.acc")
+        con.executemany(
+            "INSERT INTO temp.acc VALUES (?,?,?,?)",
+            set(((i, a[0], a[1], a[2:] == ("*",)) for i, S in enumerate(Q) for a in S)),
+        )
+        sql = (
+            "WITH m AS (SELECT a.q, f.sid, a.offset, a.size, "
+            "MAX((CASE WHEN f.size = a.size THEN 1.0 ELSE 0.5 END) * "
+            "(CASE WHEN a.ptr AND NOT f.ptr THEN 0.5 ELSE 1.0 END)) AS v, "
+            "MAX(f.size = a.size) AS e FROM temp.acc a "
+            "JOIN fields f ON f.psize = ? AND f.offset = a.offset "
+            "JOIN structs s ON s.sid = f.sid%s "
+            "GROUP BY a.q, f.sid, a.offset, a.size), "
+            "g AS (SELECT q, sid, SUM(v) AS matched, SUM(e) AS exact FROM m "
+            "GROUP BY q, sid), "
+            "r AS (SELECT g.*, z.size, z.count, ROW_NUMBER() OVER (PARTITION BY q "
+            "ORDER BY matched DESC, z.count, g.sid) AS rk FROM g "
+            "JOIN sizes z ON z.sid = g.sid AND z.psize = ?) "
+            "SELECT r.q, s.id, r.size, r.count, r.matched, r.exact FROM r "
+            "JOIN structs s ON s.sid = r.sid WHERE rk <= ? ORDER BY r.q, rk"
+        )
+        params = [psize]
+        if tag is not None:
+            sql = sql % " AND s.tag = ?"
+            params.append(tag)
+        else:
+            sql = sql % ""
+        params += [psize, pool]
+        R = {}
+        for i, n, size, count, matched, exact in con.execute(sql, params):
+            R.setdefault(i, []).append((n, size, count, matched, exact))
+        return R
+
+    def failures(self, tag=None):
+        """
+        Returns the list of (identifier, error) of structures that are not
+        indexed because their layout can't be computed.
+        """
+        sql = "SELECT id, error FROM failures"
+        if tag is not None:
+            return self.con.execute(sql + " WHERE tag = ?", (tag,)).fetchall()
+        return self.con.execute(sql).fetchall()
+
+    def close(self):
+        self.con.close()
@@ -8,9 +8,10 @@ from ccrawl.formatters import formats
 from ccrawl.parser import TYPEDEF_DECL, STRUCT_DECL, UNION_DECL, ENUM_DECL
 from ccrawl.parser import CLASS_DECL, FUNCTION_DECL, MACRO_DEF
 from ccrawl.parser import preprocess,parse,parse_string
+from ccrawl.parser import parse_pool
 from ccrawl.core import ccore
 from ccrawl.utils import c_type
-from ccrawl.db import Proxy, Query, where
+from ccrawl.db import Proxy, Query, where, Sink, kpad
 
 """
 
@@ -157,6 +158,23 @@ def cli(ctx, verbose, quiet, db, local, configfile, tag):
     help="output dependency graph of collected files")
 @click.option("-C", "--no-cxx","nocxx", is_flag=True, help="ignore C++ files")
 @click.option("--cxx", is_flag=True, help="parse as C++")
+@click.option(
+    "-j", "--jobs",
+    type=click.INT,
+    default=None,
+    help="number of parallel parsing processes (0 for all cpus)")
+@click.option(
+    "-i", "--incremental",
+    is_flag=True,
+    help="only parse files that have changed since last collect")
+@click.option(
+    "-k", "--checkpoint",
+    is_flag=True,
+    help="journal collected files to allow resuming an interrupted collect")
+@click.option(
+    "-r", "--resume",
+    is_flag=True,
+    help="resume an interrupted collect")
 @click.argument(
     "src",
     nargs=-1,
@@ -164,7 +182,8 @@ def cli(ctx, verbose, quiet, db, local, configfile, tag):
     # help='directory/files with definitions to collect',
 )
 @click.pass_context
-def collect(ctx, allc, strict, recon, xclang, outgraph, nocxx, cxx, src):
+def collect(ctx, allc, strict, recon, xclang, outgraph, nocxx, cxx, jobs,
+            incremental, checkpoint, resume, src):
     """
     Collects types (struct,union,class,...) definitions,
     functions prototypes and/or macro definitions from SRC files/directory.
@@ -179,23 +198,46 @@ def collect(ctx, allc, strict, recon, xclang, outgraph, nocxx, cxx, src):
     In strict mode, the clang options need to conform to the makefile
     that lead to the compilation of all input source (i.e. clang diagnostics
     errors are not bypassed).
+
+    With the --jobs option, files are parsed by a pool of worker processes
+    (each with its own clang index) and collected documents are merged in
+    the same order as in sequential mode. Worker processes are also used
+    to enforce the Collect.timeout and Collect.maxmem limits: files that
+    exceed them (or crash libclang) are reported in a failures file next
+    to the local database and their worker is replaced.
+
+    In incremental mode, a manifest of content digests is kept next to the
+    local database and only files whose content, clang arguments or included
+    files have changed are parsed again. Their previous documents are
+    replaced in the local database. Unless the global tag option is used,
+    the tag of the previous incremental collect is reused.
+
+    With the --checkpoint option (or Collect.checkpoint), the files already
+    saved in the local database are journaled in a checkpoint file next to
+    it (which is removed when the collect completes.) The --resume option
+    allows to continue such an interrupted collect with the same tag,
+    skipping journaled files. (A TinyDB local database is only written when
+    the collect completes, so that checkpoints are only useful with a
+    sqlite:// local database.)
     """
     # take into account options in config:
     c = conf.config
     K = None
     c.Collect.strict |= strict
     c.Collect.allc |= allc
+    c.Collect.checkpoint |= checkpoint or resume
     c.Collect.cxx &= not nocxx
     if cxx:
         c.Collect.cxx = True
+    if jobs is not None:
+        c.Collect.jobs = jobs
+    jobs = c.Collect.jobs or os.cpu_count()
     # set tag value:
     tag = ctx.obj["tag"]
     if ctx.obj["tag"] is None:
         tag = str(time.time())
     else:
         tag = ctx.obj["db"].tag._hash[-1]
-    # temporary database cache:
-    dbo = {}
     # set defaults clang frontend parameters:
     args = [
         "-ferror-limit=0",
@@ -219,55 +261,189 @@ def collect(ctx, allc, strict, recon, xclang, outgraph, nocxx, cxx, src):
             dot.write('\n'.join(L))
     if recon is True:
         return 0
+    db = ctx.obj["db"]
+    # (stamp of the database before it is modified by this collect:)
+    stamp = db.stamp()
+    J = None
+    if c.Collect.checkpoint and db.sidecar(".ckpt") is not None:
+        from ccrawl.journal import Checkpoint, args_digest
+
+        J = Checkpoint(db.sidecar(".ckpt"))
+    if resume:
+        if incremental:
+            click.secho("resume is not supported in incremental mode", fg="red", err=True)
+            return -1
+        if J is None or not J.load():
+            click.secho("no collect to resume", fg="red", err=True)
+            return -1
+        if J.args != args_digest(args) or (ctx.obj["tag"] is not None and J.tag != tag):
+            click.secho("collect to resume has different args or tag", fg="red", err=True)
+            return -1
+        tag = J.tag
+        db.set_tag(tag)
+        FILES = dict(((f, d) for (f, d) in FILES.items() if f not in J.files))
+        if not c.Terminal.quiet:
+            click.echo("resume: %d files already collected" % len(J.files))
+    M = None
+    if incremental:
+        from ccrawl.journal import Manifest
+
+        mpath = db.sidecar(".manifest")
+        if mpath is None:
+            click.secho("incremental mode needs a local database file", fg="red", err=True)
+            return -1
+        M = Manifest(mpath)
+        if ctx.obj["tag"] is None and M.last:
+            tag = M.last
+        M.set_tag(tag)
+        db.set_tag(tag)
+        # dependencies of each root file within the collected files:
+        incs = {}
+        for g in G.C:
+            for r in g.roots():
+                incs[r.data] = [v.data for v in g.sV]
+        FILES, drop, keep = M.select(FILES, args)
+        N = db.remove_sources(drop)
+        if not c.Terminal.quiet:
+            click.echo("incremental: %d files to parse, %d outdated documents removed" % (len(FILES), N))
+    # collected documents are saved by batches:
+    dbo = Sink(db, c.Collect.batch, journal=J)
+    if M is not None or resume:
+        # documents of unchanged/journaled files are already in the database:
+        dbo.skip(db.ldb.search(db.tag))
+    if J is not None:
+        J.start(tag, args, resume)
+    if not resume and db.sidecar(".failures") is not None:
+        if os.path.isfile(db.sidecar(".failures")):
+            os.remove(db.sidecar(".failures"))
     total = len(FILES)
-    already_done = set()
+    already_done = set(J.files if J else ())
     W = c.Terminal.width - 12
     # parse and collect all sources:
     n = 0
-    for filename,directives in FILES.items():
-        t0 = time.time()
-        if not c.Terminal.quiet:
-            n += 1
-            p = (n * 100.0) / total
-            click.echo(("[%3d%%] %s " % (p, filename)).ljust(W), nl=False)
-        if filename in already_done:
-            continue
-        else:
-            already_done.add(filename)
-        l = parse(filename, args+directives, kind=K, tag=tag, config=c.Collect)
-        t1 = time.time()
-        if c.Terminal.timer:
-            click.secho("(%.2f+" % (t1 - t0), nl=False, fg="cyan")
-        if l is None:
-            return -1
-        if len(l) > 0:
-            # remove already processed/included files
-            already_done.union(set([el["src"] for el in l]))
-            # aggregate cFunc instances and remove duplicates in dbo:
-            for x in l:
-                if x["cls"] == "cFunc":
-                    kpad = x["id"] + x["val"]["prototype"]
-                    if (kpad not in dbo) or (x["val"]["locs"] or x["val"]["calls"]):
-                        dbo[kpad] = x
+    failed = 0
+    if jobs > 1 or c.Collect.timeout or c.Collect.maxmem:
+        # parse files in (isolated) worker processes:
+        for filename, l, dt, err in parse_pool(FILES, args, tag, c.Collect, jobs):
+            t1 = time.time()
+            if not c.Terminal.quiet:
+                n += 1
+                p = (n * 100.0) / total
+                click.echo(("[%3d%%] %s " % (p, filename)).ljust(W), nl=False)
+                if err is None:
+                    click.secho(("[%3d]" % len(l)).rjust(12), fg="green")
                 else:
-                    kpad = x["id"] + x["src"]
-                    dbo[kpad] = x
-        t2 = time.time()
-        if c.Terminal.timer:
-            click.secho("%.2f)" % (t2 - t1), fg="cyan")
-    db = ctx.obj["db"]
-
+                    click.secho("[err]".rjust(12), fg="red")
+            if c.Terminal.timer:
+                click.secho("(%.2f+" % dt, nl=False, fg="cyan")
+            if J is not None:
+                J.done(filename, len(l))
+            if err is not None:
+                failed += 1
+                report(db, filename, err)
+            else:
+                dbo.add(l)
+                if M is not None:
+                    record(M, filename, args + FILES[filename], l, incs)
+            t2 = time.time()
+            if c.Terminal.timer:
+                click.secho("%.2f)" % (t2 - t1), fg="cyan")
+    else:
+        for filename,directives in FILES.items():
+            t0 = time.time()
+            if not c.Terminal.quiet:
+                n += 1
+                p = (n * 100.0) / total
+                click.echo(("[%3d%%] %s " % (p, filename)).ljust(W), nl=False)
+            if filename in already_done:
+                continue
+            else:
+                already_done.add(filename)
+            l = parse(filename, args+directives, kind=K, tag=tag, config=c.Collect)
+            t1 = time.time()
+            if c.Terminal.timer:
+                click.secho("(%.2f+" % (t1 - t0), nl=False, fg="cyan")
+            if l is None:
+                return -1
+            if J is not None:
+                J.done(filename, len(l))
+            if len(l) > 0:
+                # remove already processed/included files
+                already_done.union(set([el["src"] for el in l]))
+                # aggregate cFunc instances and remove duplicates in dbo:
+                dbo.add(l)
+            if M is not None:
+                record(M, filename, args + directives, l, incs)
+            t2 = time.time()
+            if c.Terminal.timer:
+                click.secho("%.2f)" % (t2 - t1), fg="cyan")
     if not c.Terminal.quiet:
         click.echo("-" * (c.Terminal.width))
         click.echo("saving database...".ljust(W), nl=False)
-    N = len(dbo)
-    db.insert_multiple(dbo.values())
+    dbo.insert()
+    N = dbo.count
+    if c.Database.deps:
+        # update the dependency index of the collected tag:
+        db.set_tag(tag)
+        db.build_deps()
+    # (written once with the dependency index:)
+    dbo.flush()
+    if db.sidecar(".constants"):
+        # update the index of constant values with the collected tag:
+        db.flush()
+        db.constants(tag, since=stamp)
+    if M is not None:
+        M.save()
+    if J is not None:
+        J.close(remove=True)
     db.close()
     if not c.Terminal.quiet:
         click.secho(("[%4d]" % N).rjust(12), fg="green")
+        if failed:
+            click.secho("%d files failed to parse" % failed, fg="red")
     return 0
 
 
+def aggregate(dbo, l):
+    """
+    Aggregates the list l of parsed documents into the dbo dict,
+    removing duplicates (for cFunc documents, the one with
+    locals/calls is kept if any.)
+    """
+    for x in l:
+        k = kpad(x)
+        if x["cls"] == "cFunc":
+            if (k not in dbo) or (x["val"]["locs"] or x["val"]["calls"]):
+                dbo[k] = x
+        else:
+            dbo[k] = x
+
+
+def record(M, filename, args, l, incs):
+    """
+    Updates the manifest M with the given parsed root filename,
+    which depends on its included files and on all source files
+    of its collected documents.
+    """
+    deps = set(incs.get(filename, []))
+    deps.update(filter(os.path.isfile, set((x["src"] for x in l))))
+    M.update(filename, args, deps)
+
+
+def report(db, filename, err):
+    """
+    Records a failure of collect (the failed filename with the reason of
+    its failure) in the report file next to the local database, or on
+    stderr if the local database is not a file.
+    """
+    path = db.sidecar(".failures")
+    if path is None:
+        click.secho("%s: %s" % (filename, err), fg="red", err=True)
+        return
+    with open(path, "a") as f:
+        f.write("%s: %s\n" % (filename, err))
+
+
 def do_collect(ctx, src):
     ctx.invoke(
         collect,
@@ -277,6 +453,11 @@ def do_collect(ctx, src):
         xclang=None,
         outgraph="",
         nocxx=False,
+        cxx=False,
+        jobs=None,
+        incremental=False,
+        checkpoint=False,
+        resume=False,
         src=src,
     )
 
@@ -348,14 +529,7 @@ def convert(ctx, form, cxx, xclang, inp):
     if l is None and not conf.QUIET:
         click.secho("error while parsing input",gf='red')
         return
-    for x in l:
-         if x["cls"] == "cFunc":
-             kpad = x["id"] + x["val"]["prototype"]
-             if (kpad not in dbo) or (x["val"]["locs"] or x["val"]["calls"]):
-                 dbo[kpad] = x
-         else:
-             kpad = x["id"] + x["src"]
-             dbo[kpad] = x
+    aggregate(dbo, l)
     db = Proxy(conf.Database(local='',url='',localonly=True))
     db.insert_multiple(dbo.values())
     db.close()
@@ -378,6 +552,8 @@ def search(ctx, ignorecase, rex):
     Search for documents in the remote database
     (or the local database if no remote is found) with either name
     or definition matching the provided regular expression.
+    Only documents that have the trigrams of the literal parts of the
+    expression are checked (see Proxy.search_rex.)
     """
     db = ctx.obj["db"]
     flg = re.MULTILINE
@@ -395,7 +571,7 @@ def search(ctx, ignorecase, rex):
         Q |= where("use").matches(rex, flags=flg)
     else:
         Q |= where("val").test(look)
-    L = db.search(db.tag & Q)
+    L = db.search_rex(rex, Q)
     for l in L:
         click.echo("found ", nl=False)
         click.secho("%s " % l["cls"], nl=False, fg="cyan")
@@ -493,54 +669,44 @@ def constant(ctx, mask, symbol, val):
     from the remote database (or the local database if no remote is found) matching
     constraints on value (possibly representing a mask of several symbols) and
     symbol prefix.
+    With the mask option, the value is also decomposed into the constants whose
+    bits are all set in the value (the remaining bits are shown in hex.)
     """
+    from ccrawl.constants import decompose
+
     value = int(val, 0)
     db = ctx.obj["db"]
-    Q = ctx.obj.get("select", Query().noop())
-    Q &= (where("cls") == "cMacro") | (where("cls") == "cEnum")
-    L = db.search(db.tag & Q)
-    R = []
-    with click.progressbar(L) as pL:
-        for l in pL:
-            x = ccore.from_db(l)
-            if x._is_macro:
-                if not (symbol in x.identifier):
-                    continue
-                try:
-                    v = int(x, 0)
-                except Exception:
-                    continue
-                else:
-                    if v == value:
-                        R.append(x.identifier + "\n")
-                    elif mask and (symbol in x.identifier):
-                        if v < value and v & value:
-                            R.append(x.identifier + " | ")
-            else:
-                for k, v in x.items():
-                    if v == value and (symbol in k):
-                        R.append(k + "\n")
-                        break
-                    elif mask and (symbol in k):
-                        if v < value and v & value:
-                            R.append(k + " | ")
+    Q = ctx.obj.get("select", None)
+    R = list(dict.fromkeys((r[1] for r in db.find_constants(value, symbol, q=Q))))
+    if mask:
+        F = db.find_constants(value, symbol, mask=True, q=Q)
+        N, rest = decompose(value, [(r[0], r[1]) for r in F])
+        if rest:
+            N.append(hex(rest))
+        if len(N) > 1:
+            R.append(" | ".join(N))
     if R:
-        s = "".join(R)
-        click.echo(s.strip(" |\n"))
+        click.echo("\n".join(R))
 
 
 @select.command()
 @click.option("-d", "--def", "pdef", is_flag=True, default=False)
 @click.option("-p", "--psize", "pointer", type=click.INT, default=0)
+@click.option("-k", "--approx", type=click.INT, default=0,
+              help="show the k best scored structures")
 @click.argument("conds", nargs=-1, type=click.STRING)
 @click.pass_context
-def struct(ctx, pdef, pointer, conds):
+def struct(ctx, pdef, pointer, approx, conds):
     """Get structured definitions (struct, union or class)
     from the remote database (or the local database if no remote is found) matching
     constraints on total size or specific type name or size at given offset within
-    the structure.
+    the structure. For the local database, structures are selected from the
+    index of their layouts (updated if needed.)
+    With the approx option, the constraints at given offsets are accesses that
+    structures don't need to match all and the k best scored structures are
+    shown with their score (see Proxy.find_matching_types.)
     """
-    from ccrawl.ext import amoco
+    from ccrawl.layout import Layouts
     reqs = {}
     try:
         for p in conds:
@@ -552,7 +718,7 @@ def struct(ctx, pdef, pointer, conds):
                 off = int(off,0)
                 if t[0] == "+":
                     reqs[off] = int(t)
-                elif t[0] == "?":
+                elif t[0] == "?" or t == "*":
                     reqs[off] = t
                 else:
                     reqs[off] = c_type(t)
@@ -561,61 +727,136 @@ def struct(ctx, pdef, pointer, conds):
         return
     db = ctx.obj["db"]
     Q = ctx.obj.get("select", Query().noop())
-    L = db.search(
-        db.tag & Q & ((where("cls") == "cStruct") | (where("cls") == "cClass"))
-    )
     R = []
     fails = []
-    with click.progressbar(L) as pL:
-        for l in pL:
-            x = ccore.from_db(l)
-            name = x.identifier
-            try:
-                if x._is_class:
-                    x = x.as_cStruct(db)
-                ax = amoco.build(x,db)
-                t = ax()
-                F,SZ = zip(*(t.offsets(psize=pointer)))
-                xsize = t.size(psize=pointer)
-            except Exception as e:
-                fails.append("can't build %s (error: %s)" % (x.identifier,str(e)))
-                continue
-            if F:
-                if "*" in reqs and reqs["*"] != xsize:
+    if approx > 0:
+        psize = Layouts.psize(pointer)
+        S = []
+        try:
+            for o, s in reqs.items():
+                if o == "*" or s == "?":
                     continue
-                ok = []
-                for o, s in reqs.items():
-                    if o == "*":
-                        continue
-                    cond = o in F
-                    ok.append(cond)
-                    if not cond:
-                        break
-                    else:
-                        i = F.index(o)
-                    if s == "?":
+                if s == "*":
+                    S.append((o, psize, s))
+                elif isinstance(s, c_type):
+                    sz = Layouts(db, db.tagname).typeinfo(s.show(), psize)[0]
+                    S.append((o, sz))
+                else:
+                    S.append((o, s))
+        except Exception:
+            click.secho("invalid arguments", fg="red", err=True)
+            return
+        Locs = db.find_matching_types({"": S}, psize=psize, k=approx)
+        for i, sc in Locs[""][1]:
+            if not pdef:
+                R.append("%.3f %s" % (sc, i))
+            else:
+                x = ccore.from_db(db.get(where("id") == i))
+                R.append("// score: %.3f\n%s\n" % (sc, x.show(db, False, form="C")))
+        if R:
+            click.echo("\n".join(R))
+        return
+    if db.rdb and not db.c.localonly:
+        L = db.search(
+            db.tag & Q & ((where("cls") == "cStruct") | (where("cls") == "cClass"))
+        )
+        E = Layouts(db, db.tagname)
+        with click.progressbar(L) as pL:
+            for l in pL:
+                x = ccore.from_db(l)
+                name = x.identifier
+                try:
+                    if x._is_class:
+                        x = x.as_cStruct(db)
+                    t = E.layout(x, pointer)
+                    F,SZ = zip(*(t.offsets()))
+                    xsize = t.size
+                except Exception as e:
+                    fails.append("can't build %s (error: %s)" % (x.identifier,str(e)))
+                    continue
+                if F:
+                    if "*" in reqs and reqs["*"] != xsize:
                         continue
-                    if s == "*":
-                        cond = t.fields[i].typename=='P'
-                    elif isinstance(s, c_type):
-                        cond = x[i][0] == s.show()
-                    else:
-                        cond = SZ[i] == s
-                    ok.append(cond)
-                    if not cond:
-                        break
-                if all(ok):
-                    if not pdef:
-                        res = name
-                    else:
-                        res = x.show(db, False, form="C")+"\n"
-                    R.append(res)
+                    ok = []
+                    for o, s in reqs.items():
+                        if o == "*":
+                            continue
+                        cond = o in F
+                        ok.append(cond)
+                        if not cond:
+                            break
+                        else:
+                            i = F.index(o)
+                        if s == "?":
+                            continue
+                        if s == "*":
+                            cond = "*" in x[i][0]
+                        elif isinstance(s, c_type):
+                            cond = x[i][0] == s.show()
+                        else:
+                            cond = SZ[i] == s
+                        ok.append(cond)
+                        if not cond:
+                            break
+                    if all(ok):
+                        if not pdef:
+                            res = name
+                        else:
+                            res = x.show(db, False, form="C")+"\n"
+                        R.append(res)
+    else:
+        # intersect the posting lists of the local index of layouts:
+        I = db.layouts()
+        F = []
+        for o, s in reqs.items():
+            if o == "*":
+                continue
+            if s == "?":
+                F.append((o, None, None))
+            elif s == "*":
+                F.append((o, None, s))
+            elif isinstance(s, c_type):
+                F.append((o, None, s.show()))
+            else:
+                F.append((o, s, None))
+        ids = I.select(Layouts.psize(pointer), reqs.get("*"), F, db.tagname)
+        for i in dict.fromkeys(ids):
+            for l in db.search(Q & (where("id") == i)):
+                if not pdef:
+                    R.append(i)
+                else:
+                    R.append(ccore.from_db(l).show(db, False, form="C")+"\n")
+        fails = ["can't build %s (error: %s)" % f for f in I.failures(db.tagname)]
     if conf.VERBOSE:
         click.secho("\n".join(fails), fg="red", err=True)
     if R:
         click.echo("\n".join(R))
 
 
+@select.command()
+@click.option("-r", "--recursive", is_flag=True, help="include indirect users")
+@click.argument("identifier", nargs=1, type=click.STRING)
+@click.pass_context
+def users(ctx, recursive, identifier):
+    """Get the identifiers of definitions of the local database that depend
+    on the given identifier (directly, or also indirectly if the recursive
+    option is used) from the dependency index (computed in memory for
+    documents that are not indexed, the database is not modified.)
+    """
+    db = ctx.obj["db"]
+    _, U = db.deps_index(db.ldb.search(db.tag))
+    R = []
+    S = list(U.get(identifier, []))
+    while S:
+        x = S.pop(0)
+        if x not in R and x != identifier:
+            R.append(x)
+            if recursive:
+                S.extend(U.get(x, []))
+    if R:
+        click.echo("\n".join(R))
+
+
 # show command:
 # ------------------------------------------------------------------------------
 
@@ -649,6 +890,9 @@ def show(ctx, form, recursive, identifier):
     if db.contains(db.tag & Q):
         for l in db.search(db.tag & Q):
             x = ccore.from_db(l)
+            if isinstance(recursive, set) and db.cache is not None:
+                # fetch all required types at once from the persistent cache:
+                db.remember(x.unfold(db))
             click.echo(x.show(db, recursive, form=form))
     else:
         click.secho("identifier '%s' not found" % identifier, fg="red", err=True)
@@ -680,20 +924,23 @@ def info(ctx, pointer, identifier):
             click.echo("source    : {}".format(l["src"]))
             click.secho("tag       : {}".format(l["tag"]), fg="magenta")
             if x._is_struct or x._is_union or x._is_class:
-                from ccrawl.ext import amoco
+                from ccrawl.layout import Layouts
                 try:
-                    t = amoco.build(x, db)()
-                except (TypeError, KeyError) as e:
-                    what = e.args[0]
+                    t = Layouts(db, db.tagname).layout(x, pointer)
+                except KeyError as e:
                     click.secho(
-                        "can't build %s:\nmissing type: '%s'" % (x.identifier, what),
+                        "can't build %s:\nmissing type: '%s'" % (x.identifier, e.args[0]),
                         fg="red",
                         err=True,
                     )
                     click.echo("", err=True)
                     continue
-                F = t.offsets(psize=pointer)
-                xsize = t.size(psize=pointer)
+                except TypeError as e:
+                    click.secho("can't build %s:\n%s" % (x.identifier, e), fg="red", err=True)
+                    click.echo("", err=True)
+                    continue
+                F = t.offsets()
+                xsize = t.size
                 click.secho("size      : {}".format(xsize), fg="yellow")
                 click.secho(
                     "offsets   : {}".format([(f[0], f[1]) for f in F]), fg="yellow"
@@ -722,44 +969,61 @@ def info(ctx, pointer, identifier):
 
 @cli.command()
 @click.option(
-    "-u", "--update", is_flag=False, help="update local base with all subtypes"
+    "-u", "--update", is_flag=True, help="update local base with all subtypes"
+)
+@click.option(
+    "--chunk", type=click.INT, default=1000, show_default=True,
+    help="number of documents per remote insert",
+)
+@click.option(
+    "--retries", type=click.INT, default=3, show_default=True,
+    help="number of retries of a failed remote insert",
 )
 @click.pass_context
-def store(ctx, update):
+def store(ctx, update, chunk, retries):
     """Update the remote database with definitions from the current local database.
     If the update option flag is set, the dependency graph of local definitions
     is computed before pushing definitions to the remote database.
     """
     db = ctx.obj["db"]
-    Done = []
-    for l in db.ldb.search(db.tag):
-        x = ccore.from_db(l)
-        if not conf.QUIET:
-            click.echo("unfolding '%s'..." % x.identifier, nl=False)
-        try:
-            l["use"] = list(x.unfold(db.ldb).subtypes.keys())
-        except Exception:
-            if not conf.QUIET:
-                click.secho("failed.", fg="red")
-        else:
-            if not conf.QUIET:
-                click.secho("ok.", fg="green")
-            if update is True:
-                db.ldb.update(l)
-        Done.append(l)
+    if not conf.QUIET:
+        click.echo("indexing dependencies...", nl=False)
+    if update is True:
+        db.build_deps()
+        db.flush()
+    Done = db.ldb.search(db.tag)
+    U, R = db.deps_index(Done)
+    for l, u in zip(Done, U):
+        l["use"] = u
+        l["used_by"] = R.get(l["id"], [])
+    if not conf.QUIET:
+        click.secho("done.", fg="green")
     if db.rdb:
+        t0 = time.time()
+        stored, failed = [], 0
+        with click.progressbar(length=len(Done), label="storing") as pb:
+            try:
+                for L, F in db.rdb.insert_chunks(Done, size=chunk, retries=retries):
+                    F = set((id(l) for l in F))
+                    stored.extend((l.doc_id for l in L if id(l) not in F))
+                    failed += len(F)
+                    pb.update(len(L))
+            except Exception as e:
+                click.secho("remote db insert failed (%s)" % e, fg="red", err=True)
+        dt = time.time() - t0
         if not conf.QUIET:
-            click.echo("remote db insert multiple ...", nl=False)
-        try:
-            db.rdb.insert_multiple(Done)
-        except Exception:
-            if not conf.QUIET:
-                click.secho("failed.", fg="red")
-        else:
-            if not conf.QUIET:
-                click.secho("done.", fg="green")
-            if not update:
-                db.ldb.remove(doc_ids=[l.doc_id for l in Done])
+            click.echo(
+                "%d documents stored in %.1fs (%d docs/s)"
+                % (len(stored), dt, len(stored) / max(dt, 1e-3))
+            )
+        if failed:
+            click.secho("%d documents failed" % failed, fg="red", err=True)
+        T = set((l.get("tag") for l in Done if l["cls"] in ("cMacro", "cEnum")))
+        if stored and T:
+            db.rdb.update_constants(T)
+        if not update:
+            db.ldb.remove(doc_ids=stored)
+            db.flush()
 
 
 # sync command:
@@ -769,7 +1033,10 @@ def store(ctx, update):
 @cli.command()
 @click.pass_context
 @click.option("-i", "--interact", is_flag=True, help="prompt before updating")
-@click.option("-n", "--printonly", is_flag=True, help="print only but do not update")
+@click.option(
+    "-n", "--printonly", "--dry-run", is_flag=True,
+    help="print only but do not update",
+)
 def sync(ctx, interact, printonly):
     """use a local database to update the val & use attributes of documents in
     the remote database, matching on the id, cls, src and tag.
@@ -785,42 +1052,43 @@ def sync(ctx, interact, printonly):
         click.secho("not a MongoDB remote database", fg="red")
         return
     db.cleanup_local()
-    for l in db.ldb.search(db.tag):
-        x = ccore.from_db(l)
-        try:
-            l["use"] = list(x.unfold(db.ldb).subtypes.keys())
-        except Exception:
-            l["use"] = []
-        R = db.rdb.db["nodes"].find(
-            {"id": l["id"], "cls": l["cls"], "tag": l["tag"], "src": l["src"]}
+    t0 = time.time()
+    L = db.ldb.search(db.tag)
+    U, _ = db.deps_index(L)
+    for l, u in zip(L, U):
+        l["use"] = u
+    new, changed, same = db.rdb.sync_plan(L)
+    t1 = time.time()
+    if not conf.QUIET:
+        for l in same:
+            click.secho("matching entry %s [%s]" % (l["id"], l["cls"]), fg="green")
+    todo = []
+    for l, ids in changed:
+        if not conf.QUIET:
+            click.echo("remote entry differs for %s [%s]" % (l["id"], l["cls"]))
+        if conf.VERBOSE:
+            click.secho("local : %s" % l["val"], fg="cyan")
+        if (not interact) or click.confirm("Do you want to continue?"):
+            todo.append((l, ids))
+    changed = todo
+    todo = []
+    for l in new:
+        if not conf.QUIET:
+            click.secho("new remote entry %s [%s]" % (l["id"], l["cls"]), fg="blue")
+        if (not interact) or click.confirm("Do you want to continue?"):
+            todo.append(l)
+    new = todo
+    if not conf.QUIET:
+        click.echo(
+            "%d new, %d changed, %d unchanged entries (compared in %.2fs)"
+            % (len(new), len(changed), len(same), t1 - t0)
         )
-        isnew = True
-        for r in R:
-            isnew = False
-            if l["val"] != r["val"]:
-                if not conf.QUIET:
-                    click.echo("remote entry differs for %s [%s]" % (l["id"], l["cls"]))
-                if conf.VERBOSE:
-                    click.secho("local : %s" % l["val"], fg="cyan")
-                    click.secho("remote: %s" % r["val"], fg="yellow")
-                doit = True
-                if interact:
-                    doit = click.confirm("Do you want to continue?")
-                if doit and not printonly:
-                    db.rdb.db["nodes"].update_one(
-                        {"_id": r["_id"]}, {"$set": {"val": l["val"], "use": l["use"]}}
-                    )
-                    db.rdb.update_structs(db, {"_id": r["_id"]})
-            elif not conf.QUIET:
-                click.secho("matching entry %s [%s]" % (l["id"], l["cls"]), fg="green")
-        if isnew:
-            if not conf.QUIET:
-                click.secho("new remote entry %s [%s]" % (l["id"], l["cls"]), fg="blue")
-            doit = True
-            if interact:
-                doit = click.confirm("Do you want to continue?")
-            if doit and not printonly:
-                db.rdb.db["nodes"].insert_one(l)
+    if printonly:
+        return
+    t2 = time.time()
+    n = db.rdb.sync_apply(db, new, changed)
+    if not conf.QUIET:
+        click.echo("%d remote entries written in %.2fs" % (n, time.time() - t2))
 
 
 # fetch command:
@@ -917,22 +1185,23 @@ def stats(ctx,structs):
     l, s = max(((len(s["val"]), s["id"]) for s in S))
     click.echo("  max fields: %d (in '%s')" % (l, s))
     if structs:
-        from ccrawl.ext.amoco import build
+        from ccrawl.layout import Layouts
+        E = Layouts(db, db.tagname)
         maxsz = 0
         maxsz_s = ""
         maxar = 0
+        maxar_s = ""
         for s in S:
             x = ccore.from_db(s)
             if conf.VERBOSE:
                 click.echo("  building '%s'..."%s["id"])
             try:
-                ax = build(x,db)
-                t = ax()
+                t = E.layout(x, 4)
                 for f in t.fields:
                     if f.count>maxar:
                         maxar = f.count
                         maxar_s = s["id"]
-                sz = t.size(4)
+                sz = t.size
                 if sz>maxsz:
                     maxsz = sz
                     maxsz_s = s["id"]
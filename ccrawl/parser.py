@@ -2,6 +2,7 @@
 
 import os
 import re
+import time
 from click import echo, secho
 from clang.cindex import CursorKind, TokenKind, TranslationUnit, Index
 import clang.cindex
@@ -9,6 +10,7 @@ import tempfile
 import hashlib
 from itertools import chain
 from functools import wraps
+from multiprocessing.util import Finalize
 from collections.abc import Iterable
 from collections import OrderedDict, defaultdict
 from ccrawl import conf
@@ -596,6 +598,76 @@ def fix_type_conversion(f, t, cxx, errs):
 # ccrawl 'parse' function(s), wrapper of clang index.parse;
 # ------------------------------------------------------------------------------
 
+g_index = None
+g_prelude = {}
+
+
+def get_index():
+    """
+    Returns the clang index of the current process
+    (created on first call and reused for all parsed files.)
+    """
+    global g_index
+    if g_index is None:
+        g_index = Index.create()
+    return g_index
+
+
+def prelude_args(args, config):
+    """
+    Returns the clang arguments to use for parsing a file with given args,
+    including the precompiled header built (once per process for these args)
+    from the config.prelude list of common headers. The -fmodules option is
+    removed since libclang fails to load a precompiled header in modules mode.
+    If no prelude is configured or if the prelude headers have errors,
+    args are returned unchanged.
+    """
+    return prelude(args, config)[0]
+
+
+def prelude(args, config):
+    """
+    Returns the tuple (args, P) where args are the prelude_args and P is the
+    (mutable) list [pch, files, done] associated to the precompiled header,
+    with files the set of headers it contains and done set by the parse
+    function once all declarations of these headers have been collected
+    by the current process. P is None if no precompiled header is used.
+    """
+    if not config.prelude:
+        return (args, None)
+    _args = [a for a in args if a != "-fmodules"]
+    key = tuple(_args)
+    if key not in g_prelude:
+        g_prelude[key] = None
+        L = []
+        for h in config.prelude:
+            if h[0] not in "<\"":
+                h = "<%s>" % h
+            L.append("#include %s\n" % h)
+        fd, pre = tempfile.mkstemp(prefix="ccrawl-", suffix=".h")
+        os.write(fd, "".join(L).encode("utf-8"))
+        os.close(fd)
+        options = TranslationUnit.PARSE_INCOMPLETE
+        try:
+            tu = get_index().parse(pre, _args, None, options)
+            if any((err.severity > 2 for err in tu.diagnostics)):
+                raise ValueError
+            tu.save(pre + ".pch")
+        except Exception:
+            if conf.VERBOSE:
+                secho("prelude headers not precompiled", fg="yellow", err=True)
+        else:
+            files = set((t.include.name for t in tu.get_includes()))
+            g_prelude[key] = [pre + ".pch", files, False]
+            # (finalizers also run at exit of worker processes)
+            Finalize(None, os.remove, args=(pre + ".pch",), exitpriority=0)
+        # (the precompiled header is valid only if its source still exists)
+        Finalize(None, os.remove, args=(pre,), exitpriority=0)
+    P = g_prelude[key]
+    if P is None:
+        return (args, None)
+    return (_args + ["-include-pch", P[0]], P)
+
 
 def parse(filename, args=None, unsaved_files=None, options=None, kind=None, tag=None, config=None):
     """
@@ -634,11 +706,12 @@ def parse(filename, args=None, unsaved_files=None, options=None, kind=None, tag=
         if filename.endswith(".hpp") or filename.endswith(".cpp"):
             _args.extend(cxx_args)
     cxx = "c++" in _args
+    xargs = []
     if not config.strict:
         # in non strict mode, we allow missing includes
         fd, depf = tempfile.mkstemp(prefix="ccrawl-")
         os.close(fd)
-        _args += ["-M", "-MG", "-MF%s" % depf]
+        xargs = ["-M", "-MG", "-MF%s" % depf]
     if conf.DEBUG:
         echo("\nfilename: %s, args: %s" % (filename, _args))
     if unsaved_files is None:
@@ -654,10 +727,11 @@ def parse(filename, args=None, unsaved_files=None, options=None, kind=None, tag=
     if config.allc is False:
         options |= TranslationUnit.PARSE_SKIP_FUNCTION_BODIES
     defs = OrderedDict()
-    index = Index.create()
+    index = get_index()
     # call clang parser:
     try:
-        tu = index.parse(filename, _args, unsaved_files, options)
+        pargs, P = prelude(_args, config)
+        tu = index.parse(filename, pargs + xargs, unsaved_files, options)
         for err in tu.diagnostics:
             if conf.DEBUG:
                 secho(err.format(), fg="yellow")
@@ -670,7 +744,9 @@ def parse(filename, args=None, unsaved_files=None, options=None, kind=None, tag=
                         if conf.DEBUG:
                             secho("reparse as c++ input...",fg="cyan")
                         cxx = True
-                        tu = index.parse(filename, _args + cxx_args, unsaved_files, options)
+                        _args += cxx_args
+                        pargs, P = prelude(_args, config)
+                        tu = index.parse(filename, pargs + xargs, unsaved_files, options)
                         break
                     elif config.skipcxx:
                         secho("[c++]".rjust(12), fg="yellow")
@@ -698,6 +774,12 @@ def parse(filename, args=None, unsaved_files=None, options=None, kind=None, tag=
         os.remove(depf)
     # walk down all AST to get all top-level cursors:
     pool = [(c, []) for c in tu.cursor.get_children()]
+    if P and P[2]:
+        # declarations from the precompiled prelude are identical in all
+        # files parsed with it, so they are collected only once:
+        skip = P[1]
+        pool = [(c, e) for (c, e) in pool
+                if c.location.file is None or c.location.file.name not in skip]
     #name = str(tu.cursor.extent.start.file.name)
     diag = {}
     for r in tu.diagnostics:
@@ -725,8 +807,11 @@ def parse(filename, args=None, unsaved_files=None, options=None, kind=None, tag=
             if kv:
                 ident, cobj = kv
                 if cobj:
-                    for x in cobj.to_db(ident, tag, cur.location.file.name):
+                    src = cur.location.file.name
+                    for x in cobj.to_db(ident, tag, src, config.decompose):
                         defs[x["id"]] = x
+    if P:
+        P[2] = True
     if not conf.QUIET:
         secho(("[%3d]" % len(defs)).rjust(12), fg="green" if not cxx else "cyan")
         for i in diag_get_missing(filename, tu):
@@ -745,6 +830,160 @@ def parse_string(s, args=None, options=0, tag=None, config=None):
     return parse(tmph, args, [(tmph, s)], options, tag=tag, config=config)
 
 
+# ccrawl parallel 'parse' workers:
+# ------------------------------------------------------------------------------
+# libclang translation units can't be pickled, so each worker process owns its
+# own clang index and only sends back the (plain) database documents.
+
+g_config = None
+
+
+def parse_init(config, lib=None):
+    """
+    Initializer of a collect worker process. The config argument is the
+    dict of Collect parameters used to instanciate the worker's own config.
+    Workers are always quiet: progress is reported by the parent process.
+    """
+    global g_config, g_index
+    if lib and not clang.cindex.Config.loaded:
+        clang.cindex.Config.set_library_file(lib)
+    # don't reuse the index (and prelude) of a forked parent process:
+    g_index = None
+    g_prelude.clear()
+    conf.QUIET = True
+    conf.VERBOSE = False
+    conf.DEBUG = False
+    g_config = conf.Collect(**config)
+
+
+def parse_job(filename, args=None, tag=None):
+    """
+    Parses filename in a worker process and returns the tuple
+    (filename, list of documents, elapsed time, error) where error is
+    None or "parse error" if parse failed (returned None.)
+    """
+    t0 = time.time()
+    defs = parse(filename, args, tag=tag, config=g_config)
+    if defs is None:
+        return (filename, [], time.time() - t0, "parse error")
+    return (filename, list(defs), time.time() - t0, None)
+
+
+def parse_worker(conn, config, lib=None, maxmem=0):
+    """
+    Main loop of an isolated collect worker process, which receives
+    (filename, args, tag) jobs from the conn pipe and sends back the
+    result of parse_job (or None if the worker ran out of memory.)
+    The address space of the worker is limited to maxmem MB if not 0.
+    """
+    if maxmem:
+        import resource
+
+        lim = maxmem * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (lim, lim))
+    parse_init(config, lib)
+    while True:
+        job = conn.recv()
+        if job is None:
+            break
+        try:
+            res = parse_job(*job)
+        except MemoryError:
+            res = None
+        conn.send(res)
+    conn.close()
+
+
+def parse_pool(FILES, args, tag, config, jobs):
+    """
+    Generator that parses FILES with a pool of jobs isolated worker processes,
+    each file being parsed within the config.timeout (seconds) and
+    config.maxmem (MB) limits. It yields (filename, documents, elapsed, error)
+    tuples in FILES order, as soon as all previous files have been parsed,
+    where error is None, "parse error" if parse failed on this file, or the
+    reason why the worker of this file failed (and has been replaced.)
+    """
+    import multiprocessing as mp
+    from multiprocessing.connection import wait
+
+    # all Collect parameters are forwarded to workers (the clang library
+    # is loaded by parse_init):
+    cfg = {k: getattr(config, k) for k in config.trait_names(config=True) if k != "lib"}
+    todo = list(FILES.items())
+    # workers: conn -> [process, job index or None, job start time]
+    W = {}
+    res = {}
+    nxt = [0]
+
+    def start():
+        a, b = mp.Pipe()
+        p = mp.Process(target=parse_worker, args=(b, cfg, config.lib, config.maxmem))
+        p.daemon = True
+        p.start()
+        b.close()
+        W[a] = [p, None, 0]
+        return a
+
+    def submit(c):
+        W[c][1] = None
+        if nxt[0] < len(todo):
+            filename, directives = todo[nxt[0]]
+            c.send((filename, args + directives, tag))
+            W[c][1:] = [nxt[0], time.time()]
+            nxt[0] += 1
+
+    def fail(c, err):
+        p, i, t0 = W.pop(c)
+        p.kill()
+        p.join()
+        c.close()
+        if err == "crash":
+            err = "crash (exit code %s)" % p.exitcode
+        res[i] = (todo[i][0], [], time.time() - t0, err)
+        submit(start())
+
+    try:
+        for _ in range(max(1, min(jobs, len(todo)))):
+            submit(start())
+        out = 0
+        while out < len(todo):
+            busy = [c for c in W if W[c][1] is not None]
+            tmo = None
+            if config.timeout:
+                tmo = max(0, min((W[c][2] for c in busy)) + config.timeout - time.time())
+            for c in wait(busy, tmo):
+                try:
+                    r = c.recv()
+                except (EOFError, OSError):
+                    fail(c, "crash")
+                    continue
+                if r is None:
+                    fail(c, "out of memory")
+                    continue
+                res[W[c][1]] = r
+                submit(c)
+            if config.timeout:
+                now = time.time()
+                for c in list(W):
+                    if W[c][1] is not None and now - W[c][2] > config.timeout:
+                        fail(c, "timeout")
+            while out in res:
+                yield res.pop(out)
+                out += 1
+    finally:
+        for c in W:
+            try:
+                c.send(None)
+            except (OSError, ValueError):
+                pass
+        for c, (p, i, t0) in W.items():
+            p.join(1)
+            if p.is_alive():
+                p.kill()
+                p.join()
+            c.close()
+
+
 def selected_errs(r):
     if (
         "unknown type name" in r.spelling
@@ -786,7 +1025,7 @@ def parse_debug(filename, cxx=False):
         "-I./other",
     ]
     unsaved_files = []
-    index = Index.create()
+    index = get_index()
     if conf.DEBUG:
         echo(_args)
     tu = index.parse(filename, _args, unsaved_files, options)
@@ -867,7 +1106,12 @@ def preprocess(files,args=None):
         F.append((f,v))
     # now try to "link" them based on inclusion:
     for (filename,v) in F:
-        missing,incs = parseincludes(filename,args)
+        # scan include directives, or fallback to a full clang parse
+        # if the scan can't decide which files are actually included:
+        res = scanincludes(filename,args)
+        if res is None:
+            res = parseincludes(filename,args)
+        missing,incs = res
         for i in missing:
             bni = os.path.basename(i)
             dni = os.path.dirname(i)
@@ -952,14 +1196,14 @@ def parseincludes(filename,args=None):
     if args is None:
         _args = ["-ferror-limit=0","-fmodules","-fbuiltin-module-map"]
     else:
-        _args = args
+        _args = args[:]
     if conf.config.Collect.cxx:
         cxx_args = ["-x", "c++", "-std=c++11"]
         if filename.endswith(".hpp") or filename.endswith(".cpp"):
             _args.extend(cxx_args)
     cxx = "c++" in _args
     unsaved_files = []
-    index = Index.create()
+    index = get_index()
     if conf.DEBUG:
         echo("parseincludes(%s)..."%filename,nl="")
     tu = index.parse(filename, _args, unsaved_files, options)
@@ -973,3 +1217,267 @@ def parseincludes(filename,args=None):
         secho("incs   :%s"%incs,fg='green')
     return (missing,incs)
 
+
+
+# ccrawl lightweight include scanner:
+# ------------------------------------------------------------------------------
+# parseincludes needs a full clang parse of each file only to get its direct
+# includes. The scanner below rather reads the #include directives of the file
+# and resolves them like clang does, while following the conditional blocks
+# that it can evaluate (include guards, #if 0, #ifdef of known macros...)
+# If an include directive depends on a condition that can't be decided without
+# the full preprocessor, the scanner gives up and parseincludes is used.
+
+g_sysincs = {}
+
+re_comments = re.compile(r"/\*.*?\*/|//[^\n]*", re.DOTALL)
+re_directive = re.compile(r"^[ \t]*#[ \t]*(\w+)[ \t]*(.*)$", re.MULTILINE)
+re_condtoks = re.compile(r"&&|\|\||[!()]|\w+")
+re_integer = re.compile(r"^(\d+)[uUlL]*$")
+
+
+def scan_args(args):
+    """
+    Returns the include search paths and the macro definitions of a list of
+    clang arguments, as a tuple (quote dirs, angle dirs, macros, forced) where
+    macros maps names to True if defined or False if undefined, and forced
+    is True if some files are included by the -include option.
+    """
+    opts = {"-iquote": [], "-I": [], "-isystem": [], "-idirafter": [],
+            "-D": [], "-U": [], "-include": []}
+    args = iter(args or [])
+    for a in args:
+        for o in opts:
+            if a.startswith(o):
+                v = a[len(o):] or next(args, "")
+                opts[o].append(v)
+                break
+    angle = opts["-I"] + opts["-isystem"] + opts["-idirafter"]
+    D = {}
+    for o in opts["-D"]:
+        D[o.split("=")[0]] = True
+    for o in opts["-U"]:
+        D[o] = False
+    return (opts["-iquote"] + angle, angle, D, len(opts["-include"]) > 0)
+
+
+def scan_cond(expr, D, dflt):
+    """
+    Evaluates (when possible) the #if expression with macros defined or
+    undefined according to dict D, other macros being defined or not
+    according to dflt (or unknown if dflt is None.) Only integers, the
+    defined operator and the !, &&, || operators are supported.
+    Returns True or False, or None if the expression can't be evaluated.
+    """
+    toks = re_condtoks.findall(expr)
+    if "".join(toks) != re.sub(r"\s", "", expr):
+        return None
+    toks.append("")
+    pos = [0]
+
+    def tok():
+        return toks[pos[0]]
+
+    def eat():
+        pos[0] += 1
+        return toks[pos[0] - 1]
+
+    def atom():
+        t = eat()
+        if t == "!":
+            r = atom()
+            return r if r is None else (not r)
+        if t == "(":
+            r = disj()
+            if eat() != ")":
+                raise ValueError
+            return r
+        if t == "defined":
+            p = tok() == "("
+            if p:
+                eat()
+            x = eat()
+            if p and eat() != ")":
+                raise ValueError
+            if not re.match(r"^[A-Za-z_]\w*$", x):
+                raise ValueError
+            if x in D:
+                return D[x]
+            if x.startswith("__") or (x[0] == "_" and x[1:2].isupper()):
+                # reserved names are likely predefined by the compiler:
+                return None
+            if x in ("linux", "unix", "i386"):
+                return None
+            return dflt
+        m = re_integer.match(t)
+        if m:
+            return int(m.group(1)) != 0
+        raise ValueError
+
+    def conj():
+        r = atom()
+        while tok() == "&&":
+            eat()
+            x = atom()
+            r = False if (r is False or x is False) else (None if None in (r, x) else True)
+        return r
+
+    def disj():
+        r = conj()
+        while tok() == "||":
+            eat()
+            x = conj()
+            r = True if (r is True or x is True) else (None if None in (r, x) else False)
+        return r
+
+    try:
+        r = disj()
+    except (ValueError, IndexError):
+        return None
+    if tok() != "":
+        return None
+    return r
+
+
+def sysincludes(names, args):
+    """
+    Returns the dict that maps every name (of a header included with <name>)
+    to the path of the system header found by clang (or None if not found.)
+    Names are resolved by a single parse of a file that includes all
+    unknown names, and are cached for the given args.
+    """
+    key = tuple(args)
+    new = [n for n in names if (key, n) not in g_sysincs]
+    KeepGoing = 0x200
+    options = TranslationUnit.PARSE_INCOMPLETE | KeepGoing
+    while new:
+        fd, tmph = tempfile.mkstemp(prefix="ccrawl-", suffix=".h")
+        os.close(fd)
+        os.remove(tmph)
+        s = "".join(("#include <%s>\n" % n for n in new))
+        try:
+            tu = get_index().parse(tmph, args + ["-ferror-limit=0"], [(tmph, s)], options)
+        except Exception:
+            break
+        for t in tu.get_includes():
+            if t.depth == 1:
+                g_sysincs[(key, new[t.location.line - 1])] = t.include.name
+        for err in tu.diagnostics:
+            if err.location.file and err.location.file.name == tmph:
+                if "file not found" in err.spelling:
+                    g_sysincs[(key, new[err.location.line - 1])] = None
+        # headers already included by a previous one are not reported,
+        # so they need another parse (the first name is always resolved):
+        new = [n for n in new[1:] if (key, n) not in g_sysincs]
+    for n in names:
+        g_sysincs.setdefault((key, n), None)
+    return dict(((n, g_sysincs[(key, n)]) for n in names))
+
+
+def scanincludes(filename, args=None):
+    """
+    Lightweight equivalent of parseincludes: returns the tuple (missing,incs)
+    of the direct includes of filename based only on the scan of its
+    preprocessing directives, or None if the scanner can't decide which
+    files are included.
+    """
+    if args is None:
+        args = ["-ferror-limit=0","-fmodules","-fbuiltin-module-map"]
+    _args = args[:]
+    if conf.config.Collect.cxx:
+        if filename.endswith(".hpp") or filename.endswith(".cpp"):
+            _args.extend(["-x", "c++", "-std=c++11"])
+    cxx = "c++" in _args
+    quote, angle, D, forced = scan_args(_args)
+    D["__cplusplus"] = cxx
+    # macros not in D are undefined until a file is included:
+    dflt = None if forced else False
+    try:
+        with open(filename, "r", errors="replace") as f:
+            src = f.read()
+    except OSError:
+        return None
+    src = re_comments.sub(" ", src.replace("\\\n", ""))
+    # conditional stack: list of [branch state, a branch was taken, parent
+    # state] with states being True, False or None (can't be evaluated):
+    stack = []
+    state = True
+    found = []
+    directives = [(m.group(1), m.group(2).strip()) for m in re_directive.finditer(src)]
+    for k, (d, x) in enumerate(directives):
+        if d in ("if", "ifdef", "ifndef"):
+            if state is False:
+                c = False
+            elif d == "if":
+                c = scan_cond(x, D, dflt)
+            else:
+                c = scan_cond("defined %s" % x, D, dflt)
+                if d == "ifndef" and c is not None:
+                    c = not c
+            if c is None and d == "ifndef" and directives[k + 1 :]:
+                # include guard:
+                nd, nx = directives[k + 1]
+                if nd == "define" and nx.split()[:1] == [x]:
+                    c = True
+            stack.append([c, c, state])
+        elif d in ("elif", "else"):
+            if not stack:
+                return None
+            b = stack[-1]
+            c = True if d == "else" else scan_cond(x, D, dflt)
+            if b[2] is False or b[1] is True or c is False:
+                c = False
+            elif b[1] is None or c is None:
+                c = None
+            b[0] = c
+            b[1] = True if c else (None if (b[1] is None or c is None) else False)
+        elif d == "endif":
+            if not stack:
+                return None
+            stack.pop()
+        elif state is not False and d in ("define", "undef"):
+            if x:
+                x = x.split("(")[0].split()[0]
+                D[x] = None if state is None else (d == "define")
+        elif state is not False and d in ("include", "import", "include_next"):
+            if state is None or d == "include_next":
+                return None
+            if x[:1] == "<" and ">" in x:
+                found.append(x[: x.index(">") + 1])
+            elif x[:1] == '"' and '"' in x[1:]:
+                found.append(x[: x.index('"', 1) + 1])
+            else:
+                # computed include:
+                return None
+            # any macro can be defined by an included file:
+            dflt = None
+        state = True
+        for b in stack:
+            if b[0] is False:
+                state = False
+                break
+            if b[0] is None:
+                state = None
+    # now resolve include names like clang:
+    here = os.path.dirname(filename)
+    paths = []
+    for i in found:
+        n = i[1:-1]
+        dirs = ([here] + quote) if i[0] == '"' else angle
+        p = None
+        for I in dirs:
+            if os.path.isfile(os.path.join(I, n)):
+                p = os.path.join(I, n)
+                break
+        paths.append(p)
+    sysincs = sysincludes([i[1:-1] for i, p in zip(found, paths) if p is None], _args)
+    missing = []
+    incs = []
+    for i, p in zip(found, paths):
+        if p is None:
+            p = sysincs[i[1:-1]]
+        if p is None:
+            missing.append(i[1:-1])
+        else:
+            incs.append((p, i))
+    return (missing, incs)
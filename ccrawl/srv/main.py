@@ -5,6 +5,7 @@ from flask_restful import reqparse, abort, Api, Resource
 from ccrawl import conf
 from ccrawl.parser import ccore, c_type
 from ccrawl.db import where, Query
+from ccrawl.constants import decompose
 
 import re
 
@@ -80,7 +81,7 @@ class Search(Resource):
         Q = where("id").matches(rex, flags=flg)
         Q |= where("val").matches(rex, flags=flg)
         L = []
-        for l in db.search(Q):
+        for l in db.search_rex(rex, Q):
             d = {"id": l["id"], "val": l["val"]}
             if args["verbose"]:
                 for k in keys:
@@ -237,50 +238,30 @@ class Select_Constant(Resource):
         db = g_ctx.obj["db"]
         if args["tag"]:
             db.set_tag(args["tag"])
-        if verbose := args["verbose"]:
-            keys = ("src", "tag")
+        verbose = args["verbose"]
         if args["key"] and args["match"]:
             Q = where(args["key"]).matches(args["match"])
         else:
-            Q = Query().noop()
+            Q = None
         try:
             value = int(args["val"], 0)
         except (ValueError, TypeError):
             abort(400, reason="invalid value")
         mask = args["mask"]
         pfx = args["prefix"] or ""
-        Q &= (where("cls") == "cMacro") | (where("cls") == "cEnum")
         L = []
-        for l in db.search(Q):
-            x = ccore.from_db(l)
-            out = ""
-            if x._is_macro:
-                if pfx not in x.identifier:
-                    continue
-                try:
-                    v = int(x, 0)
-                except Exception:
-                    continue
-                else:
-                    if v == value:
-                        out = x.identifier
-                    elif mask and (pfx in x.identifier):
-                        if v < value and v & value:
-                            out = x.identifier + " | "
-            else:
-                for k, v in x.items():
-                    if v == value and (pfx in k):
-                        out = k
-                        break
-                    elif mask and (pfx in k):
-                        if v < value and v & value:
-                            out = k + " | "
-            if out:
-                d = {"val": out}
-                if verbose:
-                    for k in keys:
-                        d[k] = l[k]
-                L.append(d)
+        for v, sym, cls, i, tag, src in db.find_constants(value, pfx, q=Q):
+            d = {"val": sym}
+            if verbose:
+                d.update(src=src, tag=tag)
+            L.append(d)
+        if mask:
+            F = db.find_constants(value, pfx, mask=True, q=Q)
+            N, rest = decompose(value, [(r[0], r[1]) for r in F])
+            if rest:
+                N.append(hex(rest))
+            if len(N) > 1:
+                L.append({"val": " | ".join(N)})
         return L
 
 
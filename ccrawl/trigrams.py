@@ -0,0 +1,190 @@
+import json
+import sqlite3
+
+try:
+    import re._parser as sre_parse
+    import re._constants as sre_constants
+except ImportError:
+    import sre_parse
+    import sre_constants
+
+"""
+This module implements the trigram index used to search documents by regular
+expression without evaluating the expression on every document: the index maps
+each (lowercase) sequence of 3 characters of the "id" and of the (stringified)
+"val" of a document to its doc_id, and the literal parts that any match of the
+regular expression must contain give the trigrams that candidate documents must
+have. Candidates are then checked with the regular expression itself.
+"""
+
+# ------------------------------------------------------------------------------
+
+# maximum number of alternatives of trigram sets for a regular expression:
+MAX_ALTS = 16
+
+
+def trigrams(s):
+    "Returns the set of (lowercase) trigrams of the string s."
+    s = s.lower()
+    return set((s[i : i + 3] for i in range(len(s) - 2)))
+
+
+def strings(v):
+    "Yields all strings found in the (json) value v."
+    if isinstance(v, str):
+        yield v
+    elif isinstance(v, dict):
+        for x in v.values():
+            yield from strings(x)
+    elif isinstance(v, (list, tuple)):
+        for x in v:
+            yield from strings(x)
+
+
+def doc_trigrams(d):
+    """
+    Returns the set of trigrams of document d: trigrams of its "id", of
+    the string of its "val" (as searched in the local database) and of every
+    string of its "val" and "use" (as searched in the remote database.)
+    """
+    T = trigrams(d.get("id", ""))
+    if "val" in d:
+        T |= trigrams(str(d["val"]))
+        for s in strings(d["val"]):
+            T |= trigrams(s)
+    for s in d.get("use") or ():
+        T |= trigrams(s)
+    return T
+
+
+def literals(p):
+    """
+    Returns the list of alternatives of lists of literal strings, such that
+    any match of the parsed regular expression p contains all strings of (at
+    least) one alternative. Literals are only collected in mandatory parts of
+    the expression, and the list is limited to MAX_ALTS alternatives.
+    """
+    C = sre_constants
+    R = [[]]
+    cur = []
+
+    def product(R, S):
+        if len(R) * len(S) > MAX_ALTS:
+            return R
+        return [r + s for r in R for s in S]
+
+    for op, av in p:
+        if op is C.LITERAL:
+            cur.append(chr(av))
+            continue
+        if cur:
+            R = [r + ["".join(cur)] for r in R]
+            cur = []
+        if op is C.SUBPATTERN:
+            R = product(R, literals(av[-1]))
+        elif op is C.BRANCH:
+            S = []
+            for b in av[1]:
+                S.extend(literals(b))
+            R = product(R, S)
+        elif op in (C.MAX_REPEAT, C.MIN_REPEAT) and av[0] >= 1:
+            R = product(R, literals(av[2]))
+    if cur:
+        R = [r + ["".join(cur)] for r in R]
+    return R
+
+
+def regex_trigrams(rex):
+    """
+    Returns the list of sets of trigrams such that any string that contains
+    a match of the regular expression rex has all trigrams of at least one
+    set, or None if there is no such (non-empty) set.
+    """
+    try:
+        p = sre_parse.parse(rex)
+    except Exception:
+        return None
+    T = []
+    for A in literals(p):
+        t = set()
+        for s in A:
+            t |= trigrams(s)
+        if not t:
+            return None
+        if t not in T:
+            T.append(t)
+    return T or None
+
+
+# ------------------------------------------------------------------------------
+
+
+class TrigramIndex(object):
+    """
+    This class implements the trigram index of the documents of the local
+    database, stored in a SQLite file next to it (see Proxy.trigrams.)
+
+    The "postings" table maps each trigram to the doc_id of the documents
+    that have it (see doc_trigrams) and documents that have all trigrams of
+    a set are selected by intersecting these (indexed) posting lists.
+
+    Attributes:
+        path (str): the index file path
+        stamp (str): the stamp of the database when the index was updated
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.con = sqlite3.connect(path)
+        self.con.execute("CREATE TABLE IF NOT EXISTS meta (k TEXT PRIMARY KEY, v TEXT)")
+        self.con.execute(
+            "CREATE TABLE IF NOT EXISTS postings (tri TEXT, doc_id INTEGER, "
+            "PRIMARY KEY (tri, doc_id)) WITHOUT ROWID"
+        )
+        r = self.con.execute("SELECT v FROM meta WHERE k = 'stamp'").fetchone()
+        self.stamp = r and json.loads(r[0])
+
+    def __repr__(self):
+        return u"<TrigramIndex [%s]>" % self.path
+
+    def build(self, docs, stamp):
+        """
+        Replaces the content of the index by the trigrams of the given
+        documents (that have a doc_id) and records the stamp of the database.
+        """
+        self.con.execute("DELETE FROM postings")
+        self.add(docs)
+        self.set_stamp(stamp)
+
+    def add(self, docs):
+        "Adds the trigrams of the given (doc_id, document) pairs."
+        self.con.executemany(
+            "INSERT OR IGNORE INTO postings VALUES (?,?)",
+            ((t, i) for i, d in docs for t in doc_trigrams(d)),
+        )
+
+    def set_stamp(self, stamp):
+        "Records the stamp of the database that the index is up-to-date with."
+        self.con.execute(
+            "INSERT OR REPLACE INTO meta VALUES ('stamp', ?)", (json.dumps(stamp),)
+        )
+        self.con.commit()
+        self.stamp = stamp
+
+    def candidates(self, T):
+        """
+        Returns the sorted list of doc_ids of documents that have all trigrams
+        of at least one of the sets of T (see regex_trigrams.)
+        """
+        Q, params = [], []
+        for t in T:
+            Q.append(
+                "SELECT * FROM (%s)"
+                % " INTERSECT ".join(["SELECT doc_id FROM postings WHERE tri = ?"] * len(t))
+            )
+            params.extend(sorted(t))
+        sql = " UNION ".join(Q) + " ORDER BY 1"
+        return [r[0] for r in self.con.execute(sql, params)]
+
+    def close(self):
+        self.con.close()
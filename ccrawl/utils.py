@@ -1,4 +1,7 @@
+import re
 import pyparsing as pp
+from collections import OrderedDict
+from functools import lru_cache
 
 
 # ccrawl low-level utilities:
@@ -71,6 +74,319 @@ nested_par = pp.nestedExpr(content=pp.Regex(r"[^()]+"), ignoreExpr=None)
 nested_c = pp.OneOrMore(nested_par)
 
 
+class pp_grammar(object):
+    """
+    Parse functions of the above pyparsing grammar, as used by
+    parse_decl and pstack.
+    """
+
+    @staticmethod
+    def bitfield(s):
+        return list(bitfield.parseString(s))
+
+    @staticmethod
+    def objecttype(s):
+        x, r = (pp.Group(objecttype) + pp.restOfLine).parseString(s)
+        return (list(x), r)
+
+    @staticmethod
+    def nested(s):
+        try:
+            return nested_c.parseString(s).asList()[0]
+        except Exception as e:
+            print("c_type: error while parsing '%s'" % s)
+            raise e
+
+    @staticmethod
+    def pointer(s):
+        p, a = pointer.parseString(s)
+        return (tuple(p) if p else "", a)
+
+    @staticmethod
+    def pointerxx(s):
+        return tuple(pointerxx.parseString(s))
+
+    @staticmethod
+    def arraydecl(s):
+        return arraydecl.parseString(s)[0]
+
+    @staticmethod
+    def cvref(s):
+        return cvref.parseString(s)[0]
+
+
+# fast C type parser:
+# ------------------------------------------------------------------------------
+# notes:
+# type strings are spelled by libclang and are very regular, but pyparsing is
+# slow. The fast_grammar below implements the same parse functions as the
+# pyparsing grammar with a simple tokenizer, including its quirks (keywords
+# vs. 'oneOf' prefixes, whitespaces kept at the end of nested contents, etc.)
+# It raises ParseException wherever the pyparsing grammar would fail, and
+# decompose falls back to pyparsing on any error or unusual input.
+
+kwchars = set(pp.alphanums + "_$")
+re_ws = re.compile(r"[ \t\n\r]*")
+re_symbol = re.compile(r"[?]?[A-Za-z_:<>][A-Za-z0-9_:<>$]*")
+re_intp = re.compile(r"[1-9][0-9]*")
+re_stars = re.compile(r"\*+")
+re_ampers = re.compile(r"&+")
+re_structured = re.compile(r"struct|union|enum|class")
+re_content = re.compile(r"[^()]+")
+
+
+class fast_grammar(object):
+    """
+    Tokenizer-based parse functions equivalent to pp_grammar.
+    """
+
+    @staticmethod
+    def skip(s, i):
+        return re_ws.match(s, i).end()
+
+    @staticmethod
+    def keyword(s, i, kw):
+        "returns the end of keyword kw if found at s[i:] (or -1)"
+        j = i + len(kw)
+        if not s.startswith(kw, i):
+            return -1
+        if (j < len(s) and s[j] in kwchars) or (i > 0 and s[i - 1] in kwchars):
+            return -1
+        return j
+
+    @staticmethod
+    def prefix(s, i):
+        "returns the list of prefix keywords found at s[i:] and their end"
+        g = fast_grammar
+        P = []
+        while True:
+            j = g.skip(s, i)
+            for kw in ("const", "volatile", "unsigned", "signed"):
+                e = g.keyword(s, j, kw)
+                if e > 0:
+                    P.append(kw)
+                    i = e
+                    break
+            else:
+                return (P, i)
+
+    @staticmethod
+    def bitfield(s):
+        g = fast_grammar
+        P, i = g.prefix(s, 0)
+        m = re_symbol.match(s, g.skip(s, i))
+        if m:
+            i = g.skip(s, m.end())
+            if s.startswith("#", i):
+                n = re_intp.match(s, g.skip(s, i + 1))
+                if n:
+                    return P + [m.group(), int(n.group())]
+        raise pp.ParseException(s, i, "not a bitfield")
+
+    @staticmethod
+    def objecttype(s):
+        g = fast_grammar
+        P, i = g.prefix(s, 0)
+        # rawtypes alternative:
+        j = g.skip(s, i)
+        e1, raw = -1, None
+        for t in struct_letters:
+            e = g.keyword(s, j, t)
+            if e > e1:
+                e1, raw = e, t
+        # strucdecl alternative:
+        T = []
+        m = re_structured.match(s, j)
+        if m:
+            T.append(m.group())
+            j = g.skip(s, m.end())
+        m = re_symbol.match(s, j)
+        e2 = m.end() if m else -1
+        # the longest alternative wins (rawtypes first):
+        if e1 >= 0 and e1 >= e2:
+            return (P + [raw], s[e1:])
+        if e2 >= 0:
+            return (P + T + [m.group()], s[e2:])
+        raise pp.ParseException(s, i, "not an object type")
+
+    @staticmethod
+    def nested(s, i=0, top=True):
+        g = fast_grammar
+        i = g.skip(s, i)
+        if not s.startswith("(", i):
+            raise pp.ParseException(s, i, "expected '('")
+        L = []
+        i += 1
+        while True:
+            i = g.skip(s, i)
+            if i >= len(s):
+                raise pp.ParseException(s, i, "expected ')'")
+            if s[i] == "(":
+                x, i = g.nested(s, i, False)
+                L.append(x)
+            elif s[i] == ")":
+                return L if top else (L, i + 1)
+            else:
+                m = re_content.match(s, i)
+                L.append(m.group())
+                i = m.end()
+
+    @staticmethod
+    def array(s, i, intonly=True):
+        "returns the dimension at s[i:] and its end (or (None, i))"
+        g = fast_grammar
+        j = g.skip(s, i)
+        if s.startswith("[", j):
+            j = g.skip(s, j + 1)
+            m = re_intp.match(s, j)
+            if m:
+                a = int(m.group())
+            elif not intonly:
+                m = re_symbol.match(s, j)
+                a = m and m.group()
+            if m:
+                j = g.skip(s, m.end())
+                if s.startswith("]", j):
+                    return (a, j + 1)
+        return (None, i)
+
+    @staticmethod
+    def pointer(s):
+        g = fast_grammar
+        p = ""
+        m = re_stars.match(s, g.skip(s, 0))
+        i = 0
+        if m:
+            i = m.end()
+            e = g.keyword(s, g.skip(s, i), "const")
+            p = (m.group(), "const" if e > 0 else "")
+            if e > 0:
+                i = e
+        a, i = g.array(s, i)
+        return (p, a or 0)
+
+    @staticmethod
+    def pointerxx(s):
+        g = fast_grammar
+        r = ""
+        m = re_ampers.match(s, g.skip(s, 0))
+        i = 0
+        if m:
+            r, i = m.group(), m.end()
+        a, i = g.array(s, i, False)
+        return (r, a or 0)
+
+    @staticmethod
+    def arraydecl(s):
+        a, i = fast_grammar.array(s, 0)
+        if a is None:
+            raise pp.ParseException(s, 0, "not an array")
+        return a
+
+    @staticmethod
+    def cvref(s):
+        g = fast_grammar
+        i = g.skip(s, 0)
+        for kw in ("const", "volatile", "noexcept"):
+            if g.keyword(s, i, kw) > 0:
+                return kw
+        m = re_ampers.match(s, i)
+        if m:
+            return m.group()
+        raise pp.ParseException(s, i, "not a cv/ref qualifier")
+
+
+def decompose(decl, cls):
+    """
+    Parses the given C type string and returns the dict of attributes of
+    the corresponding cls (c_type or cxx_type) object.
+    The fast_grammar is used unless it fails or the string holds chars
+    that pyparsing would not handle in the same way (tabs, newlines.)
+    """
+    if not ("\t" in decl or "\n" in decl or "\r" in decl):
+        try:
+            return parse_decl(decl, cls, fast_grammar)
+        except Exception:
+            pass
+    return parse_decl(decl, cls, pp_grammar)
+
+
+def parse_decl(decl, cls, g=pp_grammar):
+    """
+    Decomposes the given C type string using the parse functions of g.
+    """
+    # get final element type:
+    bf = decl.rfind("#")
+    if bf > 0:
+        try:
+            x = g.bitfield(decl)
+        except Exception:
+            x, r = g.objecttype(decl[:bf])
+            lbfw = 0
+        else:
+            r = ""
+            lbfw = x.pop()
+    else:
+        x, r = g.objecttype(decl)
+        lbfw = 0
+    lbase = []
+    lconst = lunsigned = lvolatile = False
+    for w in x:
+        if w == "const":
+            lconst = True
+        elif w == "unsigned":
+            lunsigned = True
+        elif w == "signed":
+            pass
+        elif w == "volatile":
+            lvolatile = True
+        else:
+            lbase.append(w)
+    lbase = " ".join(lbase)
+    r = r.replace("[]", "*")
+    r = "(%s)" % r
+    nest = g.nested(r)
+    return {
+        "lbfw": lbfw,
+        "lconst": lconst,
+        "lunsigned": lunsigned,
+        "lvolatile": lvolatile,
+        "lbase": lbase,
+        "pstack": tuple(pstack(nest, cls, g)),
+    }
+
+
+# parsed type strings are cached: the same few types strings are decomposed
+# again and again when unfolding, showing or building types. Cached dicts are
+# shared and must not be modified (c_type.__init__ copies them.)
+
+
+@lru_cache(maxsize=65536)
+def c_decompose(decl):
+    return decompose(decl, c_type)
+
+
+@lru_cache(maxsize=65536)
+def cxx_decompose(decl):
+    D = decompose(decl, cxx_type)
+    D["kw"], D["ns"] = namespaces(D["lbase"])
+    return D
+
+
+def namespaces(lbase):
+    """
+    returns the (keyword, namespaces) parts of the given C++ base type.
+    """
+    kw = ns = ""
+    k = lbase.find(" ")
+    if k > 0:
+        kw = lbase[:k]
+    x = lbase.rfind("::")
+    if x > 0:
+        ns = lbase[k + 1 : x + 2]
+    return (kw, ns)
+
+
 class c_type(object):
     """
     The c_type object parses a C type string and decomposes it into
@@ -92,43 +408,49 @@ class c_type(object):
         dim (int): dimension if the type is an array (or 0.)
     """
 
+    _decompose = staticmethod(c_decompose)
+
     def __init__(self, decl):
-        # get final element type:
-        bf = decl.rfind("#")
-        if bf > 0:
-            try:
-                x = bitfield.parseString(decl)
-            except Exception:
-                x, r = (pp.Group(objecttype) + pp.restOfLine).parseString(decl[:bf])
-                self.lbfw = 0
-            else:
-                r = ""
-                self.lbfw = x.pop()
-        else:
-            x, r = (pp.Group(objecttype) + pp.restOfLine).parseString(decl)
-            self.lbfw = 0
-        lbase = []
-        self.lconst = self.lunsigned = self.lvolatile = False
-        for w in x:
-            if w == "const":
-                self.lconst = True
-            elif w == "unsigned":
-                self.lunsigned = True
-            elif w == "signed":
-                pass
-            elif w == "volatile":
-                self.lvolatile = True
-            else:
-                lbase.append(w)
-        self.lbase = " ".join(lbase)
-        r = r.replace("[]", "*")
-        r = "(%s)" % r
-        try:
-            nest = nested_c.parseString(r).asList()[0]
-        except Exception as e:
-            print("c_type: error while parsing '%s'" % r)
-            raise e
-        self.pstack = pstack(nest, self.__class__)
+        self.__dict__.update(self._decompose(str(decl)))
+        # the pstack is the only attribute that is modified in place:
+        self.pstack = list(self.pstack)
+
+    def to_dict(self):
+        """
+        returns the decomposition of this type as a json-serializable
+        dict (see from_dict.)
+        """
+        return {
+            "base": self.lbase,
+            "bfw": self.lbfw,
+            "const": self.lconst,
+            "unsigned": self.lunsigned,
+            "volatile": self.lvolatile,
+            "stack": [p.to_list() for p in self.pstack],
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        """
+        returns the instance of cls decomposed as the given dict,
+        without parsing the type string.
+        """
+        t = cls.__new__(cls)
+        t.lbase = d["base"]
+        t.lbfw = d["bfw"]
+        t.lconst = d["const"]
+        t.lunsigned = d["unsigned"]
+        t.lvolatile = d["volatile"]
+        t.pstack = [stacked(l) for l in d["stack"]]
+        return t
+
+    @classmethod
+    def cache_info(cls):
+        """
+        returns the hits/misses statistics of the cache of
+        parsed type strings for this class.
+        """
+        return cls._decompose.cache_info()
 
     @property
     def is_ptr(self):
@@ -203,17 +525,13 @@ class cxx_type(c_type):
     cxx_type extends c_type with extracting the namespace parts of the fully
     qualified name of the C++ type.
     """
-    def __init__(self, decl):
-        super().__init__(decl)
-        # get namespaces:
-        self.kw = ""
-        self.ns = ""
-        k = self.lbase.find(" ")
-        if k > 0:
-            self.kw = self.lbase[:k]
-        x = self.lbase.rfind("::")
-        if x > 0:
-            self.ns = self.lbase[k + 1 : x + 2]
+    _decompose = staticmethod(cxx_decompose)
+
+    @classmethod
+    def from_dict(cls, d):
+        t = super().from_dict(d)
+        t.kw, t.ns = namespaces(t.lbase)
+        return t
 
     @property
     def is_method(self):
@@ -272,6 +590,9 @@ class ptr(object):
         sfx = "%s " % self.const if self.const else ""
         return "{}{}".format(self.p, sfx)
 
+    def to_list(self):
+        return ["ptr", self.p, self.const] + ([self.cvr] if hasattr(self, "cvr") else [])
+
 
 class arr(object):
     """
@@ -287,6 +608,9 @@ class arr(object):
     def __str__(self):
         return "[%s]" % self.a
 
+    def to_list(self):
+        return ["arr", self.a] + ([self.cvr] if hasattr(self, "cvr") else [])
+
 
 class fargs(object):
     """
@@ -302,24 +626,54 @@ class fargs(object):
 
     @property
     def args(self):
-        f = nested_par.parseString(self.f)
-        A = []
-        for x in f.asList()[0]:
-            if not isinstance(x, list):
-                A.extend(x.split(","))
-            else:
-                r = A.pop()
-                r += flatten(x)
-                A.append(r)
-        return list(filter(None, A))
+        return list(split_args(self.f))
 
     def __str__(self):
         if hasattr(self, "cvr"):
             return "%s %s" % (self.f, self.cvr)
         return self.f
 
+    def to_list(self):
+        return ["fargs", self.f] + ([self.cvr] if hasattr(self, "cvr") else [])
+
+
+def stacked(l):
+    """returns the ptr, arr or fargs object of the given to_list() list."""
+    k = l[0]
+    if k == "ptr":
+        p = ptr(l[1], l[2])
+        l = l[3:]
+    elif k == "arr":
+        p = arr(l[1])
+        l = l[2:]
+    else:
+        p = fargs(l[1])
+        l = l[2:]
+    if l:
+        p.cvr = l[0]
+    return p
+
+
+@lru_cache(maxsize=65536)
+def split_args(f):
+    """returns the tuple of arguments of the (cached) arguments list f
+    of a function prototype."""
+    try:
+        f = fast_grammar.nested(f)
+    except pp.ParseException:
+        f = nested_par.parseString(f).asList()[0]
+    A = []
+    for x in f:
+        if not isinstance(x, list):
+            A.extend(x.split(","))
+        else:
+            r = A.pop()
+            r += flatten(x)
+            A.append(r)
+    return tuple(filter(None, A))
 
-def pstack(plist, cls=c_type):
+
+def pstack(plist, cls=c_type, g=pp_grammar):
     """returns the 'stack' of pointers-to array-N-of pointer-to
     function() returning pointer to function() returning ..."""
     cxx = cls == cxx_type
@@ -330,14 +684,14 @@ def pstack(plist, cls=c_type):
             # we are declaring either a pointer or array,
             # or an array of pointers to previously stacked objs
             p0 = plist[0]
-            p, a = pointer.parseString(p0)
+            p, a = g.pointer(p0)
             if p:
                 S.append(ptr(*p))
             if a:
                 S.append(arr(a))
             if not (p or a):
                 if cxx:
-                    r, a = pointerxx.parseString(p0)
+                    r, a = g.pointerxx(p0)
                     if r:
                         S.append(ptr(r[0], ""))
                     if a:
@@ -355,17 +709,17 @@ def pstack(plist, cls=c_type):
         r = plist.pop()
         if not isinstance(r, list):
             try:
-                r = arraydecl.parseString(r)[0]
+                r = g.arraydecl(r)
                 S.append(arr(r))
             except pp.ParseException:
                 if cxx:
-                    cvr = cvref.parseString(r)[0]
+                    cvr = g.cvref(r)
         else:
             S.append(fargs(flatten(r)))
     if plist:
         if len(plist) == 1 and not cvr:
             plist = plist[0]
-        S.extend(pstack(plist))
+        S.extend(pstack(plist, g=g))
     if cvr:
         if len(S) > 0:
             S[-1].cvr = cvr
@@ -391,3 +745,30 @@ def indent(txt, l=4):
             x = l + x
         L.append(x)
     return "\n".join(L)
+
+
+class LRU(OrderedDict):
+    """
+    Dict holding at most maxsize items, that discards its least recently
+    used items when full.
+    """
+
+    def __init__(self, maxsize=100000):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def __getitem__(self, k):
+        v = super().__getitem__(k)
+        self.move_to_end(k)
+        return v
+
+    def get(self, k, default=None):
+        if k in self:
+            return self[k]
+        return default
+
+    def __setitem__(self, k, v):
+        super().__setitem__(k, v)
+        self.move_to_end(k)
+        while len(self) > self.maxsize:
+            del self[next(iter(self))]
@@ -1,5 +1,6 @@
 import pytest
 import os
+import re
 import tempfile
 
 samples_dir = os.path.join(os.path.dirname(__file__), "samples")
@@ -135,3 +136,220 @@ def dbfile():
     os.close(fd)
     yield fname
     os.remove(fname)
+    for ext in (".layouts", ".trigrams", ".constants"):
+        if os.path.isfile(fname + ext):
+            os.remove(fname + ext)
+
+
+# in-memory fake of the subset of the pymongo API used by db.MongoDB:
+# ------------------------------------------------------------------------------
+
+_missing = object()
+
+
+def _norm(v):
+    "Returns the value v as stored by MongoDB (tuples are arrays.)"
+    if isinstance(v, (list, tuple)):
+        return [_norm(x) for x in v]
+    if isinstance(v, dict):
+        return {k: _norm(x) for k, x in v.items()}
+    return v
+
+
+def _eq(v, x):
+    x = _norm(x)
+    if v is _missing:
+        return x is None
+    return v == x or (isinstance(v, list) and x in v)
+
+
+def _cmp(op):
+    return lambda v, x: v is not _missing and not isinstance(v, list) and op(v, x)
+
+
+_ops = {
+    "$in": lambda v, x: any(_eq(v, e) for e in x),
+    "$nin": lambda v, x: not any(_eq(v, e) for e in x),
+    "$all": lambda v, x: isinstance(v, list) and all(_norm(e) in v for e in x),
+    "$exists": lambda v, x: (v is not _missing) == bool(x),
+    "$ne": lambda v, x: not _eq(v, x),
+    "$gt": _cmp(lambda v, x: v > x),
+    "$gte": _cmp(lambda v, x: v >= x),
+    "$lt": _cmp(lambda v, x: v < x),
+    "$lte": _cmp(lambda v, x: v <= x),
+    "$regex": lambda v, x: isinstance(v, str) and re.search(x, v) is not None,
+    "$bitsAllClear": lambda v, x: isinstance(v, int) and all(not (v >> i) & 1 for i in x),
+}
+
+
+def _match(d, req):
+    for k, c in (req or {}).items():
+        if k == "$and":
+            ok = all(_match(d, r) for r in c)
+        elif k == "$or":
+            ok = any(_match(d, r) for r in c)
+        elif isinstance(c, dict) and c and all(o.startswith("$") for o in c):
+            ok = all(_ops[o](d.get(k, _missing), x) for o, x in c.items())
+        else:
+            ok = _eq(d.get(k, _missing), c)
+        if not ok:
+            return False
+    return True
+
+
+def _expr(d, e):
+    "Evaluates the aggregation expression e for document d."
+    if isinstance(e, str) and e.startswith("$"):
+        return d if e == "$$ROOT" else d.get(e[1:])
+    if isinstance(e, dict) and len(e) == 1:
+        op, a = next(iter(e.items()))
+        if op == "$mergeObjects":
+            r = {}
+            for x in a:
+                r.update(_expr(d, x) or {})
+            return r
+        if op == "$arrayElemAt":
+            l, i = _expr(d, a[0]), a[1]
+            return l[i] if -len(l) <= i < len(l) else None
+        if op == "$size":
+            return len(_expr(d, a))
+        if op == "$setIntersection":
+            L, R = _expr(d, a[0]), _expr(d, a[1])
+            return [x for i, x in enumerate(L) if x in R and x not in L[:i]]
+    return _norm(e)
+
+
+def _project(d, P):
+    if not P:
+        return dict(d)
+    if any(v and k != "_id" for k, v in P.items()):
+        r = {k: d[k] for k in ("_id",) if k in d and P.get("_id", 1)}
+        for k, v in P.items():
+            if k == "_id":
+                continue
+            if v is True or v == 1:
+                if k in d:
+                    r[k] = d[k]
+            elif v:
+                r[k] = _expr(d, v)
+        return r
+    return {k: v for k, v in d.items() if P.get(k, 1)}
+
+
+class FakeCollection(object):
+    """
+    In-memory collection of documents with the subset of the pymongo
+    Collection API used by ccrawl: queries and aggregation pipelines are
+    evaluated on the documents (for the operators and stages used by
+    db.MongoDB), inserts, updates and deletes modify them, and bulk_write
+    operations, deleted requests, created indexes and pipelines are recorded
+    (but bulk operations are not applied.)
+    """
+
+    def __init__(self, docs=(), db=None):
+        self.docs = [_norm(d) for d in docs]
+        self.db = db
+        self.ops = []
+        self.deleted = []
+        self.indexes = []
+        self.pipelines = []
+
+    def find(self, req=None, projection=None, sort=None):
+        L = [_project(d, projection) for d in self.docs if _match(d, req)]
+        for k, o in reversed(sort or []):
+            L.sort(key=lambda d: d[k], reverse=(o < 0))
+        return L
+
+    def find_one(self, req=None, projection=None, sort=None):
+        return next(iter(self.find(req, projection, sort)), None)
+
+    def estimated_document_count(self):
+        return len(self.docs)
+
+    def insert_many(self, docs, ordered=True):
+        from bson import ObjectId
+
+        for d in docs:
+            d.setdefault("_id", ObjectId())
+            self.docs.append(_norm(d))
+
+    def delete_many(self, req):
+        self.deleted.append(req)
+        self.docs = [d for d in self.docs if not _match(d, req)]
+
+    def bulk_write(self, ops, ordered=True):
+        self.ops.extend(ops)
+
+    def update_one(self, req, update, upsert=False):
+        d = next((d for d in self.docs if _match(d, req)), None)
+        if d is None:
+            if not upsert:
+                return
+            d = {k: v for k, v in req.items() if not k.startswith("$")}
+            self.docs.append(d)
+        for k, v in update.get("$set", {}).items():
+            d[k] = _norm(v)
+        for k, v in update.get("$inc", {}).items():
+            d[k] = d.get(k, 0) + v
+
+    def create_index(self, keys, **kargs):
+        self.indexes.append(keys)
+
+    def aggregate(self, pipeline):
+        self.pipelines.append(pipeline)
+        return iter(self._run([dict(d) for d in self.docs], pipeline))
+
+    def _run(self, L, pipeline):
+        for stage in pipeline:
+            (op, a), = stage.items()
+            if op == "$match":
+                L = [d for d in L if _match(d, a)]
+            elif op == "$lookup":
+                F = self.db[a["from"]].docs
+                for d in L:
+                    v = d.get(a["localField"])
+                    d[a["as"]] = [dict(f) for f in F if f.get(a["foreignField"]) == v]
+            elif op == "$replaceRoot":
+                L = [_expr(d, a["newRoot"]) for d in L]
+            elif op == "$project":
+                L = [_project(d, a) for d in L]
+            elif op == "$sort":
+                for k, o in reversed(list(a.items())):
+                    L.sort(key=lambda d: d[k], reverse=(o < 0))
+            elif op == "$limit":
+                L = L[:a]
+            elif op == "$facet":
+                L = [{k: self._run([dict(d) for d in L], P) for k, P in a.items()}]
+            else:
+                raise NotImplementedError(op)
+        return L
+
+
+class FakeDatabase(dict):
+    "Dict of FakeCollection (created when first accessed) by name."
+
+    def __missing__(self, name):
+        col = self[name] = FakeCollection(db=self)
+        return col
+
+    def get_collection(self, name):
+        return self[name]
+
+
+@pytest.fixture
+def fake_mongo():
+    """
+    Returns a function that builds a db.MongoDB instance on a FakeDatabase
+    whose collections are initialized with the given lists of documents by
+    collection name.
+    """
+    from ccrawl.db import MongoDB
+
+    def make(**cols):
+        m = MongoDB.__new__(MongoDB)
+        m.db = FakeDatabase()
+        for name, docs in cols.items():
+            m.db[name] = FakeCollection(docs, m.db)
+        return m
+
+    return make
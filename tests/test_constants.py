@@ -0,0 +1,130 @@
+import pytest
+from ccrawl import conf
+from ccrawl.db import Proxy, MongoDB, where
+from ccrawl.constants import *
+
+
+def test_c_eval():
+    assert c_eval("0x10") == 16
+    assert c_eval("(1<<2)") == 4
+    assert c_eval("(1UL << 63)") == 1 << 63
+    assert c_eval("-1") == -1
+    assert c_eval("(unsigned char)-1") == 255
+    assert c_eval("~0U") == 0xFFFFFFFF
+    assert c_eval("-7 / 2") == -3
+    assert c_eval("-7 % 2") == -1
+    assert c_eval("'A' + '\\n'") == 75
+    assert c_eval("2 > 1 ? 0x20 : 0x40") == 0x20
+    assert c_eval("A | B", {"A": 1, "B": 4}.__getitem__) == 5
+    for e in ("", "1 +", "\"toto\"", "(a+4)", "1.5", "1 / 0", "f(1)"):
+        with pytest.raises(ValueError):
+            c_eval(e)
+
+
+def test_decompose():
+    F = [(0x1, "A"), (0x2, "B"), (0x3, "AB"), (0x40, "C"), (0x200, "E")]
+    assert decompose(0x243, F) == (["AB", "C", "E"], 0)
+    assert decompose(0x1004, F) == ([], 0x1004)
+    assert decompose(0x2, F) == (["B"], 0)
+
+
+def test_constants():
+    docs = [
+        {"id": "X", "cls": "cMacro", "tag": "a", "val": "(Y + E2)"},
+        {"id": "Y", "cls": "cMacro", "tag": "a", "val": "0x10"},
+        {"id": "Y", "cls": "cMacro", "tag": "b", "val": "0x20"},
+        {"id": "R", "cls": "cMacro", "tag": "a", "val": "(R + 1)"},
+        {"id": "S", "cls": "cMacro", "tag": "a", "val": "\"toto\""},
+        {"id": "enum e", "cls": "cEnum", "tag": "a", "val": {"E1": 1, "E2": 2}},
+        # identifiers are only resolved in the same tag:
+        {"id": "Z", "cls": "cMacro", "tag": "b", "val": "(Y | 1)"},
+        {"id": "W", "cls": "cMacro", "tag": "b", "val": "E1"},
+    ]
+    L = [(v, n, d["tag"]) for v, n, d in constants(docs)]
+    assert L == [
+        (18, "X", "a"), (16, "Y", "a"), (32, "Y", "b"), (1, "E1", "a"), (2, "E2", "a"),
+        (33, "Z", "b"),
+    ]
+
+
+def test_mask_ranges():
+    assert mask_ranges(0) == []
+    assert mask_ranges(0x14) == [(4, 0x14)]
+    assert mask_ranges(1 << 63 | 2) == [(2, (1 << 63) - 1), (-(1 << 63), -(1 << 63) + 2)]
+    I = ConstIndex(":memory:")
+    I.con.executemany(
+        "INSERT INTO consts VALUES (?,?,?,?,?,?,?,?)",
+        [(int64(v), str(v), "S%x" % v, "cMacro", "S", "t", "s.h", 0)
+         for v in (1, 2, 3, 4, 8, 1 << 63, 1 << 63 | 2)],
+    )
+    assert [r[0] for r in I.select(6, mask=True)] == [2, 4]
+    assert [r[0] for r in I.select(1 << 63 | 3, mask=True)] == [1, 2, 3, 1 << 63, 1 << 63 | 2]
+    plan = I.con.execute(
+        "EXPLAIN QUERY PLAN SELECT * FROM consts WHERE value BETWEEN 1 AND 7"
+    ).fetchall()
+    assert "consts_v" in plan[0][-1]
+
+
+def test_find_constants(configfile, tmp_path):
+    c = conf.Config(configfile)
+    conf.config = c
+    db = Proxy(conf.Database(local=str(tmp_path / "c.db"), url=""))
+    docs = [
+        {"id": "F_R", "cls": "cMacro", "tag": "t", "src": "f.h", "val": "0x1"},
+        {"id": "F_W", "cls": "cMacro", "tag": "t", "src": "f.h", "val": "(1 << 1)"},
+        {"id": "F_RW", "cls": "cMacro", "tag": "t", "src": "f.h", "val": "(F_R | F_W)"},
+        {"id": "enum m", "cls": "cEnum", "tag": "t", "src": "m.h", "val": {"M_X": 4}},
+        {"id": "F_R", "cls": "cMacro", "tag": "u", "src": "g.h", "val": "8"},
+    ]
+    db.insert_multiple(docs)
+    db.flush()
+    assert db.find_constants(3) == [(3, "F_RW", "cMacro", "F_RW", "t", "f.h")]
+    assert [r[1] for r in db.find_constants(7, mask=True)] == ["F_R", "F_W", "F_RW", "M_X"]
+    assert [r[1] for r in db.find_constants(7, "F_", mask=True)] == ["F_R", "F_W", "F_RW"]
+    assert [r[4] for r in db.find_constants(8, "F_R")] == ["u"]
+    assert [r[1] for r in db.find_constants(7, mask=True, q=where("src") == "m.h")] == ["M_X"]
+    db.set_tag("t")
+    assert db.find_constants(8) == []
+    I = db.constants()
+    assert I.stamp == db.stamp()
+    # the index is rebuilt when the database is modified:
+    db.insert_multiple([{"id": "F_X", "cls": "cMacro", "tag": "t", "val": "0x8"}])
+    db.flush()
+    assert [r[1] for r in db.find_constants(8)] == ["F_X"]
+    assert I.stamp == db.stamp()
+    # only the constants of the tag collected since stamp are updated:
+    stamp = db.stamp()
+    db.insert_multiple([{"id": "G_X", "cls": "cMacro", "tag": "v", "val": "0x8"}])
+    db.flush()
+    I.build = None
+    db.constants("v", since=stamp)
+    assert I.stamp == db.stamp()
+    db.set_tag(None)
+    assert [r[1] for r in db.find_constants(8)] == ["F_R", "F_X", "G_X"]
+    db.close()
+
+
+def test_MongoDB_find_constants(fake_mongo):
+    C = [
+        {"symbol": "AB", "raw": "3", "cls": "cMacro", "id": "AB", "tag": "t", "src": "a.h"},
+        {"symbol": "M", "raw": "-1", "cls": "cMacro", "id": "M", "tag": "t", "src": "a.h"},
+        {"symbol": "B8", "raw": "8", "cls": "cMacro", "id": "B8", "tag": "t", "src": "a.h"},
+        {"symbol": "AB", "raw": "3", "cls": "cMacro", "id": "AB", "tag": "u", "src": "b.h"},
+    ]
+    for c in C:
+        c["value"] = int64(int(c["raw"]))
+    m = fake_mongo(constants=C)
+    assert m.find_constants(3, "A", tag="t") == [(3, "AB", "cMacro", "AB", "t", "a.h")]
+    assert [r[4] for r in m.find_constants(3)] == ["t", "u"]
+    # negative constants are never part of a mask:
+    assert [r[1] for r in m.find_constants(7, mask=True, tag="t")] == ["AB"]
+    assert [r[1] for r in m.find_constants(11, mask=True, tag="t")] == ["AB", "B8"]
+    assert m.find_constants(0, mask=True) == []
+    # the constants collection is built when it is empty:
+    N = [
+        {"_id": 1, "id": "F_R", "cls": "cMacro", "tag": "t", "src": "f.h", "val": "0x1"},
+        {"_id": 2, "id": "enum m", "cls": "cEnum", "tag": "t", "src": "m.h", "val": {"M_X": 4}},
+    ]
+    m = fake_mongo(nodes=N)
+    assert [r[1] for r in m.find_constants(5, mask=True)] == ["F_R", "M_X"]
+    assert len(m.db["constants"].docs) == 2
@@ -47,3 +47,26 @@ def test_from_db_2(db_doc2):
     assert "yyyy" in x.subtypes
     y = x.subtypes["yyyy"]
     assert y._is_typedef
+
+
+def test_to_db_decompose(db_doc2):
+    x = ccore.from_db(data=db_doc2[0])
+    doc = x.to_db(x.identifier, "test", "x.h", decompose=True)[0]
+    assert doc["types"][1] == c_type("yyyy").to_dict()
+    doc["types"][0]["base"] = "short"
+    y = ccore.from_db(data=doc)
+    T = [r for (t, n, c, r) in y.fields_types()]
+    assert T[0].lbase == "short"
+    assert T[1].show("b") == "yyyy b"
+    assert "types" not in x.to_db(x.identifier, "test", "x.h")[0]
+
+
+def test_to_db_hash(db_doc2):
+    import json
+
+    x = ccore.from_db(data=db_doc2[0])
+    doc = x.to_db(x.identifier, "test", "x.h")[0]
+    y = ccore.from_db(data=json.loads(json.dumps(doc)))
+    assert y.to_db(x.identifier, "test", "y.h")[0]["hash"] == doc["hash"]
+    assert val_digest(db_doc2[0]["val"]) == doc["hash"]
+    assert ccore.from_db(data=db_doc2[1]).to_db("X", None, "x.h")[0]["hash"] != doc["hash"]
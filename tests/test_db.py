@@ -1,3 +1,4 @@
+import os
 import pytest
 from ccrawl.conf import Config
 from ccrawl.db import *
@@ -22,8 +23,336 @@ def test_Proxy_tinydb(configfile, db_doc1, db_doc2):
     db.close()
 
 
+def test_Proxy_sqlite(configfile, db_doc1, db_doc2, tmp_path):
+    c = Config(configfile)
+    c.Database.local = u"sqlite://%s" % (tmp_path / "test.sqlite")
+    c.Database.url = u""
+    db = Proxy(c.Database)
+    assert type(db.ldb).__name__ == "SQLiteDB"
+    assert db.sidecar(".ckpt") == str(tmp_path / "test.sqlite") + ".ckpt"
+    assert len(db.ldb) == 0
+    db.ldb.insert(db_doc1)
+    assert db.ldb.contains(where("id") == "xxx")
+    ids = db.insert_multiple(db_doc2)
+    x = db.get(where("id") == "struct X")
+    assert x["cls"] == "cStruct" and x.doc_id == ids[0]
+    assert x["val"] == db_doc2[0]["val"]
+    assert len(db.search(where("cls") == "cTypedef")) == 2
+    assert len(db.search(where("val").test(lambda v: "int" in v))) == 2
+    db.ldb.update({"tag": "t"}, doc_ids=ids)
+    db.set_tag("t")
+    assert len(db.search()) == 2
+    assert len(db.search(where("cls") == "cTypedef")) == 1
+    assert len(db.search((where("id") == "xxx") | (where("id") == "yyyy"))) == 1
+    db.ldb.remove(doc_ids=[ids[1]])
+    db.close()
+    db = Proxy(c.Database)
+    assert len(db.ldb) == 2
+    db.set_tag("t")
+    assert [x["id"] for x in db.search()] == ["struct X"]
+    db.close()
+
+
 def test_Proxy_mongodb(configfile, db_doc2):
     c = Config(configfile)
     c.Database.local = u""
     db = Proxy(c.Database)
     # TODO
+
+
+def test_Sink(configfile):
+    c = Config(configfile)
+    c.Database.local = u""
+    c.Database.url = u""
+    db = Proxy(c.Database)
+    f = lambda body: {
+        "id": "f",
+        "cls": "cFunc",
+        "src": "a.c",
+        "val": {"prototype": "int (int)", "locs": body, "calls": []},
+    }
+    s = {"id": "struct S", "cls": "cStruct", "src": "a.h", "val": []}
+    sink = Sink(db, size=2)
+    sink.add([f([]), s])
+    assert sink.count == 2 and len(db.ldb) == 2
+    sink.add([dict(s, val=[["int", "x", None]]), f([["int", "i"]])])
+    sink.flush()
+    assert sink.count == 2 and len(db.ldb) == 2
+    assert db.get(where("id") == "f")["val"]["locs"] == [["int", "i"]]
+    assert db.get(where("id") == "struct S")["val"] == []
+    db.close()
+
+
+def test_Sink_stream(configfile, tmp_path):
+    c = Config(configfile)
+    c.Database.url = u""
+    L = [{"id": "x%d" % i, "cls": "cMacro", "src": "a.h", "val": "1"} for i in range(3)]
+    # TinyDB files are written once by the final flush:
+    c.Database.local = str(tmp_path / "t.db")
+    db = Proxy(c.Database)
+    sink = Sink(db, size=2)
+    assert not sink.stream
+    sink.add(L)
+    assert len(db.ldb) == 3 and os.path.getsize(c.Database.local) == 0
+    sink.flush()
+    assert os.path.getsize(c.Database.local) > 0
+    db.close()
+    # SQLite databases are written by batches:
+    c.Database.local = "sqlite://" + str(tmp_path / "s.db")
+    db = Proxy(c.Database)
+    sink = Sink(db, size=2)
+    assert sink.stream
+    sink.add(L)
+    db2 = Proxy(c.Database)
+    assert len(db2.ldb) == 3
+    db2.close()
+    db.close()
+
+
+def test_IndexedTable(configfile, db_doc1, db_doc2):
+    c = Config(configfile)
+    c.Database.local = u""
+    c.Database.url = u""
+    db = Proxy(c.Database)
+    db.insert_multiple(db_doc2)
+    assert db.get(where("id") == "yyyy")["val"] == "int *"
+    assert db.ldb.table(db.ldb.default_table_name)._index is not None
+    db.ldb.insert(dict(db_doc1, id="yyyy", tag="t"))
+    # index is rebuilt after any modification:
+    assert len(db.ldb.search(where("id") == "yyyy")) == 2
+    db.set_tag("t")
+    assert db.search(where("id") == "yyyy")[0]["val"] == "int"
+    assert db.contains(db.tag & (where("id") == "yyyy"))
+    assert not db.contains(db.tag & (where("id") == "struct X"))
+    db.ldb.remove(where("id") == "yyyy")
+    assert db.get(where("id") == "yyyy") is None
+    db.close()
+
+
+def test_TypesCache(configfile, tmp_path):
+    from ccrawl.core import ccore
+
+    c = Config(configfile)
+    c.Database.local = str(tmp_path / "test.db")
+    c.Database.url = u""
+    c.Database.cache = str(tmp_path / "types.cache")
+    db = Proxy(c.Database)
+    db.insert_multiple(
+        [
+            {"id": "myint", "cls": "cTypedef", "val": "int"},
+            {"id": "struct T", "cls": "cStruct", "val": [["myint", "b", ""]]},
+            {"id": "struct S", "cls": "cStruct",
+             "val": [["myint", "a", ""], ["struct T *", "p", ""], ["Z", "z", ""]]},
+        ]
+    )
+    db.close()
+    ccore._cache_.clear()
+    db = Proxy(c.Database)
+    x = ccore.from_db(db.get(where("id") == "struct S")).unfold(db)
+    assert x.subtypes["struct T"].subtypes["myint"] == "int"
+    assert x.subtypes["Z"] is None
+    db.remember(x)
+    db.cache.close()
+    # a new process gets the whole closure of struct S from the persistent cache:
+    ccore._cache_.clear()
+    db = Proxy(c.Database)
+    L = []
+    search = db.ldb.search
+    db.ldb.search = lambda q: L.append(q) or search(q)
+    x = ccore.from_db(db.get(where("id") == "struct S")).unfold(db)
+    assert len(L) == 0
+    assert x.subtypes["struct T"].subtypes["myint"] == "int"
+    assert x.subtypes["Z"] is None
+    assert db.get(where("id") == "Z") is None
+    db.cache.close()
+    # cache is invalidated when the database is modified:
+    db.insert_multiple([{"id": "Z", "cls": "cTypedef", "val": "char"}])
+    db.close()
+    ccore._cache_.clear()
+    db = Proxy(c.Database)
+    x = ccore.from_db(db.get(where("id") == "struct S")).unfold(db)
+    assert x.subtypes["Z"] == "char"
+    db.cache.close()
+    db.close()
+
+
+def test_Proxy_build_deps(configfile, db_doc1, db_doc2):
+    c = Config(configfile)
+    c.Database.local = u""
+    c.Database.url = u""
+    db = Proxy(c.Database)
+    db.insert_multiple(db_doc2 + [dict(db_doc1, id="zzzz", val="yyyy")])
+    assert db.build_deps() == 3
+    x = db.get(where("id") == "struct X")
+    assert x["use"] == ["yyyy"] and x["used_by"] == []
+    y = db.get(where("id") == "yyyy")
+    assert y["use"] == [] and y["used_by"] == ["struct X", "zzzz"]
+    assert db.build_deps() == 0
+    db.ldb.remove(where("id") == "zzzz")
+    assert db.build_deps() == 1
+    assert db.get(where("id") == "yyyy")["used_by"] == ["struct X"]
+    # the index of a replaced document is dropped and rebuilt:
+    x = db.get(where("id") == "struct X")
+    db.replace(dict(db_doc1, id="struct X", val="int"), x.doc_id)
+    assert "use" not in db.get(where("id") == "struct X")
+    assert db.build_deps() == 2
+    assert db.get(where("id") == "yyyy")["used_by"] == []
+    db.close()
+
+
+def test_MongoDB_insert_chunks(monkeypatch, fake_mongo):
+    from pymongo.errors import AutoReconnect, BulkWriteError
+
+    monkeypatch.setattr("time.sleep", lambda t: None)
+    m = fake_mongo(nodes=[])
+    col = m.db["nodes"]
+    insert, calls = col.insert_many, []
+
+    def insert_many(docs, ordered=True):
+        assert ordered is False
+        calls.append(docs)
+        if len(calls) == 2:
+            # network error after a partial insert:
+            insert(docs[:1])
+            raise AutoReconnect("oops")
+        ids = [d["id"] for d in col.docs]
+        E = []
+        for i, d in enumerate(docs):
+            if d["id"] in ids:
+                E.append({"index": i, "code": 11000})
+            elif d["id"] == "bad":
+                E.append({"index": i, "code": 121})
+            else:
+                insert([d])
+        if E:
+            raise BulkWriteError({"writeErrors": E})
+
+    monkeypatch.setattr(col, "insert_many", insert_many)
+    docs = [{"id": "d%d" % i} for i in range(5)] + [{"id": "bad"}]
+    R = list(m.insert_chunks(docs, size=2))
+    assert [len(c) for c, f in R] == [2, 2, 2]
+    assert [f for c, f in R] == [[], [], [{"id": "bad"}]]
+    assert sorted((d["id"] for d in col.docs)) == ["d0", "d1", "d2", "d3", "d4"]
+
+
+def test_MongoDB_sync_plan(fake_mongo):
+    R = [
+        {"_id": 1, "id": "a", "cls": "cMacro", "tag": "t", "src": "x.h", "val": "1"},
+        {"_id": 2, "id": "b", "cls": "cTypedef", "tag": "t", "src": "x.h", "val": "int"},
+        {"_id": 4, "id": "c", "cls": "cMacro", "tag": "t", "src": "y.h", "val": "2"},
+        {"_id": 3, "id": "b", "cls": "cTypedef", "tag": "u", "src": "x.h", "val": "int"},
+    ]
+    m = fake_mongo(nodes=R)
+    col = m.db["nodes"]
+    L = [
+        {"id": "a", "cls": "cMacro", "tag": "t", "src": "x.h", "val": "1"},
+        {"id": "b", "cls": "cTypedef", "tag": "t", "src": "x.h", "val": "long"},
+        {"id": "c", "cls": "cMacro", "tag": "t", "src": "x.h", "val": "2"},
+    ]
+    new, changed, same = m.sync_plan(L)
+    assert new == [L[2]]
+    assert changed == [(L[1], [2])]
+    assert same == [L[0]]
+    stamp = m.stamp()
+    assert m.sync_apply(None, [], []) == 0 and m.stamp() == stamp
+    assert m.sync_apply(None, new, changed) == 2
+    assert len(col.ops) == 2
+    # (the fake bulk_write doesn't apply the writes, but the stamp changes:)
+    assert len(col.docs) == 4 and m.stamp() != stamp
+    # constants of the tag of the written macro are updated:
+    C = m.db["constants"]
+    assert C.deleted == [{"tag": {"$in": ["t"]}}]
+    assert [(c["symbol"], c["value"], c["node"]) for c in C.docs] == [
+        ("a", 1, 1),
+        ("c", 2, 4),
+    ]
+    assert "_id" not in L[2]
+    col.docs[1]["hash"] = val_digest("long")
+    del col.docs[1]["val"]
+    new, changed, same = m.sync_plan(L)
+    assert changed == [] and len(new) == 1
+
+
+def test_MongoDB_structs(monkeypatch, tmp_path, fake_mongo):
+    import json
+    from pymongo import UpdateOne
+
+    m = fake_mongo(
+        nodes=[
+            {"_id": 1, "cls": "cStruct", "tag": "a"},
+            {"_id": 2, "cls": "cStruct", "tag": "b"},
+            {"_id": 3, "cls": "cTypedef", "tag": "b"},
+        ],
+        structs_ptr32=[{"_id": i} for i in (1, 2, 4)],
+        structs_ptr64=[{"_id": i} for i in (1, 2, 4, 5)],
+    )
+    m.cleanup_structs(size=2)
+    assert [d["_id"] for d in m.db["structs_ptr32"].docs] == [1, 2]
+    assert [d["_id"] for d in m.db["structs_ptr64"].docs] == [1, 2]
+    m.cleanup_structs(tag="b")
+    assert [d["_id"] for d in m.db["structs_ptr64"].docs] == [1]
+    def offsets(s, db):
+        if s["tag"] == "b":
+            return (s["_id"], "B", (4, [0], 8, [0]), None)
+        return (s["_id"], "A", None, "oops")
+
+    monkeypatch.setattr(MongoDB, "struct_offsets", staticmethod(offsets))
+    report = tmp_path / "report.json"
+    F = m.update_structs(None, size=1, report=str(report))
+    assert F == [(1, "A", "oops")]
+    assert json.loads(report.read_text()) == {"_id": "1", "id": "A", "error": "oops"}
+    assert len(m.db["structs_ptr32"].ops) == 1
+    assert m.db["structs_ptr64"].ops == [
+        UpdateOne({"_id": 2}, {"$set": {"_id": 2, "size": 8, "offsets": [0]}}, upsert=True)
+    ]
+
+
+def test_structs_dispatch(monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+    from ccrawl import db
+
+    monkeypatch.setattr(db, "structs_worker", lambda P: [s * 2 for s in P])
+    with ThreadPoolExecutor(2) as ex:
+        assert list(structs_dispatch(ex, 2, iter(range(25)), 3)) == list(range(0, 50, 2))
+
+
+def test_MongoDB_find_matching_types(fake_mongo):
+    m = fake_mongo(
+        nodes=[{"_id": 1, "id": "A", "cls": "cStruct"}, {"_id": 2, "id": "B", "cls": "cClass"}],
+        structs_ptr32=[
+            {"_id": 1, "size": 8, "offsets": [[0, 4], [4, 4]]},
+            {"_id": 2, "size": 12, "offsets": [[0, 4], [4, 4], [8, 4]]},
+        ],
+        structs_ptr64=[{"_id": 2, "size": 16, "offsets": [[0, 8], [8, 4]]}],
+    )
+    Locs = {"a": [(0, 4)], "b": [(4, 4), (8, 4)], "c": [(0, 8)], "d": [], "e": [(0, 4)]}
+    m.find_matching_types(Locs)
+    assert len(m.db["structs_ptr32"].pipelines) == len(m.db["structs_ptr64"].pipelines) == 1
+    assert Locs["a"] == ([(0, 4)], ["A", "B"])
+    assert Locs["b"][1] == ["B"]
+    assert Locs["c"][1] == ["B"]
+    assert Locs["d"] == ([], [])
+    assert Locs["e"] == Locs["a"]
+    Locs = {"a": [(0, 4)]}
+    m.find_matching_types(Locs, req={"cls": "cClass"}, psize=32)
+    assert Locs["a"][1] == ["B"]
+    assert len(m.db["structs_ptr64"].pipelines) == 1
+
+
+def test_MongoDB_scored_types(fake_mongo):
+    m = fake_mongo(
+        nodes=[
+            {"_id": 1, "id": "A", "val": [["int", "a", ""], ["char *", "p", ""]]},
+            {"_id": 2, "id": "B", "val": [["int", "a", ""], ["int", "b", ""]]},
+        ],
+        structs_ptr64=[
+            {"_id": 1, "size": 16, "offsets": [[0, 4], [8, 8]]},
+            {"_id": 2, "size": 8, "offsets": [[0, 4], [4, 4]]},
+        ],
+    )
+    Locs = {"v": [(0, 4), (8, 8, "*")], "w": [(0, 4), (8, 4, "*")], "x": []}
+    m.find_matching_types(Locs, psize=64, k=1)
+    assert Locs["v"][1] == [("A", 1.0)]
+    # B has no field at 8 and is too small:
+    assert Locs["w"][1] == [("A", round(0.8 * 1.5 / 2 + 0.2 * 1 / 2, 4))]
+    assert Locs["x"] == ([], [])
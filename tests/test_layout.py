@@ -0,0 +1,144 @@
+import pytest
+from ccrawl import conf
+from ccrawl.core import ccore
+from ccrawl.db import Proxy
+from ccrawl.parser import parse_string
+from ccrawl.layout import *
+
+# offsets and sizes below are those computed by clang for the x86_64 and
+# armv7 (linux) targets:
+src = """
+typedef long double lay_ld;
+typedef int lay_arr3[3];
+enum lay_E { LAY_A, LAY_B = 5 };
+#define LAY_N 7
+struct lay_a { char c; lay_ld x; short s; };
+struct lay_b { char c[3][5]; int *p[2][3]; int (*pa)[4]; lay_arr3 m[2]; };
+struct lay_c { unsigned char a:3; unsigned char b:6; unsigned int c:20;
+  unsigned int d:20; long long e:40; char f; int :0; char g; };
+struct lay_d { char c; struct { int x; char y; }; union { double u; char v[9]; };
+  void (*f)(int); };
+union lay_e { char c; long double d; struct lay_a s; int bits:3; };
+struct lay_f { enum lay_E e; char c; char fl[]; };
+struct lay_h { struct lay_a aa[2]; union lay_e ee; char t; int w[LAY_N]; };
+struct lay_i { char a; int :3; char b; long long :0; char c; short d:9;
+  short e:9; short f:9; };
+struct lay_u { struct lay_undefined *p; };
+struct lay_v { struct lay_undefined x; };
+"""
+
+
+@pytest.fixture
+def db(configfile):
+    c = conf.Config(configfile)
+    c.Terminal.quiet = True
+    conf.config = c
+    L = parse_string(src, [], tag="lay", config=c.Collect)
+    db = Proxy(conf.Database(local="", url=""))
+    db.insert_multiple(L)
+    yield db
+    ccore._cache_.clear()
+
+
+def test_split_type():
+    assert split_type("unsigned long int") == ("long", (), (), None)
+    assert split_type("const char *[2][3]") == ("char", (("ptr",),), ("2", "3"), None)
+    assert split_type("u8 # 3") == ("u8", (), (), 3)
+    assert split_type("int (*)[4]")[1] == (("arr", "4"), ("ptr",))
+
+
+def test_layouts(db):
+    E = Layouts(db)
+    get = lambda n, p: E.layout(E.fetch(n), p)
+    l = get("struct lay_a", 8)
+    assert (l.size, l.align, l.offsets()) == (48, 16, [(0, 1), (16, 16), (32, 2)])
+    assert get("struct lay_a", 4).offsets() == [(0, 1), (8, 8), (16, 2)]
+    l = get("struct lay_b", 8)
+    assert l.size == 96
+    assert [f.offset for f in l.fields] == [0, 16, 64, 72]
+    assert [f.count for f in l.fields] == [15, 6, 0, 2]
+    l = get("struct lay_c", 8)
+    assert [(f.offset * 8 + f.bitpos, f.bitsize) for f in l.fields] == [
+        (0, 3), (8, 6), (32, 20), (64, 20), (84, 40), (128, 0), (160, 0), (160, 0)
+    ]
+    assert l.size == 24
+    l = get("struct lay_d", 8)
+    assert (l.size, [f.offset for f in l.fields]) == (40, [0, 4, 16, 32])
+    assert get("struct lay_d", 4).offsets()[3] == (32, 4)
+    assert get("union lay_e", 8).size == 48
+    assert get("union lay_e", 4).size == 24
+    assert get("struct lay_f", 8).offsets() == [(0, 4), (4, 1), (5, 0)]
+    assert get("struct lay_f", 8).size == 8
+    assert get("struct lay_h", 8).size == 176
+    assert get("struct lay_h", 4).size == 104
+    l = get("struct lay_i", 8)
+    assert [f.offset * 8 + f.bitpos for f in l.fields] == [0, 8, 16, 64, 64, 80, 96, 112]
+    assert (l.size, l.align) == (16, 2)
+    # the forward declaration of lay_undefined is not a member:
+    assert get("struct lay_u", 4).offsets() == [(0, 0), (0, 4)]
+    with pytest.raises(KeyError):
+        get("struct lay_v", 8)
+
+
+def test_LayoutIndex(db):
+    db.set_tag("lay")
+    I = db.layouts()
+    assert I.select(8, 48) == ["struct lay_a"]
+    assert I.select(4, 24, [(8, 8, None)]) == ["struct lay_a", "struct lay_c"]
+    assert I.select(8, None, [(16, 16, "lay_ld")]) == ["struct lay_a"]
+    assert I.select(8, None, [(0, 1, None), (4, None, None)]) == ["struct lay_c", "struct lay_d"]
+    assert I.select(8, fields=[(0, 1, None)], tag="other") == []
+    assert [f[0] for f in I.failures()] == ["struct lay_v"]
+    assert db.layouts() is I
+    Locs = db.find_matching_types({"v": [(0, 48), (48, 24)]})
+    assert Locs["v"][1] == ["struct lay_h"]
+    Locs = db.find_matching_types({"v": [(0, 1), (32, 4)]}, req={"cls": "cStruct"})
+    assert Locs["v"][1] == ["struct lay_d"]
+    assert I.select(8, fields=[(32, None, "*")]) == ["struct lay_d"]
+    Locs = db.find_matching_types({"v": [(0, 1)], "w": [(0, 1), (32, 8)], "x": []}, psize=8)
+    assert Locs["v"][1] == ["struct lay_a", "struct lay_d", "struct lay_i", "struct lay_c"]
+    assert Locs["w"][1] == ["struct lay_d"]
+    assert Locs["x"] == ([], [])
+
+
+def test_approx(db):
+    db.set_tag("lay")
+    Locs = {"v": [(0, 1), (32, 8, "*"), (4, 4)], "w": [(0, 16, "*"), (16, 16)], "x": []}
+    db.find_matching_types(Locs, psize=8, k=3)
+    # lay_d: 2 exact accesses and 1 at offset 4 with a different size,
+    # 2 of its 4 locations accessed:
+    assert Locs["v"][1][0] == ("struct lay_d", round(0.8 * 2.5 / 3 + 0.2 * 2 / 4, 4))
+    assert [i for i, _ in Locs["v"][1]] == ["struct lay_d", "struct lay_a", "struct lay_c"]
+    # the pointer access at 0 halves the match of lay_a.c:
+    assert Locs["w"][1][0] == ("struct lay_a", round(0.8 * 1.25 / 2 + 0.2 * 1 / 3, 4))
+    assert Locs["x"] == ([], [])
+    Locs = db.find_matching_types({"v": [(0, 1), (32, 4, "*")]}, psize=4, k=1)
+    assert Locs["v"][1] == [("struct lay_d", round(0.8 + 0.2 * 2 / 4, 4))]
+    Locs = db.find_matching_types({"v": [(0, 1), (32, 8)]}, req={"cls": "cUnion"}, k=2)
+    assert Locs["v"][1] == []
+
+
+def test_layouts_tags(configfile):
+    c = conf.Config(configfile)
+    c.Terminal.quiet = True
+    conf.config = c
+    db = Proxy(conf.Database(local="", url=""))
+    # the same types with different definitions in two tags:
+    for tag, s in (
+        ("v1", "typedef int lay_t; struct lay_foo { lay_t a, b; };"),
+        ("v2", "typedef long long lay_t; struct lay_foo { lay_t a, b; char c; };"),
+    ):
+        db.insert_multiple(parse_string(s, [], tag=tag, config=c.Collect))
+    try:
+        I = db.layouts()
+        assert I.select(8, 8, tag="v1") == ["struct lay_foo"]
+        assert I.select(8, 24, tag="v2") == ["struct lay_foo"]
+        assert I.select(8, 8, tag="v2") == []
+        db.set_tag("v2")
+        Locs = db.find_matching_types({"v": [(16, 1)]}, psize=8)
+        assert Locs["v"][1] == ["struct lay_foo"]
+        E = Layouts(db.ldb, "v2")
+        assert E.sizeof("struct lay_foo", 8) == (24, 8)
+        assert E.of("v1").sizeof("struct lay_foo", 8) == (8, 4)
+    finally:
+        ccore._cache_.clear()
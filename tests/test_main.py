@@ -39,7 +39,14 @@ def test_02_cmd_select(configfile, dbfile):
         cli, ["-l", dbfile, "-c", configfile, "select", "constant", "10"]
     )
     assert result.exit_code == 0
-    assert result.output == "\nC1\n"
+    assert result.output == "C1\n"
+    # the index of constants is built by collect:
+    assert os.path.isfile(dbfile + ".constants")
+    result = runner.invoke(
+        cli, ["-l", dbfile, "-c", configfile, "select", "constant", "-m", "14"]
+    )
+    assert result.exit_code == 0
+    assert result.output == "C2 | 0x2\n"
 
 
 def test_03_cmd_select(configfile, dbfile):
@@ -94,3 +101,211 @@ def test_05_cmd_graph(configfile, dbfile):
     assert l[2] == "//graph has a strongly connected component of size 4"
     assert l[3] == "digraph {"
     assert l[6] == '  v0 [label="struct grG"  shape="box"]'
+
+def test_06_cmd_collect_jobs(configfile, dbfile, tmp_path):
+    runner = CliRunner()
+    samples = os.path.join(os.path.dirname(__file__), "samples/xxx")
+    res = {}
+    for jobs in ("1", "2"):
+        dbj = str(tmp_path / ("jobs%s.db" % jobs))
+        result = runner.invoke(
+            cli,
+            ["-l", dbj, "-b", "None", "-c", configfile, "-g", "jobs",
+             "collect", "-j", jobs, samples],
+        )
+        assert result.exit_code == 0
+        db = Proxy(conf.Database(local=dbj, url=""))
+        res[jobs] = sorted((l["id"], l["src"]) for l in db.ldb.all())
+        db.close()
+    assert len(res["1"]) > 0
+    assert res["1"] == res["2"]
+
+
+def test_06_cmd_collect_jobs_decompose(configfile, tmp_path):
+    # Collect options are forwarded to workers:
+    cfg = str(tmp_path / "decompose.conf")
+    with open(configfile) as f, open(cfg, "w") as g:
+        g.write(f.read() + "c.Collect.decompose = True\n")
+    runner = CliRunner()
+    samples = os.path.join(os.path.dirname(__file__), "samples/xxx")
+    res = {}
+    for jobs in ("1", "2"):
+        dbj = str(tmp_path / ("decompose%s.db" % jobs))
+        result = runner.invoke(
+            cli,
+            ["-l", dbj, "-b", "None", "-c", cfg, "collect", "-j", jobs, samples],
+        )
+        assert result.exit_code == 0
+        db = Proxy(conf.Database(local=dbj, url=""))
+        res[jobs] = sorted(l["id"] for l in db.ldb.all() if "types" in l)
+        db.close()
+    assert len(res["1"]) > 0
+    assert res["1"] == res["2"]
+
+
+def test_07_cmd_collect_incremental(configfile, tmp_path):
+    import shutil
+    runner = CliRunner()
+    src = str(tmp_path / "src")
+    shutil.copytree(os.path.join(os.path.dirname(__file__), "samples/xxx"), src)
+    dbi = str(tmp_path / "incr.db")
+    cmd = ["-l", dbi, "-b", "None", "-c", configfile, "collect", "-i", src]
+    result = runner.invoke(cli, cmd)
+    assert result.exit_code == 0
+    assert os.path.isfile(dbi + ".manifest")
+    db = Proxy(conf.Database(local=dbi, url=""))
+    N = len(db.ldb)
+    db.close()
+    assert N > 0
+    result = runner.invoke(cli, cmd)
+    assert result.exit_code == 0
+    db = Proxy(conf.Database(local=dbi, url=""))
+    assert len(db.ldb) == N
+    db.close()
+    with open(os.path.join(src, "graph.h"), "a") as f:
+        f.write("\n#define INCREMENTAL_MACRO 1\n")
+    result = runner.invoke(cli, cmd)
+    assert result.exit_code == 0
+    db = Proxy(conf.Database(local=dbi, url=""))
+    assert len(db.ldb) == N + 1
+    assert db.ldb.contains(where("id") == "INCREMENTAL_MACRO")
+    db.close()
+
+
+def test_08_cmd_collect_resume(configfile, tmp_path, monkeypatch):
+    import ccrawl.main
+    runner = CliRunner()
+    samples = os.path.join(os.path.dirname(__file__), "samples")
+    rc = str(tmp_path / "rc")
+    with open(configfile) as f:
+        open(rc, "w").write(f.read() + "\nc.Collect.batch = 1\n")
+    # (the sqlite backend saves collected documents by batches:)
+    dbr = str(tmp_path / "resume.db")
+    cmd = ["-l", "sqlite://" + dbr, "-b", "None", "-c", rc, "-g", "resume", "collect", "-C", "-k"]
+    parse = ccrawl.main.parse
+    done = []
+    def crash(filename, *args, **kargs):
+        # crash after the first file with documents:
+        if any(done):
+            raise MemoryError
+        l = parse(filename, *args, **kargs)
+        done.append(len(l))
+        return l
+    monkeypatch.setattr(ccrawl.main, "parse", crash)
+    # no checkpoint is journaled unless asked for:
+    result = runner.invoke(cli, cmd[:-1] + [samples])
+    assert isinstance(result.exception, MemoryError)
+    assert not os.path.isfile(dbr + ".ckpt")
+    os.remove(dbr)
+    done = []
+    result = runner.invoke(cli, cmd + [samples])
+    assert isinstance(result.exception, MemoryError)
+    from ccrawl.journal import Checkpoint
+    J = Checkpoint(dbr + ".ckpt")
+    assert J.load() and J.tag == "resume"
+    assert len(J.files) == len(done)
+    monkeypatch.setattr(ccrawl.main, "parse", parse)
+    result = runner.invoke(cli, cmd + ["--resume", samples])
+    assert result.exit_code == 0
+    assert not os.path.isfile(dbr + ".ckpt")
+    db = Proxy(conf.Database(local="sqlite://" + dbr, url=""))
+    res = sorted((l["id"], l["src"]) for l in db.ldb.all())
+    db.close()
+    dbf = "sqlite://" + str(tmp_path / "full.db")
+    result = runner.invoke(cli, ["-l", dbf] + cmd[2:] + [samples])
+    assert result.exit_code == 0
+    db = Proxy(conf.Database(local=dbf, url=""))
+    assert res == sorted((l["id"], l["src"]) for l in db.ldb.all())
+    db.close()
+
+
+def test_08_cmd_collect_checkpoint_tinydb(configfile, tmp_path, monkeypatch):
+    from tinydb.storages import JSONStorage
+    runner = CliRunner()
+    samples = os.path.join(os.path.dirname(__file__), "samples")
+    rc = str(tmp_path / "rc")
+    with open(configfile) as f:
+        open(rc, "w").write(f.read() + "\nc.Collect.batch = 1\n")
+    writes = []
+    write = JSONStorage.write
+    def counted(self, data):
+        writes.append(sum(len(t) for t in data.values()))
+        return write(self, data)
+    monkeypatch.setattr(JSONStorage, "write", counted)
+    dbt = str(tmp_path / "t.db")
+    cmd = ["-l", dbt, "-b", "None", "-c", rc, "-g", "t", "collect", "-C", "-k", samples]
+    result = runner.invoke(cli, cmd)
+    assert result.exit_code == 0
+    assert not os.path.isfile(dbt + ".ckpt")
+    # the TinyDB file is not rewritten for each batch of 1 document:
+    assert len(writes) == 1 and writes[0] > 1
+
+
+def test_09_cmd_collect_timeout(configfile, tmp_path):
+    runner = CliRunner()
+    src = tmp_path / "src"
+    src.mkdir()
+    (src / "ok.h").write_text("struct ok { int x; };\n")
+    (src / "big.h").write_text(
+        "".join(("struct s%d { int a; struct s%d *n; };\n" % (i, i) for i in range(40000)))
+    )
+    rc = str(tmp_path / "rc")
+    with open(configfile) as f:
+        open(rc, "w").write(f.read() + "\nc.Collect.timeout = 0.2\n")
+    dbt = str(tmp_path / "timeout.db")
+    result = runner.invoke(
+        cli, ["-l", dbt, "-b", "None", "-c", rc, "collect", str(src)]
+    )
+    assert result.exit_code == 0
+    with open(dbt + ".failures") as f:
+        assert f.read() == "%s: timeout\n" % (src / "big.h")
+    db = Proxy(conf.Database(local=dbt, url=""))
+    assert [l["id"] for l in db.ldb.all()] == ["struct ok"]
+    db.close()
+
+
+def test_10_cmd_select_users(configfile, dbfile):
+    runner = CliRunner()
+    cmd = ["-l", dbfile, "-c", configfile, "select", "users"]
+    # the dependency index is maintained by collect:
+    db = Proxy(conf.Database(local=dbfile, url=""))
+    assert "myu8" in db.get(where("id") == "__u8")["used_by"]
+    db.close()
+    st = os.stat(dbfile)
+    result = runner.invoke(cli, cmd + ["__u8"])
+    assert result.exit_code == 0
+    l = result.output.split("\n")
+    assert "myu8" in l and "struct xt_string_info" in l
+    result = runner.invoke(cli, cmd + ["-r", "__u8"])
+    assert result.exit_code == 0
+    assert len(result.output.split("\n")) > len(l)
+    # (the local database is not modified:)
+    assert os.stat(dbfile).st_mtime_ns == st.st_mtime_ns
+
+
+def test_11_cmd_select_approx(configfile, dbfile):
+    runner = CliRunner()
+    result = runner.invoke(
+        cli,
+        ["-l", dbfile, "-c", configfile, "select", "struct", "-k", "2", "0:+2", "8:*"],
+    )
+    assert result.exit_code == 0
+    l = result.output.strip().split("\n")
+    assert len(l) == 2
+    assert l[0].endswith(" struct xt_string_info")
+
+
+def test_12_cmd_store_update(configfile, tmp_path):
+    runner = CliRunner()
+    dbs = str(tmp_path / "store.db")
+    samples = os.path.join(os.path.dirname(__file__), "samples/xxx")
+    cmd = ["-l", dbs, "-b", "None", "-c", configfile]
+    result = runner.invoke(cli, cmd + ["collect", samples])
+    assert result.exit_code == 0
+    # the update flag writes the dependency index in the local database:
+    result = runner.invoke(cli, cmd + ["store", "-u"])
+    assert result.exit_code == 0
+    db = Proxy(conf.Database(local=dbs, url=""))
+    L = db.ldb.all()
+    assert len(L) > 0 and all(("use" in l and "used_by" in l) for l in L)
+    db.close()
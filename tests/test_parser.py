@@ -67,3 +67,99 @@ def test_parser_cxx(configfile, cxx_myclass):
         ("_ZN7MyClassC1Ei", "MyClass"),
         ("PUBLIC", None),
     )
+
+
+def test_parser_prelude(configfile, tmp_path):
+    c = conf.Config(configfile)
+    c.Terminal.quiet = True
+    c.Terminal.timer = False
+    c.Collect.strict = False
+    c.Collect.cxx = False
+    c.Collect.prelude = ["common.h"]
+    conf.config = c
+    (tmp_path / "common.h").write_text("#pragma once\nstruct common { int x; };\n")
+    for f in ("a", "b"):
+        (tmp_path / ("%s.h" % f)).write_text(
+            "#include <common.h>\nstruct %s { struct common c; };\n" % f
+        )
+    args = ["-ferror-limit=0", "-I%s" % tmp_path]
+    assert get_index() is get_index()
+    da = [d["id"] for d in parse(str(tmp_path / "a.h"), args)]
+    db = [d["id"] for d in parse(str(tmp_path / "b.h"), args)]
+    assert sorted(da) == ["struct a", "struct common"]
+    # common declarations are collected only once per process:
+    assert db == ["struct b"]
+
+
+def test_parser_scanincludes(configfile, c_headers):
+    c = conf.Config(configfile)
+    c.Terminal.quiet = True
+    c.Terminal.timer = False
+    c.Collect.strict = False
+    c.Collect.cxx = False
+    conf.config = c
+    for f in c_headers:
+        res = scanincludes(f)
+        if res is None:
+            continue
+        missing, incs = parseincludes(f)
+        assert res[0] == missing
+        # the scan also reports files that clang skips when they are
+        # already included by a previous include:
+        it = iter(res[1])
+        assert all((i in it for i in incs))
+    assert scan_cond("defined(A) && !defined B", {"A": True}, False) is True
+    assert scan_cond("defined(A) || defined B", {}, None) is None
+    assert scan_cond("X > 1", {}, False) is None
+
+
+def test_parser_fast_types(configfile):
+    from ccrawl.utils import c_type, cxx_type, parse_decl, pp_grammar, fast_grammar
+
+    c = conf.Config(configfile)
+    c.Terminal.quiet = True
+    c.Terminal.timer = False
+    c.Collect.strict = False
+    c.Collect.cxx = True
+    conf.config = c
+    S = set()
+
+    def strings(v):
+        if isinstance(v, str):
+            S.add(str(v))
+        elif isinstance(v, (list, tuple)):
+            for x in v:
+                strings(x)
+        elif isinstance(v, dict):
+            for x in v.values():
+                strings(x)
+
+    samples_dir = os.path.join(os.path.dirname(__file__), "samples")
+    for R, D, F in os.walk(samples_dir):
+        for f in F:
+            if f.rpartition(".")[2] in ("h", "hpp", "c", "cpp"):
+                for d in parse(os.path.join(R, f), tag="test"):
+                    strings([d["id"], d["val"]])
+
+    def decompose(s, cls, g):
+        try:
+            D = parse_decl(s, cls, g)
+        except Exception:
+            return None
+        D["pstack"] = [(type(p), vars(p)) for p in D["pstack"]]
+        return D
+
+    assert len(S) > 1000
+    for s in S:
+        for cls in (c_type, cxx_type):
+            assert decompose(s, cls, fast_grammar) == decompose(s, cls, pp_grammar)
+
+
+def test_parse_pool_error(configfile, c_header, monkeypatch):
+    import ccrawl.parser
+
+    # a file that parse fails on is reported as such, not as a worker crash:
+    monkeypatch.setattr(ccrawl.parser, "parse", lambda *args, **kargs: None)
+    c = conf.Config(configfile)
+    R = list(parse_pool({c_header: []}, [], "t", c.Collect, 2))
+    assert [(f, l, err) for f, l, dt, err in R] == [(c_header, [], "parse error")]
@@ -0,0 +1,74 @@
+import re
+import pytest
+from ccrawl import conf
+from ccrawl.db import Proxy, MongoDB, where
+from ccrawl.trigrams import *
+
+
+def test_regex_trigrams():
+    assert trigrams("aBcD") == {"abc", "bcd"}
+    assert regex_trigrams("xt_str") == [{"xt_", "t_s", "_st", "str"}]
+    assert regex_trigrams(r"struct \w+_info") == [
+        {"str", "tru", "ruc", "uct", "ct "} | {"_in", "inf", "nfo"}
+    ]
+    assert regex_trigrams("(foo|barz)x+") == [{"foo"}, {"bar", "arz"}]
+    # optional or too short literal parts don't give trigrams:
+    assert regex_trigrams("(foo)?bar") == [{"bar"}]
+    assert regex_trigrams(r".*\?_\w+") is None
+    assert regex_trigrams("(foo|)bar|ab") is None
+    assert regex_trigrams("[") is None
+
+
+def test_search_rex(configfile, tmp_path):
+    c = conf.Config(configfile)
+    conf.config = c
+    db = Proxy(conf.Database(local=str(tmp_path / "t.db"), url=""))
+    docs = [
+        {"id": "struct grA", "cls": "cStruct", "val": [["char *", "name", ""]]},
+        {"id": "MY_FLAG", "cls": "cMacro", "val": "0x10"},
+        {"id": "grB", "cls": "cTypedef", "val": "struct grA"},
+    ]
+    db.insert_multiple(docs)
+    db.flush()
+
+    def search(rex):
+        cx = re.compile(rex, re.MULTILINE)
+        Q = where("id").matches(rex) | where("val").test(lambda v: cx.search(str(v)))
+        L = [l["id"] for l in db.search_rex(rex, Q)]
+        assert L == [l["id"] for l in db.search(Q)]
+        return L
+
+    assert search("struct grA") == ["struct grA", "grB"]
+    assert search(r"char \*") == ["struct grA"]
+    assert search("GRA") == []
+    I = db.trigrams()
+    assert I.stamp == db.stamp()
+    # inserted documents are added to the index which is not rebuilt:
+    db.insert_multiple([{"id": "grC", "cls": "cTypedef", "val": "struct grA *"}])
+    db.flush()
+    assert I.stamp == db.stamp()
+    assert search("struct grA") == ["struct grA", "grB", "grC"]
+    assert len(I.candidates([{"gra"}])) == 3
+    db.close()
+
+
+def test_MongoDB_search_trigrams(fake_mongo):
+    docs = [
+        {"_id": 1, "id": "foo", "tag": "t", "tri": ["foo"]},
+        {"_id": 2, "id": "barz", "tag": "t", "tri": ["arz", "bar"]},
+        {"_id": 3, "id": "bar", "tag": "t", "tri": ["bar"]},
+        {"_id": 4, "id": "foo", "tag": "u", "tri": ["foo"]},
+    ]
+    m = fake_mongo(nodes=docs)
+    L = m.search_trigrams((where("tag") == "t")._hash, [{"foo"}, {"bar", "arz"}])
+    # (the tri field is not returned:)
+    assert L == [{"_id": 1, "id": "foo", "tag": "t"}, {"_id": 2, "id": "barz", "tag": "t"}]
+    # entries without tri are filtered by the query only:
+    m.db["nodes"].docs.append({"_id": 5, "id": "foobar", "tag": "t"})
+    q = (where("tag") == "t") & where("id").search("fo+")
+    L = m.search_trigrams(q._hash, [{"foo"}])
+    assert [d["_id"] for d in L] == [1, 5]
+    T = MongoDB.tri({"id": "abcd", "val": ["x\ny"], "use": ["grA"]})
+    assert T == sorted(T)
+    # raw strings of val are indexed (as well as str(val) for local search):
+    assert {"abc", "bcd", "gra", "x\ny", "x\\n"} <= set(T)
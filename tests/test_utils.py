@@ -152,3 +152,25 @@ def test_cxx_type_16():
     t = cxx_type("struct A::B::C::D")
     assert t.ns == "A::B::C::"
     assert t.show_base() == "D"
+
+
+def test_LRU():
+    d = LRU(2)
+    d["a"] = 1
+    d["b"] = 2
+    assert d.get("a") == 1
+    d["c"] = 3
+    assert "b" not in d
+    assert list(d) == ["a", "c"]
+    assert d.get("b", 0) == 0
+
+
+def test_c_type_cache():
+    n = c_type.cache_info().hits
+    t = c_type("char *[12]")
+    t.pstack.pop()
+    t.lbase = "int"
+    r = c_type("char *[12]")
+    assert c_type.cache_info().hits == n + 1
+    assert r.lbase == "char" and r.dim == 12
+    assert cxx_type("char *[12]").show() == "char *[12]"